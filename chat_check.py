@@ -9,7 +9,7 @@ import requests
 _base_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(_base_dir, "pairing/lib"))
 
-from pair import parse_tournament
+from pair import open_state, parse_tournament
 
 def main():
     arg_parser = ArgumentParser()
@@ -22,8 +22,8 @@ def main():
     resp = requests.post("http://arimaa.com/arimaa/chat/srv.php", data=payload)
     users = resp.content[3:].split()
 
-    with open(args.tournament_state) as state_file:
-        tourn = parse_tournament(state_file.read())
+    with open_state(args.tournament_state) as state_file:
+        tourn = parse_tournament(state_file)
 
     missing = 0
     for player in tourn.players:
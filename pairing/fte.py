@@ -4,16 +4,25 @@ import math
 import os.path
 import sys
 from argparse import ArgumentParser
-from collections import Counter
 
 _base_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(_base_dir, "lib"))
 
 from pair import (
-        assign_colors, from_eventlist,
-        parse_seeds, parse_history, parse_tournament,
-        rate, weighted_pairing,
+        LivesFilter, assign_colors, cached_rate, capture_output,
+        combine_terms, follow_state, open_state, pair_sections, pairing_diff,
+        parse_seeds, parse_history, parse_sections, parse_tournament,
+        sweep_pairings, sweep_variants, weighted_pairing,
         )
+from audit import audit_rounds, print_audit
+from batch import apply_options, request_tournament, run_batch
+from daemon import make_server
+from forecast import Forecaster, print_forecast
+from metrics import last_round, recording
+from result_cache import cached_result
+from simulate import print_summary, simulate_tournaments, summarize
+from snapshot import load_state
+from timing import profiling
 
 class FTE_Scale(object):
     """
@@ -42,33 +51,73 @@ class FTE_Scale(object):
             self.most_games = 0
 
     def bye(self, player):
+        return combine_terms(self.bye_terms(player))
+
+    def bye_terms(self, player):
         lives = self.lives
         num_alive = self.num_alive
 
-        weight = self.most_games - self.tourn.played[player]
-        weight *= self.pair_mul * lives
-        weight += self.tourn.losses[player]
-        weight *= lives * (self.rating_range + 1) * ((num_alive + 1) ** lives)
         # need integer weights
         # FIXME: this can cause bad pairings if small stpr differences exist
-        weight += int(self.max_rating - self.tourn.stpr[player])
-        weight *= self.rating_range ** 2
-        return weight
+        return [
+                ("fewest games", 1, self.most_games - self.tourn.played[player]),
+                ("bye losses", self.pair_mul * lives,
+                    self.tourn.losses[player]),
+                ("bye rating",
+                    lives * (self.rating_range + 1) * ((num_alive + 1) ** lives),
+                    int(self.max_rating - self.tourn.stpr[player])),
+                ("rating difference", self.rating_range ** 2, 0),
+                ]
 
     def pair(self, p1, p2):
+        return combine_terms(self.pair_terms(p1, p2))
+
+    def pair_terms(self, p1, p2):
         lives = self.lives
         num_alive = self.num_alive
 
-        weight = (num_alive + 1) ** self.tourn.pair_counts[frozenset((p1, p2))]
-        weight *= lives ** 2 * ((num_alive + 1) ** lives)
-        weight += (num_alive + 1) ** abs(
-                self.tourn.losses[p1] - self.tourn.losses[p2])
-        weight *= (self.rating_range + 1) * (self.rating_range ** 2)
         # need integer weights
         # FIXME: this can cause bad pairings if small stpr differences exist
-        weight += self.rating_range ** 2 - int(
-                (self.tourn.stpr[p1] - self.tourn.stpr[p2]) ** 2)
-        return weight
+        return [
+                ("repeat pairings", 1,
+                    (num_alive + 1) ** self.tourn.pair_counts[frozenset((p1, p2))]),
+                ("loss difference", lives ** 2 * ((num_alive + 1) ** lives),
+                    (num_alive + 1) ** abs(
+                        self.tourn.losses[p1] - self.tourn.losses[p2])),
+                ("rating difference",
+                    (self.rating_range + 1) * (self.rating_range ** 2),
+                    self.rating_range ** 2 - int(
+                        (self.tourn.stpr[p1] - self.tourn.stpr[p2]) ** 2)),
+                ]
+
+    def history_free_order(self, players):
+        """ Before any games only the rating difference term differs between
+        pairings, and it scores each pair by int(d ** 2) of its STPR gap d.
+        Pairing the top against the bottom is the only best pairing of an
+        even field when 2 * g ** 2 >= k, g being the smallest gap between
+        neighbouring ratings and k the number of pairs:
+
+        Untruncated, a pairing other than the fold has two pairs that
+        aren't nested, (a, c) and (b, d) or (a, b) and (c, d) for ratings
+        a > b > c > d. Nesting them as (a, d) and (b, c) adds 2(a - b)(c - d)
+        or 2(a - c)(b - d) to the sum of squares, at least 2 * g ** 2, and
+        doing so until every pair is nested ends at the fold. So the fold's
+        sum of squares beats any other pairing's by at least 2 * g ** 2.
+        Truncating takes less than 1 off each of the k squares, which can't
+        make up that lead once 2 * g ** 2 >= k.
+
+        An odd field also weighs a truncated bye rating, where different
+        byes can tie, so it is left to the full matching.
+        """
+        if len(players) % 2 == 1:
+            return None
+        stpr = self.tourn.stpr
+        ordered = sorted(players, key=lambda p: (-stpr[p], p))
+        gap = min([stpr[p1] - stpr[p2]
+            for p1, p2 in zip(ordered, ordered[1:])] + [float("inf")])
+        if 2 * gap ** 2 < len(players) // 2:
+            return None
+        return ordered, "fold"
 
 class FTE_2015_Scale(object):
     """
@@ -93,62 +142,64 @@ class FTE_2015_Scale(object):
             self.most_games = 0
 
     def bye(self, player):
+        return combine_terms(self.bye_terms(player))
+
+    def bye_terms(self, player):
         lives = self.lives
         num_alive = self.num_alive
 
-        weight = self.most_games - self.tourn.played[player]
-        weight *= self.pair_mul * lives
-        weight += self.tourn.losses[player]
-        weight *= lives * (num_alive + 1) * ((num_alive + 1) ** lives)
-        weight += self.tourn.ranks[player]
-        weight *= num_alive ** 2
-        return weight
+        return [
+                ("fewest games", 1, self.most_games - self.tourn.played[player]),
+                ("bye losses", self.pair_mul * lives,
+                    self.tourn.losses[player]),
+                ("bye rank",
+                    lives * (num_alive + 1) * ((num_alive + 1) ** lives),
+                    self.tourn.ranks[player]),
+                ("rank difference", num_alive ** 2, 0),
+                ]
 
     def pair(self, p1, p2):
+        return combine_terms(self.pair_terms(p1, p2))
+
+    def pair_terms(self, p1, p2):
         lives = self.lives
         num_alive = self.num_alive
 
-        weight = (num_alive + 1) ** self.tourn.pair_counts[frozenset((p1, p2))]
-        weight *= lives ** 2 * ((num_alive + 1) ** lives)
-        weight += (num_alive + 1) ** abs(
-                self.tourn.losses[p1] - self.tourn.losses[p2])
-        weight *= (num_alive + 1) * (num_alive ** 2)
-        weight += num_alive ** 2 - (
-                self.tourn.ranks[p1] - self.tourn.ranks[p2]) ** 2
-        return weight
+        return [
+                ("repeat pairings", 1,
+                    (num_alive + 1) ** self.tourn.pair_counts[frozenset((p1, p2))]),
+                ("loss difference", lives ** 2 * ((num_alive + 1) ** lives),
+                    (num_alive + 1) ** abs(
+                        self.tourn.losses[p1] - self.tourn.losses[p2])),
+                ("rank difference", (num_alive + 1) * (num_alive ** 2),
+                    num_alive ** 2 - (
+                        self.tourn.ranks[p1] - self.tourn.ranks[p2]) ** 2),
+                ]
+
+    def history_free_order(self, players):
+        """ Before any games only rank separates players, pairing the top
+        against the bottom maximizes the squared rank differences.
+        """
+        return sorted(players, key=lambda p: self.tourn.ranks[p]), "fold"
 
 def filter_games(tourn, lives):
-    losses = Counter()
-    events = list()
-    for event in tourn.events:
-        if event[0] != "game":
-            events.append(event)
-            continue
-        p1, p2, result = event[1]
-        if losses[p1] >= lives and losses[p2] >= lives:
-            continue
-        if losses[p1] >= lives or losses[p2] >= lives:
-            raise ValueError(
-                "Found game between active and eliminated player, %s vs %s" % (
-                    p1, p2))
-        events.append(event)
-        if result[0] == "winner":
-            loser = p1 if result[1] == p2 else p2
-            losses[loser] += 1
-        elif result[0] == "double loss":
-            losses[p1] += 1
-            losses[p2] += 1
-    return from_eventlist(events)
+    """ Drop games between players who were both already eliminated """
+    key = ("lives", lives)
+    if key not in tourn.views:
+        view = LivesFilter(lives)
+        for event in tourn.events:
+            view.apply_event(event)
+        tourn.views[key] = view.tournament(tourn)
+    return tourn.views[key]
 
-def get_pairings(tourn, config):
-    lives = config.lives
+def rank_players(tourn, config):
+    """ Rate the players and set their order and rank on tourn """
     virtual = config.virtual if hasattr(config, "virtual") else 0.5
     use_utpr = config.utpr if hasattr(config, "utpr") else False
-    use_2015 = config.wc2015 if hasattr(config, "wc2015") else False
 
-    stpr = rate(tourn.seeds, tourn, virtual)
+    stpr = cached_rate(tourn.seeds, tourn, virtual)
     if use_utpr:
-        utpr = rate({p: 1500 for p in tourn.seeds}, tourn, virtual)
+        utpr = cached_rate({p: 1500 for p in tourn.seeds}, tourn, virtual)
         def order(p):
             return (tourn.losses[p], -utpr[p], -stpr[p])
     else:
@@ -158,6 +209,12 @@ def get_pairings(tourn, config):
     sorted_players = sorted(tourn.players, key=order)
     tourn.ranks = {p: rank for rank, p in enumerate(sorted_players, start=1)}
     tourn.stpr = stpr
+
+def get_pairings(tourn, config):
+    lives = config.lives
+    use_2015 = config.wc2015 if hasattr(config, "wc2015") else False
+
+    rank_players(tourn, config)
     tourn.players = set([p for p in tourn.players if tourn.losses[p] < lives])
     if use_2015:
         scale = FTE_2015_Scale(lives, tourn)
@@ -167,9 +224,9 @@ def get_pairings(tourn, config):
     return pairings, bye
 
 def print_final_ranking(tourn, virtual, use_utpr=False):
-    stpr = rate(tourn.seeds, tourn, virtual)
+    stpr = cached_rate(tourn.seeds, tourn, virtual)
     if use_utpr:
-        utpr = rate({p: 1500 for p in tourn.seeds}, tourn, virtual)
+        utpr = cached_rate({p: 1500 for p in tourn.seeds}, tourn, virtual)
         def order(p):
             return (-(tourn.wins[p] + tourn.byes[p]),
                 -utpr[p], -stpr[p])
@@ -185,6 +242,72 @@ def print_final_ranking(tourn, virtual, use_utpr=False):
             print -rating,
         print
 
+def print_ranks(tourn):
+    players = sorted(tourn.ranks, key=lambda p: tourn.ranks[p])
+    for p in players:
+        print "#", tourn.ranks[p], p, tourn.player_order[p][0],
+        for r in tourn.player_order[p][1:]:
+            print -r,
+        print
+
+def print_sweep(tourn, args):
+    variants = sweep_variants(args, args.sweep, ("utpr", "wc2015"))
+    results = sweep_pairings(tourn, get_pairings, variants, args.processes)
+    for variant, result in zip(variants, results):
+        flags = [f for f in ("utpr", "wc2015") if getattr(variant, f)]
+        print " ".join(["# virtual", str(variant.virtual)] + flags)
+        pairings, bye = result
+        if bye:
+            print "bye", bye
+        for p1, p2 in pairings:
+            print "game", p1, p2
+        removed, added = pairing_diff(results[0], result)
+        if removed or added:
+            print "# %d boards differ from first variant" % (len(removed),)
+            for board in removed:
+                print "# -", " ".join(board)
+            for board in added:
+                print "# +", " ".join(board)
+
+def print_sections(sections, args):
+    """ Pair every section at once and print them in order """
+    if args.sweep or args.audit or args.forecast:
+        print "Pick a section with --section"
+        sys.exit(1)
+    results = pair_sections(sections, lambda tourn: pair_round(tourn, args),
+            args.processes)
+    for name, (result, output) in results.items():
+        print "# section", name
+        sys.stdout.write(output)
+
+BATCH_OPTIONS = ("lives", "virtual", "utpr", "wc2015", "all_games",
+        "ranks", "show_arbitrary")
+
+def batch_request(request, args):
+    """ Pair one --batch request """
+    config = apply_options(args, request.get("options", {}), BATCH_OPTIONS)
+    tourn = request_tournament(request)
+    if not config.all_games:
+        # kept on the cached tournament for the next request
+        filter_games(tourn, config.lives)
+    (pairings, bye), output = capture_output(pair_round,
+            tourn.working_copy(), config)
+    return {"pairings": pairings, "bye": bye, "output": output}
+
+def serve_commands(args):
+    """ The commands answered by --serve """
+    def ranks(tourn):
+        tourn = prepare(tourn, args)
+        rank_players(tourn, args)
+        print_ranks(tourn)
+    def standings(tourn):
+        print_final_ranking(prepare(tourn, args), args.virtual, args.utpr)
+    return {
+            "pair": lambda tourn: pair_round(tourn, args),
+            "ranks": ranks,
+            "standings": standings,
+            }
+
 def parse_args(args=None):
     parser = ArgumentParser(description="Pair FTE tournament")
     parser.add_argument("-v", "--virtual", help="Virtual game weight",
@@ -203,9 +326,78 @@ def parse_args(args=None):
     parser.add_argument("--show-arbitrary",
             help="Indicate arbitrary color assignments",
             action="store_true")
+    parser.add_argument("--sweep", metavar="VIRTUALS",
+            type=lambda s: [float(v) for v in s.split(",")],
+            help="Compare pairings for each comma separated virtual weight "
+            "with and without --utpr and --wc2015")
+    parser.add_argument("--processes", type=int,
+            help="Number of worker processes for --sweep, --speculate, "
+            "--simulate, --audit, --batch and state files with sections, by "
+            "default one per CPU")
     parser.add_argument("--seed_file", "--seeds", help="aaaa style player seeds")
     parser.add_argument("--game_file", "--games",
             help="aaaa style tournament history")
+    parser.add_argument("--snapshot",
+            help="Load the state through a binary snapshot kept next to it",
+            action="store_true")
+    parser.add_argument("--follow",
+            help="Keep following the state file, pairing each round as soon "
+            "as the previous one is complete", action="store_true")
+    parser.add_argument("--interval",
+            help="Seconds between checks of the state file with --follow",
+            type=float, default=5.0)
+    parser.add_argument("--speculate", metavar="GAMES", type=int, default=0,
+            help="With --follow, pair the next round for every outcome once "
+            "no more than this many games are left")
+    parser.add_argument("--speculate-results", metavar="RESULTS",
+            type=lambda s: s.split(","), default=[],
+            help="Comma separated results besides a win to speculate on, "
+            "like draw")
+    parser.add_argument("--batch",
+            help="Pair the JSON requests read from each line of stdin",
+            action="store_true")
+    parser.add_argument("--serve", metavar="ADDRESS",
+            help="Keep running and answer pairing requests on this Unix "
+            "socket path or host:port")
+    parser.add_argument("--memory-cap", metavar="MB", type=float,
+            default=512, help="Memory for tournaments kept by --serve")
+    parser.add_argument("--cache-dir", metavar="DIR",
+            help="Keep pairings in this directory and print them from there "
+            "when the same state is paired with the same options again")
+    parser.add_argument("--cache-size", metavar="MB", type=float,
+            default=64, help="Size limit of --cache-dir")
+    parser.add_argument("--profile",
+            help="Print the time taken by each phase of the run to stderr",
+            action="store_true")
+    parser.add_argument("--profile-dump", metavar="FILE",
+            help="Write cProfile stats of the whole run to this file")
+    parser.add_argument("--metrics", metavar="FILE",
+            help="Append the size and cost of pairing each round to this "
+            "file, see metrics_report.py")
+    parser.add_argument("--metrics-format", choices=("jsonl", "prometheus"),
+            help="Format of --metrics, by default prometheus for a .prom "
+            "file and JSON lines otherwise")
+    parser.add_argument("--section",
+            help="Only use this section of a state file with sections")
+    parser.add_argument("--audit",
+            help="Pair every round of the state file again and report where "
+            "the recorded games differ", action="store_true")
+    parser.add_argument("--simulate", metavar="COUNT", type=int,
+            help="Simulate this many tournaments of random players paired "
+            "with these options and print summary statistics")
+    parser.add_argument("--field-size", type=int, default=16,
+            help="Number of players in each simulated tournament")
+    parser.add_argument("--rounds", type=int,
+            help="Rounds per simulated tournament, by default until "
+            "one player is left")
+    parser.add_argument("--sim-seed", type=int, default=0,
+            help="Base random seed for --simulate")
+    parser.add_argument("--forecast", metavar="FUTURES", type=int,
+            help="Print each player's chance of finishing in the top "
+            "places from this many simulated futures")
+    parser.add_argument("--exact-forecast",
+            help="Pair the futures of --forecast with the real pairing "
+            "instead of a quick approximation", action="store_true")
     parser.add_argument("tournament_state", help="Tournament state file",
             nargs="?")
     args = parser.parse_args(args)
@@ -213,43 +405,131 @@ def parse_args(args=None):
         print "Cannot use both regular tournament state file and aaaa style"
         parser.print_help()
         sys.exit(1)
+    if args.simulate or args.serve or args.batch:
+        return args
     if not args.seed_file and not args.tournament_state:
         print "Must give tournament state"
         parser.print_help()
         sys.exit(1)
+    if (args.follow or args.audit) and not args.tournament_state:
+        print "Can only follow or audit a tournament state file"
+        parser.print_help()
+        sys.exit(1)
     return args
 
 def main(args=None):
     args = parse_args(args)
+    with profiling(args.profile, args.profile_dump):
+        run(args)
+
+def run(args):
+    if args.batch:
+        run_batch(sys.stdin, lambda request: batch_request(request, args),
+                args.processes)
+        return
+    if args.serve:
+        server = make_server(args.serve, serve_commands(args),
+                args.memory_cap * 2 ** 20, [] if args.all_games else [LivesFilter(args.lives)])
+        server.serve_forever()
+        return
+    if args.simulate:
+        results = simulate_tournaments(
+                lambda tourn: simulated_round(tourn, args), args.simulate,
+                args.field_size, args.sim_seed, args.rounds, args.processes)
+        print_summary(summarize(results))
+        return
+    forecaster = None
+    if args.forecast:
+        exact = None
+        if args.exact_forecast:
+            exact = lambda tourn: simulated_round(tourn, args)
+        forecaster = Forecaster(args.lives, args.forecast, args.virtual,
+                args.sim_seed, exact)
+    if args.follow:
+        report = None
+        if forecaster is not None:
+            report = lambda tourn, boards: print_forecast(
+                    forecaster.forecast(prepare(tourn, args), boards))
+        follow_state(args.tournament_state,
+                lambda tourn: pair_round(tourn, args), args.interval,
+                speculate=args.speculate, results=args.speculate_results,
+                processes=args.processes, report=report)
+        return
     if args.tournament_state:
-        with open(args.tournament_state) as state_file:
-            tourn = parse_tournament(state_file.read())
+        if args.snapshot:
+            tourn = load_state(args.tournament_state, args.section)
+        else:
+            views = [] if args.all_games else [LivesFilter(args.lives)]
+            with open_state(args.tournament_state) as state_file:
+                if args.section is not None:
+                    tourn = parse_tournament(state_file, views, args.section)
+                else:
+                    sections = parse_sections(state_file, views)
+            if args.section is None:
+                if list(sections) != [None]:
+                    print_sections(sections, args)
+                    return
+                tourn = sections[None]
     else:
-        with open(args.seed_file) as seed_file:
-            seed_data = seed_file.read()
-            tourn = parse_seeds(seed_data)
+        with open_state(args.seed_file) as seed_file:
+            tourn = parse_seeds(seed_file)
         if args.game_file:
-            with open(args.game_file) as history_file:
-                history_data = history_file.read()
-                parse_history(tourn, history_data)
+            with open_state(args.game_file) as history_file:
+                parse_history(tourn, history_file)
+
+    if args.audit:
+        audit = audit_rounds(tourn.events,
+                lambda tourn: simulated_round(tourn, args), args.processes)
+        if not print_audit(audit):
+            sys.exit(1)
+        return
+    if args.sweep:
+        print_sweep(prepare(tourn, args), args)
+        return
+    if forecaster is not None:
+        print_forecast(forecaster.forecast(prepare(tourn, args)))
+        return
+    pair_round(tourn, args)
 
+def prepare(tourn, args):
+    """ A working copy of the tournament, or of its cached lives view, for
+    get_pairings to filter the eliminated players out of
+    """
     if not args.all_games:
         tourn = filter_games(tourn, args.lives)
+    return tourn.working_copy()
+
+def pairing_options(args):
+    """ The options that change the pairing, for the --cache-dir key """
+    return {"lives": args.lives, "virtual": args.virtual, "utpr": args.utpr,
+            "wc2015": args.wc2015, "all_games": args.all_games}
+
+def solve_round(tourn, args):
+    """ The coloured pairings, bye and ranks of the next round """
     pairings, bye = get_pairings(tourn, args)
+    pairings, arbitrary = assign_colors(tourn, pairings)
+    pairings.sort(key=lambda pr: min(tourn.ranks[pr[0]], tourn.ranks[pr[1]]))
+    return {"pairings": pairings, "bye": bye, "arbitrary": arbitrary,
+            "ranks": tourn.ranks, "player_order": tourn.player_order}
+
+def pair_round(tourn, args):
+    """ Pair and print the next round, returns its pairings and bye """
+    key_tourn = tourn
+    tourn = prepare(tourn, args)
+    with recording(args.metrics, args.metrics_format, script="fte",
+            round=last_round(tourn.events)):
+        result, output = cached_result(key_tourn, pairing_options(args), args,
+                __file__, lambda: solve_round(tourn, args))
+    sys.stdout.write(output)
+    tourn.ranks = result["ranks"]
+    tourn.player_order = result["player_order"]
+    pairings, bye = result["pairings"], result["bye"]
+    arbitrary = result["arbitrary"]
     if len(pairings) == 0: # tournament is finished, print final ranks
         print_final_ranking(tourn, args.virtual, args.utpr)
 
     if args.ranks:
-        players = sorted(tourn.ranks, key=lambda p: tourn.ranks[p])
-        for p in players:
-            print "#", tourn.ranks[p], p, tourn.player_order[p][0],
-            for r in tourn.player_order[p][1:]:
-                print -r,
-            print
-
-    pairings, arbitrary = assign_colors(tourn, pairings)
-
-    pairings.sort(key=lambda pr: min(tourn.ranks[pr[0]], tourn.ranks[pr[1]]))
+        print_ranks(tourn)
 
     if bye:
         print "bye", bye
@@ -258,6 +538,14 @@ def main(args=None):
             print "game", p1, p2, "# A" if (p1, p2) in arbitrary else ""
         else:
             print "game", p1, p2
+    return pairings, bye
+
+def simulated_round(tourn, args):
+    """ Pair a round of a simulated tournament without printing it """
+    tourn = prepare(tourn, args)
+    pairings, bye = get_pairings(tourn, args)
+    pairings, arbitrary = assign_colors(tourn, pairings)
+    return pairings, bye
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,138 @@
+
+""" Check published pairings against what the pairing code produces
+
+The event log is split at its round lines. The Tournament each round was
+paired from is built in one pass over the log and the round paired again
+from it, in parallel worker processes. The result is compared with
+the games and bye recorded in that round, the order of each game's players
+giving the colours that were used.
+"""
+
+from multiprocessing import Pool
+
+from pair import EventState, build_tournament, pairing_diff
+
+def round_prefixes(events):
+    """ The Tournament each round was paired from and what it recorded
+
+    A round is paired from every event before its first game or bye, which
+    takes in the round line and the constraints and removals given after
+    it. Its rounds only count the rounds before it though, as in a state
+    file the round is paired from, and the force and exclude lines given
+    before the round line stay in force although the round line clears
+    them. Returns a list of (round, tourn, (pairings, bye)) with the games
+    of the round as recorded, in order. A round with more than one bye
+    records the first.
+    """
+    state = EventState()
+    tourn = None
+    rounds = list()
+    chunk = list()
+    def snapshot(tourn):
+        forced, excluded = list(), set()
+        for event_num, event in chunk:
+            if event[0] == "round":
+                forced, excluded = list(state.forced), set(state.excluded)
+            state.position = ("event", event_num)
+            state.apply(event)
+        tourn = build_tournament(state, [e for n, e in chunk], tourn)
+        del chunk[:]
+        prefix = tourn.copy()
+        prefix.seeds = dict(tourn.seeds)
+        paired = set(frozenset(pr) for pr in forced)
+        prefix.forced = tuple(forced + [pr for pr in tourn.forced
+                if frozenset(pr) not in paired])
+        prefix.excluded = frozenset(excluded | tourn.excluded)
+        return tourn, prefix
+    for event_num, event in enumerate(events):
+        if rounds and rounds[-1][1] is None and (
+                event[0] in ("game", "bye", "round")):
+            tourn, prefix = snapshot(tourn)
+            prefix.rounds = rounds[-1][0] - 1 or None
+            rounds[-1][1] = prefix
+        if event[0] == "round":
+            rounds.append([event[1], None, list(), list()])
+        elif rounds and event[0] == "game":
+            rounds[-1][2].append(tuple(event[1][:2]))
+        elif rounds and event[0] == "bye":
+            rounds[-1][3].append(event[1][0])
+        chunk.append((event_num, event))
+    if rounds and rounds[-1][1] is None:
+        tourn, prefix = snapshot(tourn)
+        prefix.rounds = rounds[-1][0] - 1 or None
+        rounds[-1][1] = prefix
+    return [(round_num, prefix, (pairings, byes[0] if byes else None))
+            for round_num, prefix, pairings, byes in rounds]
+
+_audit_state = dict()
+
+def _audit_init(prefixes, pair_func):
+    _audit_state["prefixes"] = prefixes
+    _audit_state["pair"] = pair_func
+
+def _audit_round(index):
+    """ The pairing of a round and None, or None and why it couldn't be
+    paired, so one bad round doesn't lose the audit of the others
+    """
+    try:
+        return _audit_state["pair"](_audit_state["prefixes"][index]), None
+    except Exception as err:
+        return None, "%s: %s" % (type(err).__name__, err)
+
+def audit_rounds(events, pair_func, processes=None):
+    """ Pair every round of the log again and compare with the record
+
+    pair_func is called with the Tournament a round was paired from and
+    returns the coloured pairings and bye for it, it gets to the workers
+    when the pool starts. Returns (round, recorded, paired, recoloured,
+    error) for each round, recoloured being the recorded games whose
+    colours were swapped. When pair_func raises, paired is None and error
+    describes the exception.
+    """
+    rounds = round_prefixes(events)
+    pool = Pool(processes, initializer=_audit_init,
+            initargs=([prefix for r, prefix, recorded in rounds], pair_func))
+    try:
+        results = pool.map(_audit_round, range(len(rounds)))
+    finally:
+        pool.close()
+        pool.join()
+    audit = list()
+    for (round_num, prefix, recorded), (paired, error) in zip(rounds,
+            results):
+        recoloured = list()
+        if paired is not None:
+            coloured = set(paired[0])
+            recoloured = [game for game in recorded[0]
+                    if game not in coloured and game[::-1] in coloured]
+        audit.append((round_num, recorded, paired, recoloured, error))
+    return audit
+
+def print_audit(audit):
+    """ Print a line for each round and the differences found, returns
+    whether every round matched, which a log without rounds doesn't
+    """
+    if not audit:
+        print "# no round lines found, nothing to audit"
+        return False
+    matched = True
+    for round_num, recorded, paired, recoloured, error in audit:
+        if error is not None:
+            matched = False
+            print "# round %d could not be paired, %s" % (round_num, error)
+            continue
+        removed, added = pairing_diff(recorded, paired)
+        if not removed and not added and not recoloured:
+            print "# round %d matches, %d games" % (round_num,
+                    len(recorded[0]))
+            continue
+        matched = False
+        print "# round %d differs, %d boards and %d colours" % (round_num,
+                len(removed), len(recoloured))
+        for board in removed:
+            print "# - recorded", " ".join(board)
+        for board in added:
+            print "# + paired", " ".join(board)
+        for p1, p2 in recoloured:
+            print "# colours recorded", p1, p2, "paired", p2, p1
+    return matched
@@ -0,0 +1,114 @@
+
+""" Answer many pairing requests in one process
+
+Requests are read as JSON lines and answered by a pool of worker
+processes, each result written as a JSON line in the order the requests
+came in. A request gives its tournament as one of:
+
+    "state": the text of a state file
+    "path": the path of a state file
+    "format": "aaaa" with "seeds" and optionally "games" holding the text
+        of aaaa style seed and history files
+
+and "options" overriding the command line options, like {"lives": 2}. An
+"id" is copied to the result. Results carry the "pairings", "bye" and
+printed "output" of the pairing, or an "error".
+
+Each worker keeps the tournaments it parsed most recently with their
+ratings, so requests that only differ in options parse and rate once.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import sys
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from pair import open_state, parse_history, parse_seeds, parse_tournament
+
+CACHED_TOURNAMENTS = 16
+
+_batch_state = dict()
+
+def _batch_init(handler):
+    _batch_state["handler"] = handler
+    _batch_state["tournaments"] = OrderedDict()
+
+def request_tournament(request):
+    """ The Tournament a request gives, from the worker's cache if it's
+    been parsed before
+
+    The cached Tournament is shared, so it should only be paired through
+    a working copy.
+    """
+    fmt = request.get("format", "state")
+    if fmt == "aaaa":
+        key = ("aaaa", hashlib.sha1(request["seeds"].encode("utf-8")
+            + "\0" + request.get("games", "").encode("utf-8")).digest())
+    elif fmt != "state":
+        raise ValueError("Unknown state format %s" % (fmt,))
+    elif "state" in request:
+        key = ("state", hashlib.sha1(
+            request["state"].encode("utf-8")).digest())
+    elif "path" in request:
+        stat = os.stat(request["path"])
+        key = ("path", request["path"], stat.st_mtime, stat.st_size)
+    else:
+        raise ValueError("Request has no state or path")
+    tournaments = _batch_state["tournaments"]
+    tourn = tournaments.pop(key, None)
+    if tourn is None:
+        if fmt == "aaaa":
+            tourn = parse_seeds(request["seeds"].encode("utf-8"))
+            if "games" in request:
+                parse_history(tourn, request["games"].encode("utf-8"))
+        elif "state" in request:
+            tourn = parse_tournament(request["state"].encode("utf-8"))
+        else:
+            with open_state(request["path"]) as state_file:
+                tourn = parse_tournament(state_file)
+    tournaments[key] = tourn
+    while len(tournaments) > CACHED_TOURNAMENTS:
+        tournaments.popitem(last=False)
+    return tourn
+
+def apply_options(config, options, allowed):
+    """ A copy of config with the request's options set on it """
+    config = copy.copy(config)
+    for name, value in options.items():
+        if name not in allowed:
+            raise ValueError("Unknown option %s" % (name,))
+        setattr(config, name, value)
+    return config
+
+def _batch_answer(line):
+    result = dict()
+    try:
+        request = json.loads(line)
+        if "id" in request:
+            result["id"] = request["id"]
+        result.update(_batch_state["handler"](request))
+    except Exception as err:
+        # one bad request shouldn't stop the rest of the batch
+        result["error"] = "%s: %s" % (type(err).__name__, err)
+    return json.dumps(result)
+
+def run_batch(lines, handler, processes=None, output=sys.stdout):
+    """ Answer each request line with handler in a process pool
+
+    handler is called with the decoded request and returns the fields of
+    its result, it gets to the workers when the pool starts. Blank lines
+    are skipped and results are written as soon as every request before
+    them has been answered.
+    """
+    pool = Pool(processes, initializer=_batch_init, initargs=(handler,))
+    try:
+        requests = (line for line in lines if line.strip())
+        for result in pool.imap(_batch_answer, requests):
+            output.write(result + "\n")
+            output.flush()
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,223 @@
+
+""" Serve pairings from a long running process
+
+The server listens on a Unix socket, or on host:port over TCP, and keeps
+the Tournament of every tournament it has been sent in memory together with
+its ratings and the output of the last commands run on it. Requests and
+responses are single lines of JSON. A request names its tournament and can
+carry any of:
+
+    "lines": state file lines to add to the tournament
+    "path": a state file to keep the tournament in step with
+    "command": one of the commands the server was started with, such as
+        "pair", "ranks" or "standings"
+
+The response has the printed "output" of the command, or an "error".
+
+Tournaments are kept in least recently used order and the oldest ones
+dropped once their estimated size, worked out from their number of events,
+goes over the memory cap. A dropped tournament fed with lines has to be sent again,
+one following a file is parsed again on its next request.
+"""
+
+import copy
+import json
+import os
+import socket
+import threading
+from collections import OrderedDict
+from SocketServer import (StreamRequestHandler, TCPServer, ThreadingMixIn,
+        UnixStreamServer)
+
+from pair import StateFollower, StateParser, build_tournament, capture_output
+
+# about what each event of a tournament with a lives view takes pickled, 120
+# bytes for 8 players up to 155 for 128
+EVENT_SIZE = 150
+
+class CachedTournament(object):
+    """ A tournament built from lines sent to the server or from a file """
+    def __init__(self, views=(), path=None):
+        self.path = path
+        self.results = dict()
+        self.prototypes = views
+        if path is not None:
+            self.follower = StateFollower(path)
+            self.tourn = None
+        else:
+            self.parser = StateParser()
+            self.views = [copy.deepcopy(view) for view in views]
+            self.tourn = build_tournament(self.parser.state, (),
+                    views=self.views)
+        self.measure()
+
+    def add_views(self):
+        """ Build the views of a tournament parsed from a file """
+        for prototype in self.prototypes:
+            view = copy.deepcopy(prototype)
+            for event in self.tourn.events:
+                view.apply_event(event)
+            self.tourn.views[view.key] = view.tournament(self.tourn)
+
+    def measure(self):
+        if self.tourn is None:
+            self.size = 0
+        else:
+            self.size = EVENT_SIZE * len(self.tourn.events)
+
+    def add_lines(self, lines):
+        """ Add state lines, none of them are kept if one is invalid """
+        if self.path is not None:
+            raise ValueError("Cannot add lines to a tournament from a file")
+        state = copy.deepcopy(self.parser.state)
+        line_num = self.parser.line_num
+        try:
+            events = list(self.parser.iter_events(lines))
+        except ValueError:
+            self.parser.state = state
+            self.parser.line_num = line_num
+            raise
+        if events:
+            self.tourn = build_tournament(self.parser.state, events,
+                    self.tourn, self.views)
+            self.results.clear()
+            self.measure()
+
+    def update(self):
+        """ Catch up with the followed file, which can still be empty """
+        if self.path is None:
+            return
+        if self.follower.update() != [] or self.tourn is None:
+            self.tourn = self.follower.tournament()
+            self.add_views()
+            self.results.clear()
+            self.measure()
+
+    def run(self, name, command):
+        """ Output of command, run again only after the tournament changed
+
+        The command gets a working copy of the tournament so its ratings
+        are kept for the next command while the players it filters out are
+        not.
+        """
+        if not self.tourn.seeds:
+            raise ValueError("Tournament has no players yet")
+        if name not in self.results:
+            result, output = capture_output(command,
+                    self.tourn.working_copy())
+            self.results[name] = output
+        return self.results[name]
+
+class TournamentCache(object):
+    def __init__(self, memory_cap, views=()):
+        self.memory_cap = memory_cap
+        self.views = views
+        self.entries = OrderedDict()
+
+    def get(self, key, path=None, create=False):
+        """ The tournament under key, made the most recently used one """
+        entry = self.entries.pop(key, None)
+        if entry is not None and path is not None and entry.path != path:
+            entry = None
+        if entry is None:
+            if path is None and not create:
+                raise ValueError("Unknown tournament %s, send its state" % (
+                    key,))
+            entry = CachedTournament(self.views, path)
+        self.entries[key] = entry
+        return entry
+
+    def trim(self):
+        """ Drop the least recently used tournaments over the memory cap """
+        total = sum(entry.size for entry in self.entries.values())
+        while total > self.memory_cap and len(self.entries) > 1:
+            key, entry = self.entries.popitem(last=False)
+            total -= entry.size
+
+class PairingServer(object):
+    def __init__(self, commands, memory_cap, views=()):
+        self.commands = commands
+        self.cache = TournamentCache(memory_cap, views)
+        self.lock = threading.Lock()
+
+    def handle(self, request):
+        """ Answer one request, see the module docstring """
+        try:
+            with self.lock:
+                return {"output": self._handle(request)}
+        except (KeyError, ValueError, IOError) as err:
+            return {"error": str(err)}
+        except Exception as err:
+            # a failing command mustn't take the connection down with it
+            return {"error": "%s: %s" % (type(err).__name__, err)}
+
+    def _handle(self, request):
+        key = request["tournament"]
+        path = request.get("path")
+        entry = self.cache.get(key, path, "lines" in request)
+        if "lines" in request:
+            entry.add_lines([line.encode("utf-8")
+                for line in request["lines"]])
+        entry.update()
+        output = ""
+        name = request.get("command")
+        if name is not None:
+            if name not in self.commands:
+                raise ValueError("Unknown command %s" % (name,))
+            output = entry.run(name, self.commands[name])
+        self.cache.trim()
+        return output
+
+class _RequestHandler(StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {"error": "Request is not valid JSON"}
+            else:
+                response = self.server.pairing.handle(request)
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+class _UnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+class _TCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def parse_address(address):
+    """ (host, port) for host:port, otherwise the Unix socket path """
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        return (host, int(port))
+    return address
+
+def make_server(address, commands, memory_cap, views=()):
+    """ A server for address, run it with serve_forever() """
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        server = _TCPServer(address, _RequestHandler)
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = _UnixServer(address, _RequestHandler)
+    server.pairing = PairingServer(commands, memory_cap, views)
+    return server
+
+def request(address, message):
+    """ Send one request to a server and return its response """
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        conn = socket.create_connection(address)
+    else:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(address)
+    try:
+        conn_file = conn.makefile("rw")
+        conn_file.write(json.dumps(message) + "\n")
+        conn_file.flush()
+        return json.loads(conn_file.readline())
+    finally:
+        conn.close()
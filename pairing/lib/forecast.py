@@ -0,0 +1,290 @@
+
+""" Forecast the final places of a running FTE tournament
+
+Many futures of the tournament are played out at once. Games are decided
+from the current ratings with the same logistic model the simulator uses
+and each future round is paired by a fast heuristic: the players still in
+are ordered by losses and rating, neighbours are paired and with an odd
+number left the last player gets the bye. Final places follow the order
+print_final_ranking uses, wins and byes and then rating.
+
+With NumPy the futures are kept as arrays and each round is played for all
+of them in a few vector operations. Without it the same model is played
+one future at a time, which gives different samples for the same seed.
+Passing an exact pairing function instead plays every future round with it
+on a copy of the Tournament, which is much slower.
+
+A Forecaster keeps its futures between calls. While only results of the
+current round's boards come in, the futures that already guessed them
+right are kept and only the rest are played again.
+"""
+
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pair import cached_rate
+from simulate import win_probability
+
+class Forecaster(object):
+    def __init__(self, lives, futures=2000, virtual=0.5, seed=0,
+            pair_func=None):
+        self.lives = lives
+        self.futures = futures
+        self.virtual = virtual
+        self.pair_func = pair_func
+        self.random = random.Random(seed)
+        if numpy is not None:
+            self.numpy_random = numpy.random.RandomState(seed)
+        self.base = None
+        self.outcomes = None
+        self.places = None
+
+    def forecast(self, tourn, boards=()):
+        """ Probabilities of each player finishing in each place
+
+        boards are the games of the current round that haven't been played
+        yet. When called again with the same boards, games recorded on them
+        since are taken as they are. The result maps each player to a list
+        of probabilities for first place, second place and so on.
+        """
+        boards = [tuple(board) for board in boards]
+        fixed = self._reuse(tourn, boards)
+        if fixed is None:
+            self.base = (tourn.events, tuple(boards))
+            self.setup(tourn, boards)
+            fixed = dict()
+            self.outcomes, self.places = self.play(self.futures, fixed)
+        elif fixed:
+            self.replay(fixed)
+        return self.probabilities()
+
+    def _reuse(self, tourn, boards):
+        """ The results recorded on boards since the futures were played,
+        None if they have to be played from scratch
+        """
+        if self.base is None:
+            return None
+        events, base_boards = self.base
+        if (tuple(boards) != base_boards
+                or tourn.events[:len(events)] != events):
+            return None
+        board_num = {frozenset(board): num
+                for num, board in enumerate(boards)}
+        fixed = dict()
+        for etype, info in tourn.events[len(events):]:
+            num = board_num.get(frozenset(info[:2]))
+            if etype != "game" or num is None or info[2][0] != "winner":
+                return None
+            fixed[num] = info[2][1] == boards[num][0]
+        return fixed
+
+    def setup(self, tourn, boards):
+        ratings = cached_rate(tourn.seeds, tourn, self.virtual)
+        self.tourn = tourn
+        self.players = sorted(tourn.players, key=lambda p: -ratings[p])
+        self.index = {p: ix for ix, p in enumerate(self.players)}
+        self.ratings = [ratings[p] for p in self.players]
+        self.losses = [tourn.losses[p] for p in self.players]
+        self.scores = [tourn.wins[p] + tourn.byes[p] for p in self.players]
+        self.boards = [(self.index[p1], self.index[p2]) for p1, p2 in boards]
+
+    def replay(self, fixed):
+        """ Play again the futures that got one of the fixed results wrong """
+        if numpy is not None:
+            wrong = numpy.zeros(len(self.outcomes), dtype=bool)
+            for num, first_won in fixed.items():
+                wrong |= self.outcomes[:, num] != first_won
+            count = int(wrong.sum())
+            if count:
+                outcomes, places = self.play(count, fixed)
+                self.outcomes[wrong] = outcomes
+                self.places[wrong] = places
+            return
+        for ix, outcome in enumerate(self.outcomes):
+            if any(outcome[num] != first_won
+                    for num, first_won in fixed.items()):
+                outcome, places = self.play(1, fixed)
+                self.outcomes[ix] = outcome[0]
+                self.places[ix] = places[0]
+
+    def play(self, count, fixed):
+        """ Play count futures with the fixed board results
+
+        Returns which boards the first player won and the final place of
+        each player in every future.
+        """
+        if self.pair_func is not None:
+            return self._play_exact(count, fixed)
+        if numpy is not None:
+            return self._play_arrays(count, fixed)
+        return self._play_lists(count, fixed)
+
+    def _play_arrays(self, count, fixed):
+        rng = self.numpy_random
+        num = len(self.players)
+        ratings = numpy.array(self.ratings, dtype=float)
+        losses = numpy.tile(numpy.array(self.losses), (count, 1))
+        scores = numpy.tile(numpy.array(self.scores), (count, 1))
+        rows = numpy.arange(count)[:, numpy.newaxis]
+
+        outcomes = numpy.empty((count, len(self.boards)), dtype=bool)
+        for board, (p1, p2) in enumerate(self.boards):
+            if board in fixed:
+                outcomes[:, board] = fixed[board]
+            else:
+                chance = win_probability(ratings[p1], ratings[p2])
+                outcomes[:, board] = rng.random_sample(count) < chance
+            winner = numpy.where(outcomes[:, board], p1, p2)
+            loser = numpy.where(outcomes[:, board], p2, p1)
+            scores[rows[:, 0], winner] += 1
+            losses[rows[:, 0], loser] += 1
+
+        # players are indexed in rating order so the index breaks ties
+        order_key = numpy.arange(num)
+        while True:
+            alive = losses < self.lives
+            alive_count = alive.sum(axis=1)
+            if alive_count.max() < 2:
+                break
+            key = numpy.where(alive, losses * num + order_key,
+                    (self.lives + 1) * num + order_key)
+            order = numpy.argsort(key, axis=1)
+            odd = (alive_count % 2 == 1) & (alive_count > 1)
+            bye = order[rows[:, 0], numpy.maximum(alive_count - 1, 0)]
+            scores[rows[odd, 0], bye[odd]] += 1
+            half = num // 2
+            first = order[:, 0:2 * half:2]
+            second = order[:, 1:2 * half:2]
+            valid = numpy.arange(half) < (alive_count // 2)[:, numpy.newaxis]
+            chance = 1 / (1 + 10 ** ((ratings[second] - ratings[first])
+                / 400))
+            first_won = rng.random_sample((count, half)) < chance
+            winner = numpy.where(first_won, first, second)
+            loser = numpy.where(first_won, second, first)
+            won_rows = numpy.broadcast_to(rows, valid.shape)[valid]
+            scores[won_rows, winner[valid]] += 1
+            losses[won_rows, loser[valid]] += 1
+
+        order = numpy.argsort(-scores * num + order_key, axis=1)
+        places = numpy.empty_like(order)
+        places[rows, order] = numpy.arange(num)
+        return outcomes, places
+
+    def _play_lists(self, count, fixed):
+        rng = self.random
+        num = len(self.players)
+        ratings = self.ratings
+        all_outcomes = list()
+        all_places = list()
+        for _ in range(count):
+            losses = list(self.losses)
+            scores = list(self.scores)
+            outcome = list()
+            for board, (p1, p2) in enumerate(self.boards):
+                if board in fixed:
+                    first_won = fixed[board]
+                else:
+                    first_won = rng.random() < win_probability(ratings[p1],
+                            ratings[p2])
+                outcome.append(first_won)
+                winner, loser = (p1, p2) if first_won else (p2, p1)
+                scores[winner] += 1
+                losses[loser] += 1
+            while True:
+                alive = [p for p in range(num) if losses[p] < self.lives]
+                if len(alive) < 2:
+                    break
+                alive.sort(key=lambda p: (losses[p], p))
+                if len(alive) % 2 == 1:
+                    scores[alive.pop()] += 1
+                for p1, p2 in zip(alive[0::2], alive[1::2]):
+                    if rng.random() < win_probability(ratings[p1],
+                            ratings[p2]):
+                        winner, loser = p1, p2
+                    else:
+                        winner, loser = p2, p1
+                    scores[winner] += 1
+                    losses[loser] += 1
+            places = [0] * num
+            for place, p in enumerate(sorted(range(num),
+                    key=lambda p: (-scores[p], p))):
+                places[p] = place
+            all_outcomes.append(tuple(outcome))
+            all_places.append(tuple(places))
+        return all_outcomes, all_places
+
+    def _play_exact(self, count, fixed):
+        rng = self.random
+        num = len(self.players)
+        all_outcomes = list()
+        all_places = list()
+        for _ in range(count):
+            tourn = self.tourn.copy()
+            outcome = list()
+            def play(p1, p2, first_won):
+                winner = p1 if first_won else p2
+                game = (p1, p2, ("winner", winner))
+                tourn.games.append(game)
+                tourn.apply_event(("game", game))
+                tourn.events = tourn.events + (("game", game),)
+            for board, (p1, p2) in enumerate(self.boards):
+                if board in fixed:
+                    first_won = fixed[board]
+                else:
+                    first_won = rng.random() < win_probability(
+                            self.ratings[p1], self.ratings[p2])
+                outcome.append(first_won)
+                play(self.players[p1], self.players[p2], first_won)
+            while True:
+                pairings, bye = self.pair_func(tourn.copy())
+                if not pairings:
+                    break
+                if bye is not None:
+                    tourn.apply_event(("bye", (bye, None)))
+                    tourn.events = tourn.events + (("bye", (bye, None)),)
+                for p1, p2 in pairings:
+                    play(p1, p2, rng.random() < win_probability(
+                        self.ratings[self.index[p1]],
+                        self.ratings[self.index[p2]]))
+            scores = [tourn.wins[p] + tourn.byes[p] for p in self.players]
+            places = [0] * num
+            for place, p in enumerate(sorted(range(num),
+                    key=lambda p: (-scores[p], p))):
+                places[p] = place
+            all_outcomes.append(tuple(outcome))
+            all_places.append(tuple(places))
+        if numpy is not None:
+            return (numpy.array(all_outcomes, dtype=bool).reshape(
+                (count, len(self.boards))), numpy.array(all_places))
+        return all_outcomes, all_places
+
+    def probabilities(self):
+        num = len(self.players)
+        if numpy is not None:
+            counts = numpy.zeros((num, num))
+            for ix in range(num):
+                counts[ix] = numpy.bincount(self.places[:, ix],
+                        minlength=num)
+            counts /= len(self.places)
+            return {p: list(counts[ix]) for ix, p in enumerate(self.players)}
+        counts = [[0] * num for _ in range(num)]
+        for places in self.places:
+            for ix, place in enumerate(places):
+                counts[ix][place] += 1
+        total = float(len(self.places))
+        return {p: [c / total for c in counts[ix]]
+                for ix, p in enumerate(self.players)}
+
+def print_forecast(probabilities, places=3):
+    """ Print each player's chance of the first few places, best first """
+    players = sorted(probabilities, key=lambda p: [-c
+        for c in probabilities[p]])
+    print "# forecast", " ".join("p%d" % (place,)
+            for place in range(1, places + 1))
+    for p in players:
+        print "#", p, " ".join("%.3f" % (c,)
+                for c in probabilities[p][:places])
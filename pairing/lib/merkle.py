@@ -0,0 +1,108 @@
+
+""" Chunked Merkle digest of an event log
+
+Each event is hashed on its own and every CHUNK events are hashed together
+into a chunk. Chunks are the leaves of a binary tree stored level by level,
+a node covering the two aligned blocks below it. Appending an event only
+adds the nodes it completes, so it takes O(log n).
+
+The digest of the first k events combines the largest aligned blocks that
+make up the prefix with the hashes of the events in the last partial chunk,
+which makes the digest of any prefix available without rehashing. Two logs
+can be compared block by block from the top to find the first event where
+they differ.
+"""
+
+import hashlib
+
+CHUNK = 64
+
+def event_hash(event):
+    return hashlib.sha256(repr(event)).digest()
+
+def _node(left, right):
+    return hashlib.sha256(left + right).digest()
+
+class EventDigest(object):
+    def __init__(self, events=()):
+        self.leaves = list()
+        # levels[0] holds chunk hashes, levels[i] blocks of CHUNK << i events
+        self.levels = list()
+        for event in events:
+            self.append(event)
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def append(self, event):
+        self.leaves.append(event_hash(event))
+        if len(self.leaves) % CHUNK != 0:
+            return
+        node = hashlib.sha256("".join(self.leaves[-CHUNK:])).digest()
+        level = 0
+        while True:
+            if level == len(self.levels):
+                self.levels.append(list())
+            nodes = self.levels[level]
+            nodes.append(node)
+            if len(nodes) % 2 != 0:
+                break
+            node = _node(nodes[-2], nodes[-1])
+            level += 1
+
+    def extend(self, events):
+        for event in events:
+            self.append(event)
+
+    def truncate(self, count):
+        """ Drop every event after the first count """
+        del self.leaves[count:]
+        chunks = count // CHUNK
+        for level, nodes in enumerate(self.levels):
+            del nodes[chunks >> level:]
+        while self.levels and not self.levels[-1]:
+            self.levels.pop()
+
+    def prefix(self, count=None):
+        """ Hex digest of the first count events, all of them by default """
+        if count is None:
+            count = len(self.leaves)
+        if not 0 <= count <= len(self.leaves):
+            raise ValueError("No prefix of %d events in a log of %d" % (
+                count, len(self.leaves)))
+        digest = hashlib.sha256("%d\n" % (count,))
+        chunks = count // CHUNK
+        start = 0
+        for level in reversed(range(len(self.levels))):
+            if chunks & (1 << level):
+                digest.update(self.levels[level][start >> level])
+                start += 1 << level
+        digest.update("".join(self.leaves[chunks * CHUNK:count]))
+        return digest.hexdigest()
+
+    def first_difference(self, other):
+        """ Index of the first event that differs from other's log
+
+        An event missing from the shorter log counts as a difference,
+        returns None if both logs are the same.
+        """
+        pos = 0
+        for level in reversed(range(min(len(self.levels), len(other.levels)))):
+            size = CHUNK << level
+            ours = self.levels[level]
+            theirs = other.levels[level]
+            while (pos // size < min(len(ours), len(theirs))
+                    and ours[pos // size] == theirs[pos // size]):
+                pos += size
+        end = min(len(self.leaves), len(other.leaves))
+        while pos < end and self.leaves[pos] == other.leaves[pos]:
+            pos += 1
+        if pos == len(self.leaves) == len(other.leaves):
+            return None
+        return pos
+
+    def copy(self):
+        other = EventDigest()
+        other.leaves = list(self.leaves)
+        other.levels = [list(nodes) for nodes in self.levels]
+        return other
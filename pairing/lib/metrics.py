@@ -0,0 +1,176 @@
+
+""" Record what pairing a round cost, for trends over field size
+
+While a recording is open the pairing code adds to its metrics:
+
+    players: players given to the matching
+    edges: edges of the matching graph, 0 when the pairing followed from
+        the seeds without one
+    weight_bits: bit length of the largest edge weight
+    matching_stages, matching_substages: work done by maxWeightMatching
+    rating_iterations: iterations of every rate() call
+    phases: seconds spent in each timing phase
+    seconds: seconds for the whole round
+    peak_memory_kb: the process's peak resident size so far
+    cached: whether the result came from --cache-dir
+
+Each recording is appended as a JSON line, or written as a Prometheus
+textfile, which holds the gauges of the last round only and is replaced
+atomically as node_exporter expects. Outside a recording the calls cost a
+global lookup and a test.
+"""
+
+import json
+import math
+import os
+import resource
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import timing
+
+_record = None
+
+def enabled():
+    return _record is not None
+
+def add(name, value):
+    """ Add value to the metric name of the open recording """
+    if _record is not None:
+        _record[name] = _record.get(name, 0) + value
+
+def peak(name, value):
+    """ Keep the largest value of the metric name """
+    if _record is not None:
+        _record[name] = max(_record.get(name, value), value)
+
+def note(name, value):
+    if _record is not None:
+        _record[name] = value
+
+def last_round(events):
+    """ Number of the last round line in events, None without one """
+    for etype, info in reversed(events):
+        if etype == "round":
+            return info
+    return None
+
+@contextmanager
+def recording(path, fmt=None, **labels):
+    """ Record the metrics of the block and write them to path
+
+    labels, such as the script and round, are stored with the metrics. fmt
+    is "jsonl" or "prometheus", by default prometheus for a .prom path. With
+    no path nothing is recorded.
+    """
+    global _record
+    if path is None:
+        yield
+        return
+    record = dict(labels, time=time.time())
+    timer = timing.current()
+    own_timer = timer is None
+    if own_timer:
+        timer = timing.start()
+    before = dict(timer.seconds)
+    started = timing.clock()
+    _record = record
+    try:
+        yield
+    finally:
+        _record = None
+        record["seconds"] = timing.clock() - started
+        record["phases"] = {name: seconds - before.get(name, 0.0)
+                for name, seconds in timer.seconds.items()
+                if seconds != before.get(name, 0.0)}
+        if own_timer:
+            timing.stop()
+        record["peak_memory_kb"] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+    write_metrics(path, record, fmt)
+
+def write_metrics(path, record, fmt=None):
+    if fmt is None:
+        fmt = "prometheus" if path.endswith(".prom") else "jsonl"
+    if fmt == "jsonl":
+        # one write of a whole line, so worker processes can share the file
+        with open(path, "a") as metrics_file:
+            metrics_file.write(json.dumps(record, sort_keys=True) + "\n")
+    elif fmt == "prometheus":
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "w") as metrics_file:
+            metrics_file.write(prometheus_text(record))
+        os.rename(tmp_path, path)
+    else:
+        raise ValueError("Unknown metrics format %s" % (fmt,))
+
+def prometheus_text(record):
+    """ The numeric metrics of record as Prometheus gauges """
+    labels = '{script="%s"}' % (record.get("script"),)
+    lines = list()
+    for name in sorted(record):
+        value = record[name]
+        if name == "time":
+            # the textfile collector reports the file's mtime already
+            continue
+        if name == "phases":
+            lines.append("# TYPE pairing_phase_seconds gauge")
+            for phase_name in sorted(value):
+                lines.append('pairing_phase_seconds{script="%s",phase="%s"} '
+                        '%r' % (record.get("script"), phase_name,
+                            value[phase_name]))
+        elif isinstance(value, (bool, int, long, float)):
+            lines.append("# TYPE pairing_%s gauge" % (name,))
+            lines.append("pairing_%s%s %r" % (name, labels, float(value)))
+    return "\n".join(lines) + "\n"
+
+def read_metrics(lines):
+    return [json.loads(line) for line in lines if line.strip()]
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of values """
+    values = sorted(values)
+    rank = max(int(math.ceil(fraction * len(values))), 1)
+    return values[rank - 1]
+
+REPORT_METRICS = ("seconds", "matching", "edges", "weight_bits",
+        "matching_stages", "rating_iterations", "peak_memory_kb")
+
+def summarize_metrics(records, bucket=16, fractions=(0.5, 0.9, 0.99)):
+    """ Percentiles of each metric for field sizes grouped by bucket
+
+    Records without a matching, like cache hits, are left out. Returns a
+    list of ((low, high), count, {metric: [percentile per fraction]}) in
+    order of field size.
+    """
+    groups = defaultdict(list)
+    for record in records:
+        if "players" in record:
+            low = (max(record["players"], 1) - 1) // bucket * bucket + 1
+            groups[(low, low + bucket - 1)].append(record)
+    summary = list()
+    for sizes in sorted(groups):
+        group = groups[sizes]
+        stats = dict()
+        for name in REPORT_METRICS:
+            if name == "matching":
+                values = [r["phases"].get("matching", 0.0) for r in group]
+            else:
+                values = [r[name] for r in group if name in r]
+            if values:
+                stats[name] = [percentile(values, f) for f in fractions]
+        summary.append((sizes, len(group), stats))
+    return summary
+
+def print_report(summary, fractions=(0.5, 0.9, 0.99)):
+    print "%-9s %5s  %-18s" % ("# players", "runs", "metric"),
+    print " ".join("%12s" % ("p%g" % (f * 100,)) for f in fractions)
+    for (low, high), count, stats in summary:
+        for name in REPORT_METRICS:
+            if name not in stats:
+                continue
+            print "%4d-%-4d %5d  %-18s" % (low, high, count, name),
+            print " ".join("%12.6g" % (v,) for v in stats[name])
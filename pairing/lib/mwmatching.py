@@ -19,6 +19,10 @@ http://jorisvr.nl/maximummatching.html
 #
 # Changes:
 #
+# 2026-10-19
+#   * Added optional output of the final dual solution.
+#   * Added optional output of the number of stages and substages.
+#
 # 2013-04-07
 #   * Added Python 3 compatibility with contributions from Daniel Saunders.
 #
@@ -43,11 +47,21 @@ CHECK_DELTA = False
 CHECK_OPTIMUM = True
 
 
-def maxWeightMatching(edges, maxcardinality=False):
+def maxWeightMatching(edges, maxcardinality=False, duals=None, stats=None):
     """Compute a maximum-weighted matching in the general undirected
     weighted graph given by "edges".  If "maxcardinality" is true,
     only maximum-cardinality matchings are considered as solutions.
 
+    If "duals" is a dict it is filled with the final dual solution,
+    duals["vertex"][i] is twice the dual variable of vertex i and
+    duals["blossoms"] is a list of (z, leaves) for every blossom with a
+    positive dual variable z, leaves being a frozenset of its vertices.  Twice the slack of edge (i, j, wt) is then
+    vertex[i] + vertex[j] - 2 * wt plus 2 * z for each blossom containing
+    both i and j.
+
+    If "stats" is a dict, stats["stages"] and stats["substages"] are set
+    to the number of stages and substages the algorithm ran.
+
     Edges is a sequence of tuples (i, j, wt) describing an undirected
     edge between vertex i and vertex j with weight wt.  There is at most
     one edge between any two vertices; no vertex has an edge to itself.
@@ -79,6 +93,8 @@ def maxWeightMatching(edges, maxcardinality=False):
 
     # Deal swiftly with empty graphs.
     if not edges:
+        if stats is not None:
+            stats["stages"] = stats["substages"] = 0
         return [ ]
 
     # Count vertices.
@@ -628,8 +644,11 @@ def maxWeightMatching(edges, maxcardinality=False):
             DEBUG('bk=%d tbk=%d bd=%s tbd=%s' % (bk, tbk, repr(bd), repr(tbd)))
         assert bd == tbd
 
+    stages = substages = 0
+
     # Main loop: continue until no further improvement is possible.
     for t in range(nvertex):
+        stages += 1
 
         # Each iteration of this loop is a "stage".
         # A stage finds an augmenting path and uses that to improve
@@ -666,6 +685,7 @@ def maxWeightMatching(edges, maxcardinality=False):
             # primal-dual method is used to pump some slack out of
             # the dual variables.
             if DEBUG: DEBUG('SUBSTAGE')
+            substages += 1
 
             # Continue labeling until all vertices which are reachable
             # through an alternating path have got a label.
@@ -849,6 +869,16 @@ def maxWeightMatching(edges, maxcardinality=False):
     if CHECK_OPTIMUM:
         verifyOptimum()
 
+    if stats is not None:
+        stats["stages"] = stages
+        stats["substages"] = substages
+
+    if duals is not None:
+        duals["vertex"] = dualvar[:nvertex]
+        duals["blossoms"] = [ (dualvar[b], frozenset(blossomLeaves(b)))
+                              for b in range(nvertex, 2*nvertex)
+                              if blossombase[b] >= 0 and dualvar[b] > 0 ]
+
     # Transform mate[] such that mate[v] is the vertex to which v is paired.
     for v in range(nvertex):
         if mate[v] >= 0:
@@ -1,147 +1,733 @@
 
+import array
+import bz2
+import copy
+import cStringIO
+import gzip
 import hashlib
+import io
 import math
+import pickle
 import sys
-from collections import Counter, defaultdict
+import time
+from collections import Counter, OrderedDict, defaultdict
+from itertools import izip, product
+from multiprocessing import Pool, cpu_count
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+import metrics
+from merkle import EventDigest
 from mwmatching import maxWeightMatching
+from timing import phase, timed
 
 class Tournament(object):
     def __init__(self):
         self.events = tuple()
         self.players = frozenset()
         self.seeds = dict()
-        self.games = tuple()
+        self.games = GameTable()
         self.byes = Counter()
         self.rounds = None
+        self.forced = tuple()
+        self.excluded = frozenset()
+        self.solution = None
+        self.rating_cache = dict()
+        self._event_digest = None
+        self.views = dict()
+        self.reset_stats()
 
-    def update_stats(tourn):
+    @property
+    def event_digest(tourn):
+        """ The EventDigest of the events, built on first use
+
+        It's kept with the events tuple it was built for and rebuilt if the
+        events are replaced by anything other than build_tournament.
+        """
+        cached = tourn._event_digest
+        if cached is None or cached[0] is not tourn.events:
+            tourn._event_digest = (tourn.events, EventDigest(tourn.events))
+        return tourn._event_digest[1]
+
+    def state_digest(tourn, round_num=None):
+        """ Digest of the events up to the end of round round_num
+
+        That's every event before the round directive starting the next
+        round, or all the events when round_num isn't given.
+        """
+        if round_num is None:
+            return tourn.event_digest.prefix()
+        for ix, (etype, info) in enumerate(tourn.events):
+            if etype == "round" and info == round_num + 1:
+                return tourn.event_digest.prefix(ix)
+        raise ValueError("Round %d has not finished" % (round_num,))
+
+    @property
+    def adjacency(tourn):
+        """ The Adjacency index of the games, built on first use """
+        if tourn._adjacency is None:
+            tourn._adjacency = Adjacency(tourn.games)
+        return tourn._adjacency
+
+    def reset_stats(tourn):
+        tourn.rating_cache = dict()
+        tourn._adjacency = None
         tourn.played = Counter()
         tourn.wins = Counter()
         tourn.draws = Counter()
         tourn.losses = Counter()
         tourn.pair_counts = Counter()
-        for g in tourn.games:
-            if g[2][0] == "winner":
-                if g[2][1] != g[0]:
-                    tourn.losses[g[0]] += 1
-                if g[2][1] != g[1]:
-                    tourn.losses[g[1]] += 1
-                tourn.wins[g[2][1]] += 1
-            elif g[2][0] == "draw":
-                tourn.draws[g[0]] += 1
-                tourn.draws[g[1]] += 1
-            elif g[2][0] == "double win":
-                tourn.wins[g[0]] += 1
-                tourn.wins[g[1]] += 1
-            elif g[2][0] == "double loss":
-                tourn.losses[g[0]] += 1
-                tourn.losses[g[1]] += 1
-            if g[2][0] != "vacated":
-                pset = frozenset(g[:2])
-                tourn.pair_counts[pset] += 1
-            tourn.played[g[0]] += 1
-            tourn.played[g[1]] += 1
+
+    @timed("update_stats")
+    def update_stats(tourn):
+        """ Rebuild the stats from the games
+
+        The games are counted by player id over the columns of a GameTable
+        and only turned back into Counters keyed by name at the end.
+        """
+        tourn.reset_stats()
+        games = tourn.games
+        if not isinstance(games, GameTable):
+            games = GameTable(games)
+        names = games.names
+        played, wins, draws, losses, pairs = games.counts()
+        for counter, counts in ((tourn.played, played), (tourn.wins, wins),
+                (tourn.draws, draws), (tourn.losses, losses)):
+            counter.update({names[pid]: n for pid, n in enumerate(counts)
+                if n})
+        tourn.pair_counts.update({frozenset((names[a], names[b])): n
+            for (a, b), n in pairs.items()})
         return tourn
 
-def from_eventlist(events):
-    players = set()
-    seeds = dict()
-    games = list()
-    byes = Counter()
-    cur_round = [0]
-    def player_event(event_num, info):
+    def copy(tourn):
+        """ A shallow copy with its own stats, so events can be applied to it
+        without changing this Tournament
+        """
+        other = copy.copy(tourn)
+        if isinstance(tourn.games, GameTable):
+            other.games = tourn.games + ()
+        other.byes = Counter(tourn.byes)
+        other.played = Counter(tourn.played)
+        other.wins = Counter(tourn.wins)
+        other.draws = Counter(tourn.draws)
+        other.losses = Counter(tourn.losses)
+        other.pair_counts = Counter(tourn.pair_counts)
+        if tourn._adjacency is not None:
+            other._adjacency = tourn._adjacency.copy()
+        if tourn._event_digest is not None:
+            other._event_digest = (tourn._event_digest[0],
+                    tourn._event_digest[1].copy())
+        other.rating_cache = dict()
+        other.views = dict()
+        other.solution = None
+        return other
+
+    def working_copy(tourn):
+        """ A shallow copy to pair from that shares the ratings cached on
+        this Tournament and its views, while players filtered out of it or
+        its views stay filtered in the copy only
+        """
+        other = copy.copy(tourn)
+        other.views = {key: copy.copy(view)
+                for key, view in tourn.views.items()}
+        return other
+
+    def apply_event(tourn, event, sign=1):
+        """ Update the stats and byes for one game or bye event
+
+        A sign of -1 removes an event applied earlier. Other event types
+        don't change the stats, and the events and games tuples are left
+        for the caller to keep. Added games extend the adjacency index if
+        it has been built, removing one drops the index to be rebuilt from
+        the games when next used.
+        """
+        etype, info = event
+        if etype == "bye":
+            _count(tourn.byes, info[0], sign)
+        elif etype == "game":
+            p1, p2, result = info
+            if result[0] == "winner":
+                if result[1] != p1:
+                    _count(tourn.losses, p1, sign)
+                if result[1] != p2:
+                    _count(tourn.losses, p2, sign)
+                _count(tourn.wins, result[1], sign)
+            elif result[0] == "draw":
+                _count(tourn.draws, p1, sign)
+                _count(tourn.draws, p2, sign)
+            elif result[0] == "double win":
+                _count(tourn.wins, p1, sign)
+                _count(tourn.wins, p2, sign)
+            elif result[0] == "double loss":
+                _count(tourn.losses, p1, sign)
+                _count(tourn.losses, p2, sign)
+            if result[0] != "vacated":
+                _count(tourn.pair_counts, frozenset((p1, p2)), sign)
+            _count(tourn.played, p1, sign)
+            _count(tourn.played, p2, sign)
+            if tourn._adjacency is not None:
+                if sign > 0:
+                    tourn._adjacency.add_game(info)
+                else:
+                    tourn._adjacency = None
+        else:
+            return
+        if tourn.rating_cache:
+            tourn.rating_cache = dict()
+        if tourn.views:
+            tourn.views = dict()
+
+    def revert_event(tourn, event):
+        tourn.apply_event(event, -1)
+
+    def undo_event(tourn, event):
+        """ Take back the latest event applied
+
+        Unlike revert_event this keeps the adjacency index, as the game is
+        the latest one of both of its players.
+        """
+        adjacency = tourn._adjacency
+        tourn._adjacency = None
+        tourn.apply_event(event, -1)
+        if adjacency is not None and event[0] == "game":
+            adjacency.remove_last_game(event[1])
+        tourn._adjacency = adjacency
+
+    def correct_game(tourn, old, new):
+        """ Replace the stats of game old with those of game new """
+        tourn.revert_event(("game", old))
+        tourn.apply_event(("game", new))
+
+GOLD, SILVER = 0, 1
+
+class Adjacency(object):
+    """ Opponents and colour history of each player
+
+    opponents maps each player to a Counter of the games played against
+    each opponent and gold to the games of those the player had gold in,
+    so every query only touches a player's own opponents. colors holds the
+    colours each player played in order, streak their current (colour,
+    length) run and last_gold the player with gold in the latest game of
+    each pair. Vacated games are left out as they were never played.
+    """
+    def __init__(self, games=()):
+        self.opponents = defaultdict(Counter)
+        self.gold = defaultdict(Counter)
+        self.extra_gold = Counter()
+        self.colors = defaultdict(list)
+        self.streak = dict()
+        self.last_gold = dict()
+        self.pair_golds = defaultdict(list)
+        for game in games:
+            self.add_game(game)
+
+    def add_game(self, game):
+        p1, p2, result = game
+        if result[0] == "vacated":
+            return
+        self.opponents[p1][p2] += 1
+        self.opponents[p2][p1] += 1
+        self.gold[p1][p2] += 1
+        self.extra_gold[p1] += 1
+        self.extra_gold[p2] -= 1
+        for player, color in ((p1, GOLD), (p2, SILVER)):
+            self.colors[player].append(color)
+            last, length = self.streak.get(player, (color, 0))
+            self.streak[player] = (color, length + 1 if last == color else 1)
+        self.last_gold[frozenset((p1, p2))] = p1
+        self.pair_golds[frozenset((p1, p2))].append(p1)
+
+    def remove_last_game(self, game):
+        """ Take back a game that is the latest one of both its players """
+        p1, p2, result = game
+        if result[0] == "vacated":
+            return
+        _count(self.opponents[p1], p2, -1)
+        _count(self.opponents[p2], p1, -1)
+        _count(self.gold[p1], p2, -1)
+        _count(self.extra_gold, p1, -1)
+        _count(self.extra_gold, p2, 1)
+        for player in (p1, p2):
+            colors = self.colors[player]
+            colors.pop()
+            if not colors:
+                del self.streak[player]
+                continue
+            length = 1
+            while length < len(colors) and colors[-length - 1] == colors[-1]:
+                length += 1
+            self.streak[player] = (colors[-1], length)
+        pset = frozenset((p1, p2))
+        golds = self.pair_golds[pset]
+        golds.pop()
+        if golds:
+            self.last_gold[pset] = golds[-1]
+        else:
+            del self.last_gold[pset]
+            del self.pair_golds[pset]
+
+    def gold_count(self, player, opponent):
+        """ Games player had gold in against opponent """
+        gold = self.gold.get(player)
+        return gold[opponent] if gold else 0
+
+    def streaks(self, player):
+        """ The player's current gold and silver streak lengths """
+        color, length = self.streak.get(player, (GOLD, 0))
+        if color == GOLD:
+            return length, 0
+        return 0, length
+
+    def copy(self):
+        other = Adjacency()
+        other.opponents.update((p, Counter(c))
+                for p, c in self.opponents.items())
+        other.gold.update((p, Counter(c)) for p, c in self.gold.items())
+        other.extra_gold = Counter(self.extra_gold)
+        other.colors.update((p, list(c)) for p, c in self.colors.items())
+        other.streak = dict(self.streak)
+        other.last_gold = dict(self.last_gold)
+        other.pair_golds.update((p, list(g)) for p, g in self.pair_golds.items())
+        return other
+
+def _count(counter, key, delta):
+    """ Add delta to a Counter entry, dropping it when it reaches zero """
+    value = counter[key] + delta
+    if value:
+        counter[key] = value
+    else:
+        del counter[key]
+
+GAME_RESULTS = ("draw", "double win", "double loss", "no decision", "vacated")
+# games are stored with a result code, 0 and 1 name the winning player
+RESULT_CODES = {result: code for code, result in enumerate(GAME_RESULTS, 2)}
+RESULTS = {code: (result,) for result, code in RESULT_CODES.items()}
+
+class GameTable(object):
+    """ Games stored as parallel arrays of interned player ids
+
+    Player names are given dense integer ids in the order they're first
+    seen, each game is then an entry in the p1, p2 and result columns. The
+    table behaves like the tuple of (p1, p2, result) games it replaces,
+    names and result tuples are only built when a game is read.
+
+    Only the games are kept as columns. The per-player stats of a
+    Tournament stay Counters keyed by name, which is how every scale reads
+    them, and counts() is only used to rebuild them.
+    """
+    __slots__ = ("names", "ids", "p1", "p2", "result")
+
+    def __init__(self, games=()):
+        self.names = list()
+        self.ids = dict()
+        self.p1 = array.array("i")
+        self.p2 = array.array("i")
+        self.result = array.array("b")
+        self.extend(games)
+
+    def intern(self, player):
+        pid = self.ids.get(player)
+        if pid is None:
+            pid = self.ids[player] = len(self.names)
+            self.names.append(player)
+        return pid
+
+    def append(self, game):
+        p1, p2, result = game
+        if result[0] == "winner":
+            code = 0 if result[1] == p1 else 1
+        else:
+            code = RESULT_CODES[result[0]]
+        self.p1.append(self.intern(p1))
+        self.p2.append(self.intern(p2))
+        self.result.append(code)
+
+    def extend(self, games):
+        for game in games:
+            self.append(game)
+
+    def truncate(self, count):
+        """ Drop every game after the first count """
+        del self.p1[count:]
+        del self.p2[count:]
+        del self.result[count:]
+
+    def _game(self, ix):
+        p1 = self.names[self.p1[ix]]
+        p2 = self.names[self.p2[ix]]
+        code = self.result[ix]
+        if code < 2:
+            return (p1, p2, ("winner", (p1, p2)[code]))
+        return (p1, p2, RESULTS[code])
+
+    def __len__(self):
+        return len(self.result)
+
+    def __iter__(self):
+        return (self._game(ix) for ix in xrange(len(self.result)))
+
+    def __getitem__(self, ix):
+        if isinstance(ix, slice):
+            return tuple(self._game(i) for i in xrange(*ix.indices(len(self))))
+        if ix < 0:
+            ix += len(self)
+        if not 0 <= ix < len(self):
+            raise IndexError("game index out of range")
+        return self._game(ix)
+
+    def __add__(self, games):
+        table = GameTable()
+        table.names = list(self.names)
+        table.ids = dict(self.ids)
+        table.p1 = array.array("i", self.p1)
+        table.p2 = array.array("i", self.p2)
+        table.result = array.array("b", self.result)
+        table.extend(games)
+        return table
+
+    def __eq__(self, other):
+        if isinstance(other, (GameTable, tuple, list)):
+            return len(self) == len(other) and all(
+                    a == b for a, b in izip(self, other))
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "GameTable(%r)" % (tuple(self),)
+
+    def __getstate__(self):
+        return (self.names, self.p1.tostring(), self.p2.tostring(),
+                self.result.tostring())
+
+    def __setstate__(self, state):
+        names, p1, p2, result = state
+        self.names = list(names)
+        self.ids = {name: pid for pid, name in enumerate(names)}
+        self.p1 = array.array("i")
+        self.p1.fromstring(p1)
+        self.p2 = array.array("i")
+        self.p2.fromstring(p2)
+        self.result = array.array("b")
+        self.result.fromstring(result)
+
+    def counts(self):
+        """ Games played, won, drawn and lost indexed by player id, and the
+        number of games between each pair of ids not counting vacated ones
+        """
+        size = len(self.names)
+        played = [0] * size
+        wins = [0] * size
+        draws = [0] * size
+        losses = [0] * size
+        pairs = defaultdict(int)
+        draw, double_win, double_loss, vacated = (RESULT_CODES[r] for r in (
+            "draw", "double win", "double loss", "vacated"))
+        for a, b, code in izip(self.p1, self.p2, self.result):
+            played[a] += 1
+            played[b] += 1
+            if code == 0:
+                wins[a] += 1
+                losses[b] += 1
+            elif code == 1:
+                wins[b] += 1
+                losses[a] += 1
+            elif code == draw:
+                draws[a] += 1
+                draws[b] += 1
+            elif code == double_win:
+                wins[a] += 1
+                wins[b] += 1
+            elif code == double_loss:
+                losses[a] += 1
+                losses[b] += 1
+            if code != vacated:
+                pairs[(a, b) if a < b else (b, a)] += 1
+        return played, wins, draws, losses, pairs
+
+class EventState(object):
+    """ Running player state needed to validate a stream of events
+
+    Only the active players, seeds, current round and pending pairing
+    constraints are kept, not the events themselves. position is set by the
+    caller to describe where the next event came from in error messages.
+    """
+    handlers = {
+            "seed": "seed_event",
+            "remove": "remove_event",
+            "add": "add_event",
+            "bye": "bye_event",
+            "game": "game_event",
+            "force": "force_event",
+            "exclude": "exclude_event",
+            "round": "round_event",
+            }
+
+    def __init__(self):
+        self.players = set()
+        self.seeds = dict()
+        self.round = 0
+        self.forced = list()
+        self.excluded = set()
+        self.position = ("event", 0)
+
+    def where(self):
+        return "%s %d" % self.position
+
+    def apply(self, event):
+        """ Validate an event against the current state and apply it """
+        try:
+            handler = self.handlers[event[0]]
+        except KeyError:
+            raise ValueError("Unrecognized event type %s at %s" % (
+                event[0], self.where()))
+        getattr(self, handler)(event[1])
+
+    def seed_event(self, info):
         name, seed = info
-        if name in seeds:
-            raise ValueError(
-                    "Duplicate player entry found for %s at event %d" % (
-                        name, event_num))
-        seeds[name] = seed
-        players.add(name)
-    def remove_event(event_num, info):
+        if name in self.seeds:
+            raise ValueError("Duplicate player entry found for %s at %s" % (
+                name, self.where()))
+        self.seeds[name] = seed
+        self.players.add(name)
+
+    def remove_event(self, info):
         player = info[0]
-        if player not in seeds:
-            raise ValueError("Tried to remove unknown player %s at event %d" % (
-                player, event_num))
-        if player not in players:
+        if player not in self.seeds:
+            raise ValueError("Tried to remove unknown player %s at %s" % (
+                player, self.where()))
+        if player not in self.players:
             raise ValueError(
-                    "Tried to remove already removed player %s at event %d" % (
-                        player, event_num))
-        players.remove(player)
-    def add_event(event_num, info):
-        if info not in seeds:
-            raise ValueError("Tried to re-add unknown player %s at event %d" % (
-                event, event_num))
-        players.add(player)
-    def bye_event(event_num, info):
-        player, result = info
-        if player not in seeds:
-            raise ValueError("Gave bye to unknown player %s at line %d" % (
-                line, line_num))
-        if player not in players:
-            raise ValueError("Gave bye to removed player %s at line %d" % (
-                line, line_num))
-        byes[player] += 1
-    def game_event(event_num, info):
+                    "Tried to remove already removed player %s at %s" % (
+                        player, self.where()))
+        self.players.remove(player)
+
+    def add_event(self, info):
+        player = info[0]
+        if player not in self.seeds:
+            raise ValueError("Tried to re-add unknown player %s at %s" % (
+                player, self.where()))
+        self.players.add(player)
+
+    def bye_event(self, info):
+        player = info[0]
+        if player not in self.seeds:
+            raise ValueError("Gave bye to unknown player %s at %s" % (
+                player, self.where()))
+        if player not in self.players:
+            raise ValueError("Gave bye to removed player %s at %s" % (
+                player, self.where()))
+
+    def game_event(self, info):
         p1, p2, result = info
-        if p1 not in seeds:
-            raise ValueError("Unknown player 1 '%s' in game at event %d" % (
-                p1, event_num))
-        if p1 not in players:
-            raise ValueError("Removed player '%s' in game at event %d" % (
-                p1, event_num))
-        if p2 not in seeds:
-            raise ValueError("Unknown player 2 '%s' in game at event %d" % (
-                p2, event_num))
-        if p2 not in players:
-            raise ValueError("Removed player '%s' in game at event %d" % (
-                p2, event_num))
+        if p1 not in self.seeds:
+            raise ValueError("Unknown player 1 '%s' in game at %s" % (
+                p1, self.where()))
+        if p1 not in self.players:
+            raise ValueError("Removed player '%s' in game at %s" % (
+                p1, self.where()))
+        if p2 not in self.seeds:
+            raise ValueError("Unknown player 2 '%s' in game at %s" % (
+                p2, self.where()))
+        if p2 not in self.players:
+            raise ValueError("Removed player '%s' in game at %s" % (
+                p2, self.where()))
         if result[0] == "winner":
-            winner = result[1]
-            if winner not in (p1, p2):
+            if result[1] not in (p1, p2):
                 raise ValueError(
-                        "Recorded winner %s not a player in game at event %d" % (
-                            winner, event_num))
-            games.append(info)
-        elif result[0] in ("draw", "double win", "double loss", "no decision",
-                "vacated"):
-            games.append(info)
-        else:
-            raise ValueError("Unrecognized result %s for game at event %d" % (
-                result, event_num))
-    def round_event(event_num, info):
-        cur_round[0] = info
-    type_handlers = {
-            "seed": player_event,
-            "remove": remove_event,
-            "add": add_event,
-            "bye": bye_event,
-            "game": game_event,
-            "round": round_event,
-            }
-    for event_num, (event, info) in enumerate(events):
-        try:
-            type_handlers[event](event_num, info)
-        except KeyError:
-            raise ValueError("Unrecognized event type %s at event %d" % (
-                event, event_num))
-    tourn = Tournament()
-    tourn.events = tuple(events)
-    tourn.players = frozenset(players)
-    tourn.seeds = seeds
-    tourn.games = tuple(games)
-    tourn.byes = byes
-    if cur_round[0] != 0:
-        tourn.rounds = cur_round[0]
-    tourn.update_stats()
+                        "Recorded winner %s not a player in game at %s" % (
+                            result[1], self.where()))
+        elif result[0] not in GAME_RESULTS:
+            raise ValueError("Unrecognized result %s for game at %s" % (
+                result, self.where()))
+        if self.forced:
+            played_forced(self.forced, p1, p2)
+
+    def force_event(self, info):
+        check_constraint(self.seeds, self.players, info, self.where())
+        if any(p in pr for pr in self.forced for p in info):
+            raise ValueError("Player forced into two pairs at %s" % (
+                self.where(),))
+        self.forced.append(info)
+
+    def exclude_event(self, info):
+        check_constraint(self.seeds, self.players, info, self.where())
+        self.excluded.add(frozenset(info))
+
+    def round_event(self, info):
+        if info != self.round + 1:
+            raise ValueError("Out of order round found at %s" % (
+                self.where(),))
+        self.round = info
+        del self.forced[:]
+        self.excluded.clear()
+
+def build_tournament(state, events, tourn=None, views=()):
+    """ Build a Tournament from a stream of events already applied to state
+
+    The events are consumed one at a time so only the event list and the
+    aggregates kept by the Tournament are held in memory. When tourn is
+    given the events are added to it instead of a new Tournament. Each of
+    views, like a LivesFilter, is fed the events in the same pass and the
+    Tournament it builds kept in tourn.views under its key.
+    """
+    if tourn is None:
+        tourn = Tournament()
+    log = None
+    if tourn._event_digest is not None and (
+            tourn._event_digest[0] is tourn.events):
+        log = tourn._event_digest[1]
+    collected = list(tourn.events)
+    games = tourn.games
+    if not isinstance(games, GameTable):
+        games = GameTable(games)
+    for player in state.seeds:
+        games.intern(player)
+    for event in events:
+        collected.append(event)
+        if event[0] == "game":
+            games.append(event[1])
+        tourn.apply_event(event)
+        for view in views:
+            view.apply_event(event)
+        if log is not None:
+            log.append(event)
+    tourn.events = tuple(collected)
+    if log is not None:
+        tourn._event_digest = (tourn.events, log)
+    tourn.players = frozenset(state.players)
+    tourn.seeds = state.seeds
+    tourn.games = games
+    tourn.forced = tuple(state.forced)
+    tourn.excluded = frozenset(state.excluded)
+    if state.round != 0:
+        tourn.rounds = state.round
+    for view in views:
+        tourn.views[view.key] = view.tournament(tourn)
     return tourn
 
+class LivesFilter(object):
+    """ A view of the games without those between eliminated players
+
+    Fed the same events as the full tournament, it counts each player's
+    losses and leaves out games where both players had already used up
+    their lives, keeping the stats of the rest as it goes.
+    """
+    def __init__(self, lives):
+        self.lives = lives
+        self.key = ("lives", lives)
+        self.losses = Counter()
+        self.events = list()
+        self.tourn = Tournament()
+
+    def apply_event(self, event):
+        if event[0] == "game":
+            p1, p2, result = event[1]
+            losses = self.losses
+            lives = self.lives
+            if losses[p1] >= lives and losses[p2] >= lives:
+                return
+            if losses[p1] >= lives or losses[p2] >= lives:
+                raise ValueError(
+                    "Found game between active and eliminated player, %s vs %s"
+                    % (p1, p2))
+            if result[0] == "winner":
+                losses[p2 if result[1] == p1 else p1] += 1
+            elif result[0] == "double loss":
+                losses[p1] += 1
+                losses[p2] += 1
+            self.tourn.games.append(event[1])
+        self.events.append(event)
+        self.tourn.apply_event(event)
+
+    def tournament(self, full):
+        """ The filtered Tournament, with everything but the games and
+        their stats taken from full
+        """
+        tourn = self.tourn
+        tourn.events = tuple(self.events)
+        tourn.players = full.players
+        tourn.seeds = full.seeds
+        tourn.forced = full.forced
+        tourn.excluded = full.excluded
+        tourn.rounds = full.rounds
+        return tourn
+
+def from_eventlist(events):
+    state = EventState()
+    def validated():
+        for event_num, event in enumerate(events):
+            state.position = ("event", event_num)
+            state.apply(event)
+            yield event
+    return build_tournament(state, validated())
+
+def check_constraint(seeds, players, pair, location):
+    """ Validate the two players named in a force or exclude directive """
+    p1, p2 = pair
+    if p1 == p2:
+        raise ValueError("Constraint pairs player %s with itself at %s" % (
+            p1, location))
+    for p in pair:
+        if p not in seeds:
+            raise ValueError("Unknown player '%s' in constraint at %s" % (
+                p, location))
+        if p not in players:
+            raise ValueError("Removed player '%s' in constraint at %s" % (
+                p, location))
+
+def played_forced(forced, p1, p2):
+    """ Drop a forced pair once its game has been recorded """
+    pset = frozenset((p1, p2))
+    forced[:] = [pr for pr in forced if frozenset(pr) != pset]
+
+def iter_lines(data):
+    """ Lines of a string without copying them into a list
+
+    Anything that isn't a string is assumed to already be an iterable of
+    lines and is returned unchanged.
+    """
+    if isinstance(data, unicode):
+        return io.StringIO(data)
+    if isinstance(data, str):
+        return cStringIO.StringIO(data)
+    return data
+
+def open_state(path):
+    """ Open a state, seed or history file for reading its lines
+
+    Files compressed with gzip, bz2 or xz are recognized by their header and
+    decompressed while reading, xz needs the lzma module.
+    """
+    with open(path, "rb") as state_file:
+        magic = state_file.read(6)
+    if magic.startswith("\x1f\x8b"):
+        return gzip.open(path)
+    if magic.startswith("BZh") and magic[3:4].isdigit():
+        return bz2.BZ2File(path)
+    if magic == "\xfd7zXZ\x00":
+        if lzma is None:
+            raise ValueError("Reading xz compressed file %s needs lzma" % (
+                path,))
+        return lzma.open(path)
+    return open(path)
+
+@timed("parse")
 def parse_seeds(seed_data):
     """ Parse aaaa style seed file """
     events = []
     players = []
     seeds = dict()
-    for line_num, line in enumerate(seed_data.splitlines(), start=1):
+    for line_num, line in enumerate(iter_lines(seed_data), start=1):
         line = line.strip()
         if len(line) == 0 or line.startswith("#"):
             continue
@@ -158,15 +744,15 @@ def parse_seeds(seed_data):
     tourn.events = tuple(events)
     tourn.players = frozenset(players)
     tourn.seeds = seeds
-    tourn.update_stats()
     return tourn
 
+@timed("parse")
 def parse_history(tourn, history_data):
     """ Parse aaaa style game history file """
     events = list(tourn.events)
     active = set(tourn.players)
-    games = list()
-    for line_num, line in enumerate(history_data.splitlines(), start=1):
+    games = GameTable(tourn.games)
+    for line_num, line in enumerate(iter_lines(history_data), start=1):
         line = line.strip()
         if len(line) == 0 or line.startswith("#"):
             continue
@@ -191,169 +777,702 @@ def parse_history(tourn, history_data):
                     p2, line_num))
         if len(words) == 2:
             # double forfeit
-            events.append(("game", (p1, p2, ("double loss",))))
-            games.append((p1, p2, ("double loss",)))
+            game = (p1, p2, ("double loss",))
+            events.append(("game", game))
+            games.append(game)
+            tourn.apply_event(("game", game))
             continue
         winner = words[2]
         if winner not in (p1, p2):
             raise ValueError(
                     "Winner (%s) not a player of game in history at line %d" % (
                     winner, line_num))
-        events.append(("game", (p1, p2, ("winner", winner))))
-        games.append((p1, p2, ("winner", winner)))
+        game = (p1, p2, ("winner", winner))
+        events.append(("game", game))
+        games.append(game)
+        tourn.apply_event(("game", game))
     tourn.events = tuple(events)
     tourn.players = frozenset(active)
-    tourn.games = tuple(games)
-    tourn.update_stats()
+    tourn.games = games
     # format doesn't record byes so add games not played as byes
     if tourn.played.most_common(1): # only check if there have been games played
         most_played = tourn.played.most_common(1)[0][1]
         for p in tourn.seeds.keys():
             tourn.byes[p] = most_played - tourn.played[p]
 
-def parse_tournament(tourn_state):
-    events = list()
-    players = set()
-    seeds = dict()
-    games = list()
-    byes = Counter()
-    cur_round = [0]
-    def parse_player(line_num, line):
+class StateParser(object):
+    """ Parse tournament state lines one at a time into validated events
+
+    The parser keeps only the running EventState and the current line
+    number so it can be fed lines from any source, stopped and continued.
+    """
+    line_handlers = {
+            "player": "parse_player",
+            "remove": "parse_remove",
+            "add": "parse_add",
+            "bye": "parse_bye",
+            "game": "parse_game",
+            "pair": "parse_game",
+            "pick": "parse_game",
+            "force": "parse_force",
+            "exclude": "parse_exclude",
+            "round": "parse_round",
+            "section": "parse_section",
+            }
+
+    def __init__(self, state=None):
+        self.state = state if state is not None else EventState()
+        self.line_num = 0
+        self.stopped = False
+
+    def line_event(self, line):
+        """ Parse the next line without validating it
+
+        Returns its event, None for lines without one or "stop" for a stop
+        line.
+        """
+        self.line_num += 1
+        line = line.split("#")[0]
+        line = line.split("*")[0]
+        line = line.strip()
+        if len(line) == 0:
+            return None
+        tokens = line.split(None, 1)
+        if len(tokens) > 1:
+            ltype, lrest = tokens
+        elif tokens[0] == "stop":
+            return "stop"
+        else:
+            raise ValueError("Unrecognized entry at line %d" % (
+                self.line_num,))
+        try:
+            handler = self.line_handlers[ltype.lower()]
+        except KeyError:
+            raise ValueError("Unrecognized line type %s at line %d" % (
+                ltype, self.line_num))
+        return getattr(self, handler)(lrest)
+
+    def parse_line(self, line):
+        """ Parse and apply the next line, returns its event or None """
+        event = self.line_event(line)
+        if event == "stop":
+            self.stopped = True
+            return None
+        if event is not None:
+            if event[0] == "section":
+                raise ValueError(
+                        "Section line at line %d, parse the sections "
+                        "separately" % (self.line_num,))
+            self.state.position = ("line", self.line_num)
+            self.state.apply(event)
+        return event
+
+    def iter_events(self, lines):
+        """ Yield the validated events from lines until a stop line """
+        for line in lines:
+            event = self.parse_line(line)
+            if self.stopped:
+                break
+            if event is not None:
+                yield event
+
+    def parse_player(self, line):
         tokens = line.split()
         if len(tokens) != 2:
-            raise ValueError("Bad player entry at line %d" % (line_num,))
+            raise ValueError("Bad player entry at line %d" % (self.line_num,))
         name, seed = tokens
-        seed = float(seed)
-        if name in seeds:
-            raise ValueError(
-                    "Duplicate player entry found for %s at line %d" % (
-                        name, line_num))
-        events.append(("seed", (name, seed)))
-        seeds[name] = seed
-        players.add(name)
-    def parse_remove(line_num, line):
-        if line not in seeds:
-            raise ValueError("Tried to remove unknown player %s at line %d" % (
-                line, line_num))
-        if line not in players:
-            raise ValueError(
-                    "Tried to remove already removed player %s at line %d" % (
-                        line, line_num))
-        events.append(("remove", (line,)))
-        players.remove(line)
-    def parse_add(line_num, line):
-        if line not in seeds:
-            raise ValueError("Tried to re-add unknown player %s at line %d" % (
-                line, line_num))
-        events.append(("add", (line,)))
-        players.add(line)
-    def parse_bye(line_num, line):
+        return ("seed", (name, float(seed)))
+
+    def parse_remove(self, line):
+        return ("remove", (line,))
+
+    def parse_add(self, line):
+        return ("add", (line,))
+
+    def parse_bye(self, line):
         tokens = line.split()
         if len(tokens) == 2:
             player, result = tokens
         else:
             player, result = line, None
-        if player not in seeds:
-            raise ValueError("Gave bye to unknown player %s at line %d" % (
-                line, line_num))
-        if player not in players:
-            raise ValueError("Gave bye to removed player %s at line %d" % (
-                line, line_num))
-        events.append(("bye", (player, result)))
-        byes[player] += 1
-    def parse_game(line_num, line):
+        return ("bye", (player, result))
+
+    def parse_game(self, line):
         tokens = line.split(None, 2)
         if len(tokens) != 3:
-            raise ValueError("Bad game entry at line %d" % (line_num,))
+            raise ValueError("Bad game entry at line %d" % (self.line_num,))
         p1, p2, result = tokens
-        if p1 not in seeds:
-            raise ValueError("Unknown player 1 '%s' in game at line %d" % (
-                p1, line_num))
-        if p1 not in players:
-            raise ValueError("Removed player '%s' in game at line %d" % (
-                p1, line_num))
-        if p2 not in seeds:
-            raise ValueError("Unknown player 2 '%s' in game at line %d" % (
-                p2, line_num))
-        if p2 not in players:
-            raise ValueError("Removed player '%s' in game at line %d" % (
-                p2, line_num))
         if result.startswith("winner"):
             tokens = result.split(None, 1)
             if len(tokens) != 2:
-                raise ValueError("Bad game result at line %d" % (line_num,))
-            winner = tokens[1]
-            if winner not in (p1, p2):
-                raise ValueError(
-                        "Recorded winner %s not a player in game at line %d" % (
-                            winner, line_num))
-            game = (p1, p2, ("winner", winner))
-            events.append(("game", game))
-            games.append(game)
-        elif result in ("draw", "double win", "double loss", "no decision",
-                "vacated"):
-            game = (p1, p2, (result,))
-            events.append(("game", game))
-            games.append(game)
-        else:
-            raise ValueError("Unrecognized result %s for game at line %d" % (
-                result, line_num))
-    def parse_round(line_num, line):
+                raise ValueError("Bad game result at line %d" % (
+                    self.line_num,))
+            return ("game", (p1, p2, ("winner", tokens[1])))
+        return ("game", (p1, p2, (result,)))
+
+    def parse_force(self, line):
+        tokens = tuple(line.split())
+        if len(tokens) != 2:
+            raise ValueError("Bad force entry at line %d" % (self.line_num,))
+        return ("force", tokens)
+
+    def parse_exclude(self, line):
+        tokens = tuple(line.split())
+        if len(tokens) != 2:
+            raise ValueError("Bad exclude entry at line %d" % (
+                self.line_num,))
+        return ("exclude", tokens)
+
+    def parse_round(self, line):
         try:
             next_round = int(line)
         except ValueError:
-            raise ValueError("Bad round entry at line %d" % (line_num,))
-        if next_round != cur_round[0] + 1:
-            raise ValueError("Out of order round found at line %d" % (line_num,))
-        cur_round[0] = next_round
-        events.append(("round", next_round))
-    type_handlers = {
-            "player": parse_player,
-            "remove": parse_remove,
-            "add": parse_add,
-            "bye": parse_bye,
-            "game": parse_game,
-            "pair": parse_game,
-            "pick": parse_game,
-            "round": parse_round,
-            }
-    for line_num, line in enumerate(tourn_state.splitlines(), start=1):
-        line = line.split("#")[0]
-        line = line.split("*")[0]
-        line = line.strip()
-        if len(line) == 0:
-            continue
-        tokens = line.split(None, 1)
-        if len(tokens) > 1:
-            ltype, lrest = tokens
-        elif tokens[0] == "stop":
+            raise ValueError("Bad round entry at line %d" % (self.line_num,))
+        return ("round", next_round)
+
+    def parse_section(self, line):
+        return ("section", line)
+
+@timed("parse")
+def parse_tournament(tourn_state, views=(), section=None):
+    """ Parse a tournament state
+
+    tourn_state is either the whole state as a string or any iterable of its
+    lines, such as a file from open_state(), which is read one line at a
+    time so the text is never held whole. The Tournament still keeps every
+    event, which views, audits and corrections replay, so memory grows with
+    the number of events. views are built in the same pass, see
+    build_tournament. A state with section lines needs the section to parse
+    given.
+    """
+    if section is not None:
+        sections = parse_sections(tourn_state, views, [section])
+        if section not in sections:
+            raise ValueError("Section %s not found" % (section,))
+        return sections[section]
+    parser = StateParser()
+    return build_tournament(parser.state,
+            parser.iter_events(iter_lines(tourn_state)), views=views)
+
+@timed("parse")
+def parse_sections(tourn_state, views=(), names=None):
+    """ Parse a state split into independent sections
+
+    A section line starts or continues the named section, every line up to
+    the next section line belongs to it. Returns an OrderedDict of the
+    Tournament of each section in the order they first appear. A state
+    without section lines gives a single section named None. Each section
+    gets its own copy of views. With names only those sections are built.
+
+    Sections can be interleaved, so the events of each are collected until
+    the end of the state before its Tournament is built. Memory grows with
+    the number of events, as it does for parse_tournament.
+    """
+    parser = StateParser()
+    sections = OrderedDict()
+    name = None
+    for line in iter_lines(tourn_state):
+        event = parser.line_event(line)
+        if event == "stop":
             break
+        if event is None:
+            continue
+        if event[0] == "section":
+            if None in sections:
+                raise ValueError(
+                        "Found events before the first section line, "
+                        "section at line %d" % (parser.line_num,))
+            name = event[1]
+            if name not in sections:
+                sections[name] = (EventState(), list(),
+                        [copy.deepcopy(view) for view in views])
+            continue
+        if name is None and name not in sections:
+            sections[None] = (EventState(), list(), list(views))
+        if names is not None and name not in names:
+            continue
+        state, events, section_views = sections[name]
+        state.position = ("line", parser.line_num)
+        state.apply(event)
+        events.append(event)
+    if not sections:
+        sections[None] = (EventState(), list(), list(views))
+    return OrderedDict((name, build_tournament(state, events,
+        views=section_views))
+        for name, (state, events, section_views) in sections.items()
+        if names is None or name in names)
+
+def _line_hash(line):
+    return hashlib.sha1(line).digest()
+
+class StateFollower(object):
+    """ Follow a state file, parsing only the lines that changed
+
+    The follower keeps the byte offset it has read up to with a digest of
+    the bytes before it, a hash of every line and the RoundCheckpoints
+    built from the lines' events. When the digest still matches only the
+    appended lines are parsed. Otherwise the line hashes are compared to
+    find the block of lines that changed, and the change is one of
+
+    - "append", the old lines are unchanged and new ones were added
+    - "edit", a block of lines was replaced, its events are corrected
+      through the round checkpoints so only the events from the round
+      before it on are applied again
+    - "structural", anything that can't be replayed that way, like adding
+      or removing a stop line or a later line no longer validating, which
+      parses the whole file again
+
+    change holds the kind of the last update. An update that doesn't
+    validate leaves the follower as it was. Followers can be saved and
+    loaded between runs. Besides the checkpoints the follower keeps every
+    event and a hash of every line, so its memory grows with the file.
+    """
+    # (start, old_stop, new_stop) after an update that changed earlier
+    # events, the events from start up to old_stop were replaced by the
+    # ones now up to new_stop
+    edited = None
+    # the round follow_state published and waits on, as (number of events
+    # when it was paired, pairings, bye)
+    published = None
+
+    def __init__(self, path):
+        self.path = path
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.digest = hashlib.sha256().hexdigest()
+        self.line_hashes = list()
+        self.line_events = list()
+        self.stop_line = None
+        self.log = RoundCheckpoints()
+        self.change = None
+
+    @property
+    def events(self):
+        return self.log.events
+
+    def update(self):
+        """ Parse the lines changed since the last update
+
+        Returns the new events when lines were only appended, an empty list
+        when no event changed, or None if earlier events changed, see
+        edited.
+        """
+        with open(self.path, "rb") as state_file:
+            data = state_file.read()
+        # leave any partly written last line for the next update
+        data = data[:data.rfind("\n") + 1]
+        data_hash = hashlib.sha256(data[:self.offset])
+        if self.offset <= len(data) and data_hash.hexdigest() == self.digest:
+            new_events = self._append(data[self.offset:].splitlines(True))
+            data_hash.update(data[self.offset:])
         else:
-            raise ValueError("Unrecognized entry at line %d" % (line_num,))
+            new_events = self._diff(data.splitlines(True))
+            data_hash = hashlib.sha256(data)
+        self.offset = len(data)
+        self.digest = data_hash.hexdigest()
+        return new_events
+
+    def _line_events(self, lines, start):
+        """ The events of lines starting at line index start, unvalidated """
+        parser = StateParser()
+        parser.line_num = start
+        events = list()
+        for line in lines:
+            events.append(parser.line_event(line))
+        return events
+
+    def _append(self, lines):
+        start = len(self.line_hashes)
+        count = len(self.log.events)
+        stop_line = self.stop_line
         try:
-            type_handlers[ltype.lower()](line_num, lrest)
-        except KeyError:
-            raise ValueError("Unrecognized line type %s at line %d" % (
-                ltype, line_num))
-    tourn = Tournament()
-    tourn.events = tuple(events)
-    tourn.players = frozenset(players)
-    tourn.seeds = seeds
-    tourn.games = tuple(games)
-    tourn.byes = byes
-    if cur_round[0] != 0:
-        tourn.rounds = cur_round[0]
-    tourn.update_stats()
-    return tourn
+            events = self._line_events(lines, start)
+            new_events = list()
+            for line_num, event in enumerate(events, start=start + 1):
+                if self.stop_line is None and event == "stop":
+                    self.stop_line = line_num - 1
+                if self.stop_line is not None or event is None:
+                    self.line_events.append(0)
+                    continue
+                self.log.append(event, ("line", line_num))
+                self.line_events.append(1)
+                new_events.append(event)
+        except ValueError:
+            self.log.replace(count, len(self.log.events), ())
+            del self.line_events[start:]
+            self.stop_line = stop_line
+            raise
+        self.line_hashes.extend(_line_hash(line) for line in lines)
+        self.change = "append"
+        return new_events
+
+    def _diff(self, lines):
+        hashes = [_line_hash(line) for line in lines]
+        old = self.line_hashes
+        start = 0
+        end = min(len(old), len(hashes))
+        while start < end and old[start] == hashes[start]:
+            start += 1
+        if start == len(old):
+            return self._append(lines[start:])
+        tail = 0
+        while (tail < end - start
+                and old[len(old) - tail - 1] == hashes[len(hashes) - tail - 1]):
+            tail += 1
+        old_stop = len(old) - tail
+        new_stop = len(hashes) - tail
+        stop_line = self.stop_line
+        if stop_line is not None and start > stop_line:
+            # only lines after the stop line changed
+            self.line_hashes[start:old_stop] = hashes[start:new_stop]
+            self.line_events[start:old_stop] = [0] * (new_stop - start)
+            self.change = "edit"
+            return []
+        try:
+            line_events = self._line_events(lines[start:new_stop], start)
+            if "stop" in line_events or (stop_line is not None
+                    and stop_line < old_stop):
+                raise ValueError("Stop line changed")
+            first = sum(self.line_events[:start])
+            last = first + sum(self.line_events[start:old_stop])
+            old_events = self.log.events[first:last]
+            new_events = [event for event in line_events if event is not None]
+            self.log.replace(first, last, new_events)
+        except ValueError:
+            return self._reparse(lines)
+        self.line_hashes[start:old_stop] = hashes[start:new_stop]
+        self.line_events[start:old_stop] = [
+                0 if event is None else 1 for event in line_events]
+        if stop_line is not None:
+            self.stop_line = stop_line + new_stop - old_stop
+        self.change = "edit"
+        return self._edited(first, old_events, new_events)
+
+    def _reparse(self, lines):
+        saved = dict(self.__dict__)
+        self.reset()
+        try:
+            self._append(lines)
+        except ValueError:
+            self.__dict__.update(saved)
+            raise
+        self.change = "structural"
+        return self._edited(0, saved["log"].events, self.log.events)
+
+    def _edited(self, start, old, new):
+        """ Set edited for old events from start replaced by new, returns
+        an empty list if none of them differ and None otherwise
+        """
+        size = min(len(old), len(new))
+        head = 0
+        while head < size and old[head] == new[head]:
+            head += 1
+        if head == len(old) == len(new):
+            return []
+        tail = 0
+        while tail < size - head and old[-tail - 1] == new[-tail - 1]:
+            tail += 1
+        self.edited = (start + head, start + len(old) - tail,
+                start + len(new) - tail)
+        return None
+
+    def tournament(self):
+        """ A Tournament for the state parsed so far """
+        return self.log.tournament()
+
+    def save(self, path):
+        with open(path, "wb") as follow_file:
+            pickle.dump(self, follow_file, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path, state_path):
+        """ Load a saved follower for state_path, or start a new one """
+        try:
+            with open(path, "rb") as follow_file:
+                follower = pickle.load(follow_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return StateFollower(state_path)
+        if not isinstance(follower, StateFollower) or (
+                follower.path != state_path):
+            return StateFollower(state_path)
+        return follower
+
+class RoundCheckpoints(object):
+    """ A tournament built event by event that can correct earlier events
+
+    A checkpoint is taken at every round directive. It holds the event
+    position and the validation state there, reusing the previous
+    checkpoint's player set when it hasn't changed, and any ratings
+    computed for the round before it. The stats themselves aren't copied:
+    a correction takes back the events after the nearest checkpoint before
+    it in reverse order, which leaves the stats, colour history and digests
+    as they were at the checkpoint, and then replays the corrected events.
+    """
+    def __init__(self, events=()):
+        self.state = EventState()
+        self.tourn = Tournament()
+        self.tourn.seeds = self.state.seeds
+        self.tourn.adjacency
+        self.events = list()
+        self.digest = EventDigest()
+        self.checkpoints = list()
+        self.unchanged = False
+        self.extend(events)
+
+    def append(self, event, position=None):
+        """ Validate and apply the next event
+
+        position describes where it came from in error messages, the
+        default is its index in the events.
+        """
+        state = self.state
+        if position is None:
+            position = ("event", len(self.events))
+        state.position = position
+        if self.checkpoints and self.unchanged:
+            # ratings computed since the checkpoint are still valid for it
+            self.checkpoints[-1][5].update(self.tourn.rating_cache)
+        if event[0] == "round":
+            players = frozenset(state.players)
+            if self.checkpoints and self.checkpoints[-1][1] == players:
+                players = self.checkpoints[-1][1]
+            self.checkpoints.append((len(self.events), players,
+                tuple(state.forced), frozenset(state.excluded), state.round,
+                dict(self.tourn.rating_cache)))
+            self.unchanged = True
+        elif event[0] in ("game", "bye"):
+            self.unchanged = False
+        state.apply(event)
+        self.events.append(event)
+        self.digest.append(event)
+        if event[0] == "game":
+            self.tourn.games.append(event[1])
+        self.tourn.apply_event(event)
+
+    def extend(self, events):
+        for event in events:
+            self.append(event)
+
+    def rollback(self, position):
+        """ Take back every event from the last checkpoint at or before
+        position, returns the events taken back
+        """
+        checkpoint = None
+        for checkpoint in reversed(self.checkpoints):
+            if checkpoint[0] <= position:
+                break
+        else:
+            checkpoint = None
+        start = checkpoint[0] if checkpoint is not None else 0
+        removed = self.events[start:]
+        for event in reversed(removed):
+            self.tourn.undo_event(event)
+            if event[0] == "seed":
+                del self.state.seeds[event[1][0]]
+        del self.events[start:]
+        self.digest.truncate(start)
+        games = self.tourn.games
+        games.truncate(len(games) - sum(1 for etype, info in removed
+            if etype == "game"))
+        state = self.state
+        if checkpoint is None:
+            state.players = set()
+            state.forced = list()
+            state.excluded = set()
+            state.round = 0
+            del self.checkpoints[:]
+        else:
+            ix, players, forced, excluded, round_num, ratings = checkpoint
+            state.players = set(players)
+            state.forced = list(forced)
+            state.excluded = set(excluded)
+            state.round = round_num
+            self.checkpoints = [cp for cp in self.checkpoints if cp[0] < start]
+            self.tourn.rating_cache = dict(ratings)
+        self.unchanged = False
+        return removed
+
+    def replace(self, start, stop, events):
+        """ Replace the events from start up to stop with events
+
+        Returns the number of events replayed. If the new events don't
+        validate the old ones are put back and ValueError raised.
+        """
+        if not 0 <= start <= stop <= len(self.events):
+            raise ValueError("No events %d to %d to replace" % (start, stop))
+        removed = self.rollback(start)
+        first = len(self.events)
+        replay = (removed[:start - first] + list(events)
+                + removed[stop - first:])
+        try:
+            self.extend(replay)
+        except ValueError:
+            self.rollback(first)
+            self.extend(removed)
+            raise
+        return len(replay)
+
+    def correct(self, position, events):
+        """ Replace the event at position with events, which may be empty """
+        if not 0 <= position < len(self.events):
+            raise ValueError("No event %d to correct" % (position,))
+        return self.replace(position, position + 1, events)
+
+    def tournament(self):
+        """ A Tournament for the events so far """
+        tourn = self.tourn.copy()
+        # ratings computed for the copy are kept for the checkpoint
+        tourn.rating_cache = self.tourn.rating_cache
+        tourn.events = tuple(self.events)
+        tourn._event_digest = (tourn.events, self.digest.copy())
+        tourn.players = frozenset(self.state.players)
+        tourn.seeds = dict(self.state.seeds)
+        tourn.forced = tuple(self.state.forced)
+        tourn.excluded = frozenset(self.state.excluded)
+        tourn.rounds = self.state.round or None
+        return tourn
+
+def _boards(pairings, bye):
+    """ The published boards as sets of players, a bye as a set of one """
+    boards = set(frozenset(pr) for pr in pairings)
+    if bye is not None:
+        boards.add(frozenset((bye,)))
+    return boards
+
+def _recorded_boards(events, boards):
+    """ Those of boards with a game or bye among events """
+    recorded = set()
+    for etype, info in events:
+        if etype == "game":
+            board = frozenset(info[:2])
+        elif etype == "bye":
+            board = frozenset(info[:1])
+        else:
+            continue
+        if board in boards:
+            recorded.add(board)
+    return recorded
+
+def _edited_position(position, edited):
+    """ Where an event position is after the edit StateFollower.edited
+    describes, positions inside the edit move to its start
+    """
+    start, old_stop, new_stop = edited
+    if position <= start:
+        return position
+    if position >= old_stop:
+        return position + new_stop - old_stop
+    return start
+
+def follow_state(state_path, pair_round, interval=5.0, polls=None,
+        speculate=0, results=(), processes=None, report=None):
+    """ Pair each round of a live tournament as soon as it is complete
+
+    pair_round is called with the Tournament parsed so far and returns the
+    pairings and bye it published. The state file is then polled every
+    interval seconds and pair_round called again once a game or bye has been
+    recorded for every one of those boards. The boards are looked for in
+    the events after the round was paired, so an edit anywhere in the file
+    only moves where that is. The follower and the round it waits on are
+    saved next to the state file after each update so a restarted watcher
+    picks up where it left off. Lines that don't validate are reported to
+    stderr and the file polled again until they are fixed. Stops when a
+    round has no boards or after polls polls.
+
+    When only speculate or fewer games of a round are left, the next round
+    is paired for every outcome of them in a process pool, see
+    speculate_pairings, and the output for the actual outcome printed as
+    soon as it's recorded. A game recorded with other colours than it was
+    published with isn't one of those outcomes, nor is an edit of the
+    events before the outcomes, the round is then paired afresh.
+
+    report, when given, is called with the Tournament and the published
+    pairings after each round is paired and after each update that records
+    some of its games.
+    """
+    save_path = state_path + ".follow"
+    follower = StateFollower.load(save_path, state_path)
+    speculation = None
+    error = [None]
+    def update():
+        try:
+            new_events = follower.update()
+        except ValueError as err:
+            if str(err) != error[0]:
+                sys.stderr.write("%s: %s\n" % (state_path, err))
+                sys.stderr.flush()
+            error[0] = str(err)
+            return []
+        error[0] = None
+        if new_events is None and follower.published is not None:
+            base, pairings, bye = follower.published
+            follower.published = (_edited_position(base, follower.edited),
+                    pairings, bye)
+        follower.save(save_path)
+        return new_events
+    update()
+    changed = False
+    while True:
+        if follower.published is not None:
+            base, pairings, bye = follower.published
+            expected = _boards(pairings, bye)
+            recorded = _recorded_boards(follower.events[base:], expected)
+            if report is not None and changed and not expected <= recorded:
+                report(follower.tournament(), pairings)
+        if follower.published is None or expected <= recorded:
+            published = None
+            if speculation is not None:
+                spec_base, outcomes = speculation
+                key = outcome_key(follower.events[spec_base:])
+                published = outcomes.get().get(key)
+                speculation = None
+            if published is not None:
+                (pairings, bye), output = published
+                sys.stdout.write(output)
+            else:
+                pairings, bye = pair_round(follower.tournament())
+            sys.stdout.flush()
+            expected = _boards(pairings, bye)
+            follower.published = None
+            if expected:
+                follower.published = (len(follower.events), list(pairings),
+                        bye)
+            follower.save(save_path)
+            if not expected:
+                return
+            recorded = set()
+            if report is not None:
+                report(follower.tournament(), pairings)
+        pending = expected - recorded
+        # published colours, since they decide later colour assignments
+        games = [pr for pr in pairings if frozenset(pr) in pending]
+        if speculation is None and 0 < len(games) <= speculate:
+            fixed = [("bye", (tuple(board)[0], None)) for board in pending
+                    if len(board) == 1]
+            speculation = (len(follower.events),
+                    speculate_pairings(follower.tournament(), pair_round,
+                        games, results, fixed, processes, wait=False))
+        if polls is not None:
+            if polls <= 0:
+                return
+            polls -= 1
+        time.sleep(interval)
+        new_events = update()
+        changed = new_events != []
+        if (new_events is None and speculation is not None
+                and follower.edited[0] < speculation[0]):
+            # the outcomes were paired from events that have changed since
+            speculation[1].discard()
+            speculation = None
 
+@timed("rate")
 def rate(seeds, tourn, virtual_weight):
     scores = tourn.wins
-    pair_counts = tourn.pair_counts
+    opponents = tourn.adjacency.opponents
     scores = Counter(scores)
     scores.update({p: 0.5 * virtual_weight for p in seeds.keys()})
-    tuple_counts = defaultdict(int)
-    tuple_counts.update({tuple(p): c for p, c in pair_counts.items()})
-    tuple_counts.update({tuple(reversed(p)): c for p, c in tuple_counts.items()})
     max_rating = max(seeds.values())
     min_rating = min(seeds.values())
     mid_rating = (min_rating + max_rating) / 2.0
@@ -364,7 +1483,9 @@ def rate(seeds, tourn, virtual_weight):
     old_error = float('inf')
     new_rating = dict()
     count = 0
+    iterations = 0
     while True:
+        iterations += 1
         new_error = list()
         for player, seed in seeds.items():
             rating = old_rating[player]
@@ -373,10 +1494,9 @@ def rate(seeds, tourn, virtual_weight):
             predicted_score = [virtual_weight * rating * inverse_sum]
             derivative = [virtual_weight * seed * inverse_sum ** 2]
 
-            for opponent in seeds.keys():
-                if player == opponent:
+            for opponent, weight in opponents.get(player, {}).items():
+                if player == opponent or opponent not in seeds:
                     continue
-                weight = tuple_counts[(player, opponent)]
                 if weight != 0:
                     op_rating = old_rating[opponent]
                     inverse_sum = 1 / (rating + op_rating)
@@ -403,6 +1523,7 @@ def rate(seeds, tourn, virtual_weight):
             else:
                 count = 0
         old_rating = dict(new_rating)
+    metrics.add("rating_iterations", iterations)
     # round to 12 significant decimal places
     ratings = {p: round(r, 11-int(math.floor(math.log10(r))))
             for p, r in best_rating.items()}
@@ -424,8 +1545,8 @@ def clyring_rate(seeds, tourn, virtual_weight):
             prating = ratings[player]
             prior_gradient = gradient_from(prating - seeds[player])
             gradient = prior * prior_gradient - (prior / 2)
-            for opponent in players:
-                if opponent == player:
+            for opponent in opponents.get(player, ()):
+                if opponent == player or opponent not in ratings:
                     continue
                 pair = (player, opponent)
                 op_gradient = gradient_from(prating - ratings[opponent])
@@ -441,8 +1562,8 @@ def clyring_rate(seeds, tourn, virtual_weight):
             prating = ratings[player]
             prior_gradient = gradient_from(prating - seeds[player])
             hessian = prior * prior_gradient * (1 - prior_gradient)
-            for opponent in players:
-                if opponent == player:
+            for opponent in opponents.get(player, ()):
+                if opponent == player or opponent not in ratings:
                     continue
                 pair = (player, opponent)
                 faced = wins[pair] + losses[pair]
@@ -462,6 +1583,7 @@ def clyring_rate(seeds, tourn, virtual_weight):
         else:
             raise ValueError("Cannot handle game result type, %s" % (
                 event[2][0],))
+    opponents = tourn.adjacency.opponents
     ratings = dict(seeds)
 
     min_hessian = 0.5
@@ -482,6 +1604,13 @@ def clyring_rate(seeds, tourn, virtual_weight):
         magnitude = new_magnitude
     return ratings
 
+def cached_rate(seeds, tourn, virtual_weight):
+    """ rate() remembered on the tournament until its stats are updated """
+    key = (virtual_weight, frozenset(seeds.items()))
+    if key not in tourn.rating_cache:
+        tourn.rating_cache[key] = rate(seeds, tourn, virtual_weight)
+    return dict(tourn.rating_cache[key])
+
 def compare_rate(seeds, tourn, virtual_weight):
     ratings = rate(seeds, tourn, virtual_weight)
     cratings = clyring_rate(seeds, tourn, virtual_weight)
@@ -493,33 +1622,326 @@ def compare_rate(seeds, tourn, virtual_weight):
                 player, rating, cratings[player]))
     return ratings
 
-def weighted_pairing(tourn, scale):
-    players = list(tourn.players)
+def ordered_pairing(ordered, structure, scale):
+    """ Pair players directly from their order
+
+    structure is either "fold", pairing the first player with the last, the
+    second with the second to last and so on, or "slide", pairing each player
+    in the first half with the player half the field further down. This is
+    only optimal for scales where swapping opponents between any two pairs
+    never improves on the given structure. With an odd number of players the
+    bye is given to the player minimizing the total weight, which is found
+    with prefix sums over the O(n) pairs that can occur after removing any
+    one player.
+    """
+    if structure == "fold":
+        def partner(ix, num):
+            return num - 1 - ix
+    elif structure == "slide":
+        def partner(ix, num):
+            return ix + num // 2
+    else:
+        raise ValueError("Unknown pairing structure %s" % (structure,))
+    num = len(ordered)
+    if num % 2 == 0:
+        pairings = [(ordered[ix], ordered[partner(ix, num)])
+                for ix in range(num // 2)]
+        return pairings, None
+
+    half = num // 2
+    def prefix(ix_pairs):
+        sums = [0]
+        for p1_ix, p2_ix in ix_pairs:
+            sums.append(sums[-1] + scale.pair(ordered[p1_ix], ordered[p2_ix]))
+        return sums
+    # Removing player k moves every later player up one place, so each pair
+    # of the remaining field is one of three pairs from the full order
+    # depending on where k falls. Prefix sums over each kind give the total
+    # for any k in constant time.
+    if structure == "fold":
+        before = prefix((j, num - 1 - j) for j in range(half))
+        between = prefix((j, num - 2 - j) for j in range(half))
+        after = prefix((j + 1, num - 1 - j) for j in range(half))
+        def split(k):
+            return min(k, num - 1 - k), min(k, half)
+    else:
+        before = prefix((j, j + half) for j in range(half))
+        between = prefix((j, j + half + 1) for j in range(half))
+        after = prefix((j + 1, j + half + 1) for j in range(half))
+        def split(k):
+            return max(0, min(k - half, half)), min(k, half)
+    best = None
+    for k, player in enumerate(ordered):
+        first, second = split(k)
+        weight = (before[first] + between[second] - between[first]
+                + after[half] - after[second])
+        weight += scale.bye(player)
+        if best is None or weight < best[0]:
+            best = (weight, k)
+    bye_ix = best[1]
+    rest = ordered[:bye_ix] + ordered[bye_ix + 1:]
+    pairings = [(rest[ix], rest[partner(ix, num - 1)])
+            for ix in range(half)]
+    return pairings, ordered[bye_ix]
+
+def weighted_pairing(tourn, scale, forced=None, excluded=None):
+    """ Find the pairings and bye minimizing the total scale weight
+
+    forced is a sequence of player pairs that must be paired together, they
+    are taken out of the graph before matching. excluded is a collection of
+    frozenset pairs that must not be paired, they are left out of the edge
+    set. Both default to the constraints recorded in the tournament.
+    """
+    if forced is None:
+        forced = tourn.forced
+    if excluded is None:
+        excluded = tourn.excluded
+    fixed = set()
+    for pair in forced:
+        for p in pair:
+            if p not in tourn.players:
+                raise ValueError("Forced pairing for unpaired player %s" % (
+                    p,))
+            if p in fixed:
+                raise ValueError("Player %s forced into two pairs" % (p,))
+            fixed.add(p)
+    players = [p for p in tourn.players if p not in fixed]
     num_alive = len(players)
 
+    # Before any games are played the scales can only separate players by
+    # their order, when a scale can prove the optimal pairing follows from
+    # that order skip building the full graph.
+    order = getattr(scale, "history_free_order", None)
+    if order is not None and not tourn.games and not excluded:
+        structure = order(players)
+        if structure is not None:
+            with phase("weights"):
+                pairings, bye = ordered_pairing(structure[0], structure[1],
+                        scale)
+            # give each board the order the full matching would, which
+            # decides the arbitrary colours
+            index = {p: ix for ix, p in enumerate(players)}
+            pairings = sorted((tuple(sorted(pair, key=index.get))
+                for pair in pairings), key=lambda pair: index[pair[0]])
+            pairings = [tuple(pair) for pair in forced] + pairings
+            tourn.solution = PairingSolution(scale, players, forced,
+                    excluded, pairings, bye, None)
+            metrics.peak("players", num_alive)
+            metrics.add("edges", 0)
+            return pairings, bye
+
     weights = []
-    for p1_ix, p1 in enumerate(players):
-        for p2_ix, p2 in enumerate(players[p1_ix + 1:], p1_ix + 1):
-            wt = scale.pair(p1, p2)
-            weights.append((p1_ix, p2_ix, 0 - wt))
-        if num_alive % 2 == 1:
-            wt = scale.bye(p1)
-            weights.append((p1_ix, num_alive, 0 - wt))
-    opponents = maxWeightMatching(weights, maxcardinality=True)
-    weight_dict = {(v1, v2): wt for v1, v2, wt in weights}
-    result_weight = sum(weight_dict[(v1, v2)] for v1, v2 in enumerate(opponents)
-        if v1 < v2)
+    with phase("weights"):
+        for p1_ix, p1 in enumerate(players):
+            for p2_ix, p2 in enumerate(players[p1_ix + 1:], p1_ix + 1):
+                if excluded and frozenset((p1, p2)) in excluded:
+                    continue
+                wt = scale.pair(p1, p2)
+                weights.append((p1_ix, p2_ix, 0 - wt))
+            if num_alive % 2 == 1:
+                wt = scale.bye(p1)
+                weights.append((p1_ix, num_alive, 0 - wt))
+    duals = dict()
+    stats = dict()
+    with phase("matching"):
+        opponents = maxWeightMatching(weights, maxcardinality=True,
+                duals=duals, stats=stats if metrics.enabled() else None)
+    if metrics.enabled():
+        metrics.peak("players", num_alive)
+        metrics.add("edges", len(weights))
+        metrics.peak("weight_bits", max([int(abs(wt))
+            for p1_ix, p2_ix, wt in weights] + [0]).bit_length())
+        metrics.add("matching_stages", stats["stages"])
+        metrics.add("matching_substages", stats["substages"])
+    # vertices without any edge are left off the end of the matching
+    num_vertices = num_alive + (num_alive % 2)
+    opponents += [-1] * (num_vertices - len(opponents))
+    for p1_ix, p2_ix in enumerate(opponents):
+        if p2_ix == -1:
+            raise ValueError("No allowed pairing found for player %s" % (
+                players[p1_ix],))
 
     if num_alive % 2 == 1:
         bye = players[opponents.index(num_alive)]
     else:
         bye = None
-    pairings = [(players[p1_ix], players[p2_ix])
+    pairings = [tuple(pair) for pair in forced]
+    pairings += [(players[p1_ix], players[p2_ix])
             for p1_ix, p2_ix in enumerate(opponents[:num_alive])
             if p2_ix != num_alive and p1_ix < p2_ix
             ]
+    tourn.solution = PairingSolution(scale, players, forced, excluded,
+            pairings, bye, duals)
     return pairings, bye
 
+class PairingSolution(object):
+    """ The optimum found by the last weighted_pairing run on a tournament
+
+    players gives the graph vertex of each unforced player, the bye vertex
+    comes after them. duals is the dual solution from the matching or None
+    when the round was paired without building the graph. The objective,
+    the total weight of the pairings and bye found, is only worked out when
+    a candidate is scored against it.
+    """
+    def __init__(self, scale, players, forced, excluded, pairings, bye,
+            duals):
+        self.scale = scale
+        self.players = list(players)
+        self.vertex = {p: ix for ix, p in enumerate(self.players)}
+        self.forced = frozenset(frozenset(pair) for pair in forced)
+        self.excluded = excluded
+        self.pairings = pairings
+        self.bye = bye
+        self.duals = duals
+        self._objective = None
+
+    @property
+    def objective(self):
+        if self._objective is None:
+            self._objective = pairing_weight(self.scale, self.pairings,
+                    self.bye)
+        return self._objective
+
+    def slack(self, p1, p2):
+        """ Twice the slack of the edge for a board, p2 is None for a bye
+
+        Returns None when the board isn't an edge of the solved graph.
+        """
+        if p1 not in self.vertex:
+            return None
+        if p2 is None:
+            if len(self.players) % 2 == 0:
+                return None
+            v2 = len(self.players)
+            wt = 0 - self.scale.bye(p1)
+        else:
+            if p2 not in self.vertex or frozenset((p1, p2)) in self.excluded:
+                return None
+            v2 = self.vertex[p2]
+            wt = 0 - self.scale.pair(p1, p2)
+        v1 = self.vertex[p1]
+        vertex_duals = self.duals.get("vertex", [])
+        if max(v1, v2) >= len(vertex_duals):
+            return None
+        slack = vertex_duals[v1] + vertex_duals[v2] - 2 * wt
+        for z, leaves in self.duals.get("blossoms", []):
+            if v1 in leaves and v2 in leaves:
+                slack += 2 * z
+        return slack
+
+class PairingScore(object):
+    """ Objective of a candidate pairing broken down by scale criterion
+
+    optimum is the objective of the last solve with the same scale, if any,
+    and violations lists the boards that have positive slack under that
+    solve's dual solution as (board, slack) with slack None for boards that
+    are not allowed at all. Any violation means the candidate is not optimal.
+    """
+    def __init__(self, objective, breakdown, optimum, violations):
+        self.objective = objective
+        self.breakdown = breakdown
+        self.optimum = optimum
+        self.violations = violations
+
+    def is_optimal(self):
+        if self.optimum is None:
+            return None
+        return self.objective == self.optimum
+
+def combine_terms(terms):
+    """ Combine (criterion, multiplier, value) terms into a single weight
+
+    Each term multiplies the weight so far before adding its own value, so
+    earlier terms dominate later ones.
+    """
+    weight = 0
+    for criterion, multiplier, value in terms:
+        weight = weight * multiplier + value
+    return weight
+
+def pairing_weight(scale, pairings, bye):
+    weight = sum(scale.pair(p1, p2) for p1, p2 in pairings)
+    if bye is not None:
+        weight += scale.bye(bye)
+    return weight
+
+def score_pairing(tourn, scale, pairings, bye=None):
+    """ Score a candidate pairing under a scale without solving
+
+    The breakdown sums the values of each scale criterion over all boards,
+    scales without pair_terms and bye_terms methods are only broken down
+    into pairs and bye. If the tournament's last solve used the same scale
+    the candidate is compared to its objective and checked for complementary
+    slackness against its dual solution.
+    """
+    seen = set()
+    for p in [p for pr in pairings for p in pr] + [bye]:
+        if p is None:
+            continue
+        if p not in tourn.players:
+            raise ValueError("Player %s in pairing is not being paired" % (
+                p,))
+        if p in seen:
+            raise ValueError("Player %s appears twice in pairing" % (p,))
+        seen.add(p)
+    if len(seen) != len(tourn.players):
+        missing = sorted(tourn.players - seen)
+        raise ValueError("Players missing from pairing: %s" % (
+            " ".join(missing),))
+
+    breakdown = list()
+    totals = dict()
+    def add_terms(terms):
+        for criterion, multiplier, value in terms:
+            if criterion not in totals:
+                totals[criterion] = 0
+                breakdown.append(criterion)
+            totals[criterion] += value
+    if hasattr(scale, "pair_terms"):
+        for p1, p2 in pairings:
+            add_terms(scale.pair_terms(p1, p2))
+        if bye is not None:
+            add_terms(scale.bye_terms(bye))
+    else:
+        add_terms([("pairs", 1, sum(scale.pair(*pr) for pr in pairings))])
+        if bye is not None:
+            add_terms([("bye", 1, scale.bye(bye))])
+    breakdown = [(criterion, totals[criterion]) for criterion in breakdown]
+
+    solution = tourn.solution
+    if solution is None or solution.scale is not scale:
+        return PairingScore(pairing_weight(scale, pairings, bye), breakdown,
+                None, None)
+    violations = None
+    if solution.duals is not None:
+        violations = list()
+        boards = [tuple(pr) for pr in pairings
+                if frozenset(pr) not in solution.forced]
+        if bye is not None:
+            boards.append((bye, None))
+        for p1, p2 in boards:
+            slack = solution.slack(p1, p2)
+            if slack != 0:
+                violations.append(((p1, p2), slack))
+    return PairingScore(pairing_weight(scale, pairings, bye), breakdown,
+            solution.objective, violations)
+
+def colour_hash(tourn):
+    """ sha256 of the sorted players and games that arbitrary colours are
+    drawn from
+    """
+    games = tourn.games
+    if not isinstance(games, GameTable):
+        games = GameTable(games)
+    names = games.names
+    tourn_hash = hashlib.sha256()
+    tourn_hash.update("\n".join(sorted(tourn.players)))
+    tourn_hash.update("\n")
+    tourn_hash.update("\n".join(sorted("%s %s" % (names[a], names[b])
+        for a, b in izip(games.p1, games.p2))))
+    return tourn_hash
+
+@timed("assign_colors")
 def assign_colors(tourn, pairings):
     """
     1. Assign Gold to the player with a lower total of previous games as Gold minus previous games as Silver.
@@ -529,64 +1951,56 @@ def assign_colors(tourn, pairings):
     5. Swap colors with respect to the last time the two players played against each other.
     6. Assign color arbitrarily.
     """
-    tourn_hash = hashlib.sha256()
-    tourn_hash.update("\n".join(sorted(tourn.players)))
-    tourn_hash.update("\n")
-    tourn_hash.update("\n".join(sorted("%s %s" % g[:2] for g in tourn.games)))
-    extra_gold = Counter()
-    prev_pair = Counter()
-    p1_streak = Counter()
-    p2_streak = Counter()
-    last_pairing = dict()
-    for p1, p2, result in tourn.games:
-        if result[0] == "vacated":
-            continue
-        extra_gold[p1] += 1
-        extra_gold[p2] -= 1
-        prev_pair[(p1, p2)] += 1
-        p1_streak[p1] += 1
-        p2_streak[p1] = 0
-        p1_streak[p2] = 0
-        p2_streak[p2] += 1
-        last_pairing[frozenset((p1, p2))] = p1
-    games = list()
+    adjacency = tourn.adjacency
+    extra_gold = adjacency.extra_gold
+    # hashing every game is only worth it once a board needs rule 6
+    tourn_hash = None
+    colored = list()
     arbitrary = set()
     for p1, p2 in pairings:
         # 1 p1 to player with less previous (games as p1 - games as p2)
         if extra_gold[p1] != extra_gold[p2]:
             if extra_gold[p2] < extra_gold[p1]:
                 p1, p2 = p2, p1
-            games.append((p1, p2))
+            colored.append((p1, p2))
             continue
         # 2 p1 to player with fewer games as p1 in games against p2
-        if prev_pair[(p1, p2)] != prev_pair[(p2, p1)]:
-            if prev_pair[(p1, p2)] > prev_pair[(p2, p1)]:
+        p1_gold = adjacency.gold_count(p1, p2)
+        p2_gold = adjacency.gold_count(p2, p1)
+        if p1_gold != p2_gold:
+            if p1_gold > p2_gold:
                     p1, p2 = p2, p1
-            games.append((p1, p2))
+            colored.append((p1, p2))
             continue
         # 3 break both player's color streak
-        if p1_streak[p1] > 0 and p2_streak[p2] > 0:
-            games.append((p2, p1))
+        p1_gold_streak, p1_silver_streak = adjacency.streaks(p1)
+        p2_gold_streak, p2_silver_streak = adjacency.streaks(p2)
+        if p1_gold_streak > 0 and p2_silver_streak > 0:
+            colored.append((p2, p1))
             continue
-        elif p2_streak[p1] > 0 and p1_streak[p2] > 0:
-            games.append((p1, p2))
+        elif p1_silver_streak > 0 and p2_gold_streak > 0:
+            colored.append((p1, p2))
             continue
         # 4 break the color streak of the player with the longest streak
-        p1_max = max(p1_streak[p1], p2_streak[p1])
-        p2_max = max(p1_streak[p2], p2_streak[p2])
+        p1_max = max(p1_gold_streak, p1_silver_streak)
+        p2_max = max(p2_gold_streak, p2_silver_streak)
         if p1_max != p2_max:
-            if ((p1_max > p2_max and p1_streak[p1] > 0)
-                    or (p2_max > p1_max and p2_streak[p2] > 0)):
+            if ((p1_max > p2_max and p1_gold_streak > 0)
+                    or (p2_max > p1_max and p2_silver_streak > 0)):
                 p1, p2 = p2, p1
-            games.append((p1, p2))
+            colored.append((p1, p2))
             continue
         # 5 swap colors from last game they played against each other
-        if frozenset((p1, p2)) in last_pairing:
-            if last_pairing[frozenset((p1, p2))] == p1:
+        pair_key = frozenset((p1, p2))
+        if pair_key in adjacency.last_gold:
+            if adjacency.last_gold[pair_key] == p1:
                 p1, p2 = p2, p1
-            games.append((p1, p2))
+            colored.append((p1, p2))
             continue
-        # 6 assign colors arbitrarily
+        # 6 assign colors arbitrarily, the same way earlier versions did so
+        # published rounds can be reproduced
+        if tourn_hash is None:
+            tourn_hash = colour_hash(tourn)
         p1_hash = tourn_hash.copy()
         p1_hash.update("\n%s %s" % (p1, p2))
         p1_hash = int(p1_hash.hexdigest(), 16)
@@ -596,7 +2010,218 @@ def assign_colors(tourn, pairings):
         if p2_hash < p1_hash:
             p1, p2 = p2, p1
         game = (p1, p2)
-        games.append(game)
+        colored.append(game)
         arbitrary.add(game)
-    return games, arbitrary
+    return colored, arbitrary
+
+_sweep_state = dict()
+
+def _sweep_init(tourn, pair_func):
+    _sweep_state["tourn"] = tourn
+    _sweep_state["pair"] = pair_func
+
+def _sweep_group(configs):
+    results = list()
+    for config in configs:
+        # shallow copies share the rating cache so each virtual weight in the
+        # group is only rated once
+        tourn = copy.copy(_sweep_state["tourn"])
+        pairings, bye = _sweep_state["pair"](tourn, config)
+        pairings, arbitrary = assign_colors(tourn, pairings)
+        pairings.sort(key=lambda pr: min(tourn.ranks[pr[0]],
+            tourn.ranks[pr[1]]))
+        results.append((pairings, bye))
+    return results
+
+def sweep_variants(config, virtuals, flags):
+    """ Copies of config for every virtual weight and flag combination """
+    variants = list()
+    for virtual in virtuals:
+        for mask in range(2 ** len(flags)):
+            variant = copy.copy(config)
+            variant.virtual = virtual
+            for bit, flag in enumerate(flags):
+                setattr(variant, flag, bool(mask & (1 << bit)))
+            variants.append(variant)
+    return variants
+
+def _sweep_tasks(configs, workers):
+    """ Split the configs into lists of (index, config) for the workers
+
+    Configs with the same virtual weight go together so their ratings are
+    shared. With fewer virtual weights than workers each of them is split
+    further, the parts rate again but keep every worker busy.
+    """
+    groups = OrderedDict()
+    for ix, config in enumerate(configs):
+        groups.setdefault(config.virtual, list()).append((ix, config))
+    parts = max(1, -(-workers // max(len(groups), 1)))
+    tasks = list()
+    for group in groups.values():
+        size = -(-len(group) // parts)
+        tasks.extend(group[start:start + size]
+                for start in range(0, len(group), size))
+    return tasks
+
+def sweep_pairings(tourn, pair_func, configs, processes=None):
+    """ Pair the tournament under each config in a process pool
+
+    The tournament is sent to each worker once and configs are shared out
+    by _sweep_tasks. pair_func is called as pair_func(tourn, config) on a
+    shallow copy of the tournament and must set its ranks. Returns
+    (pairings, bye) in the order of configs, with colors assigned and boards
+    in rank order.
+    """
+    tasks = _sweep_tasks(configs, processes or cpu_count())
+    pool = Pool(processes, initializer=_sweep_init,
+            initargs=(tourn, pair_func))
+    try:
+        task_results = pool.map(_sweep_group,
+                [[c for ix, c in task] for task in tasks])
+    finally:
+        pool.close()
+        pool.join()
+    results = [None] * len(configs)
+    for task, task_result in zip(tasks, task_results):
+        for (ix, config), result in zip(task, task_result):
+            results[ix] = result
+    return results
+
+def capture_output(func, *args):
+    """ Call func, returning its result and whatever it printed """
+    output = cStringIO.StringIO()
+    stdout = sys.stdout
+    sys.stdout = output
+    try:
+        result = func(*args)
+    finally:
+        sys.stdout = stdout
+    return result, output.getvalue()
+
+_sections_state = dict()
+
+def _sections_init(sections, pair_func):
+    _sections_state["sections"] = sections
+    _sections_state["pair"] = pair_func
+
+def _pair_section(name):
+    tourn = _sections_state["sections"][name]
+    return capture_output(_sections_state["pair"], tourn)
+
+def pair_sections(sections, pair_func, processes=None):
+    """ Pair every section from parse_sections in a process pool
 
+    The sections reach the workers when the pool starts. Returns an
+    OrderedDict in section order of pair_func's result for each section and
+    whatever it printed.
+    """
+    names = list(sections)
+    pool = Pool(processes, initializer=_sections_init,
+            initargs=(sections, pair_func))
+    try:
+        results = pool.map(_pair_section, names)
+    finally:
+        pool.close()
+        pool.join()
+    return OrderedDict(zip(names, results))
+
+_speculate_state = dict()
+
+def _speculate_init(tourn, pair_func):
+    _speculate_state["tourn"] = tourn
+    _speculate_state["pair"] = pair_func
+
+def _speculate_outcome(events):
+    tourn = _speculate_state["tourn"].copy()
+    for event in events:
+        if event[0] == "game":
+            tourn.games.append(event[1])
+        tourn.apply_event(event)
+    tourn.events = tourn.events + tuple(events)
+    return outcome_key(events), capture_output(_speculate_state["pair"], tourn)
+
+def outcome_key(events):
+    """ Key for a set of events that ignores their order
+
+    Games keep their colours, assign_colors looks at who had gold.
+    """
+    key = list()
+    for etype, info in events:
+        if etype == "bye":
+            info = info[:1]
+        key.append((etype, info))
+    return frozenset(Counter(key).items())
+
+def pending_outcomes(games, results=(), fixed=()):
+    """ Event lists for every combination of results of the pending games
+
+    Each (p1, p2) game is either won by one of the players or ends with one
+    of results, like "draw". fixed events are added to every outcome.
+    """
+    choices = list()
+    for p1, p2 in games:
+        options = [("winner", p1), ("winner", p2)]
+        options.extend((result,) for result in results)
+        choices.append([("game", (p1, p2, option)) for option in options])
+    return [list(outcome) + list(fixed) for outcome in product(*choices)]
+
+class _SpeculatedPairings(object):
+    """ The pairings of a speculation still being worked out """
+    def __init__(self, pool, result):
+        self.pool = pool
+        self.result = result
+
+    def get(self):
+        if self.pool is not None:
+            try:
+                self.result = dict(self.result.get())
+            finally:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        return self.result
+
+    def discard(self):
+        """ Stop working out pairings that are no longer wanted """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+def speculate_pairings(tourn, pair_func, games, results=(), fixed=(),
+        processes=None, wait=True):
+    """ Pair the next round for every outcome of the pending games
+
+    Every outcome from pending_outcomes is applied to a copy of tourn in a
+    process pool, which gets the tournament once, and pair_func called with
+    it. Returns a dict from the outcome_key of each outcome's events to
+    pair_func's result and whatever it printed. With wait False an object
+    whose get() method returns the dict is returned straight away.
+    """
+    outcomes = pending_outcomes(games, results, fixed)
+    pool = Pool(processes, initializer=_speculate_init,
+            initargs=(tourn, pair_func))
+    speculated = _SpeculatedPairings(pool,
+            pool.map_async(_speculate_outcome, outcomes))
+    if wait:
+        return speculated.get()
+    return speculated
+
+def pairing_diff(base, other):
+    """ Boards removed from and added to a pairing, ignoring colors
+
+    base and other are (pairings, bye) tuples, byes are given as (player,)
+    boards.
+    """
+    def boards(result):
+        pairings, bye = result
+        found = set(frozenset(pr) for pr in pairings)
+        if bye is not None:
+            found.add(frozenset((bye,)))
+        return found
+    base_boards = boards(base)
+    other_boards = boards(other)
+    def ordered(found):
+        return sorted(tuple(sorted(board)) for board in found)
+    return (ordered(base_boards - other_boards),
+            ordered(other_boards - base_boards))
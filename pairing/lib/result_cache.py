@@ -0,0 +1,114 @@
+
+""" Keep the pairings of a state on disk so pairing it again is instant
+
+A result is stored under a digest of the tournament's events, the options
+that change the pairing and the source of the pairing code, so editing the
+state, changing an option or updating the code all give a new key. Options
+that only change what gets printed, like --ranks, are left out of the key
+so they can be added on a cached result.
+
+The cache directory is kept under a size limit by removing the least
+recently used results, reading a result counts as using it.
+"""
+
+import glob
+import hashlib
+import os
+import pickle
+import tempfile
+
+import metrics
+from pair import capture_output
+
+_lib_dir = os.path.dirname(os.path.abspath(__file__))
+_versions = dict()
+
+def tool_version(script):
+    """ Digest of the library sources and the pairing script """
+    if script not in _versions:
+        source = os.path.splitext(os.path.abspath(script))[0] + ".py"
+        digest = hashlib.sha256()
+        for path in sorted(glob.glob(os.path.join(_lib_dir, "*.py"))) + [
+                source]:
+            with open(path, "rb") as source_file:
+                digest.update(hashlib.sha256(source_file.read()).digest())
+        _versions[script] = digest.hexdigest()
+    return _versions[script]
+
+def result_key(tourn, options, script):
+    """ Key for the pairing of tourn with options by script """
+    key = hashlib.sha256()
+    key.update(tool_version(script) + "\n")
+    key.update(tourn.state_digest() + "\n")
+    key.update(repr(sorted(options.items())))
+    return key.hexdigest()
+
+class ResultCache(object):
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        """ The stored result, None if there isn't a readable one """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as result_file:
+                result = pickle.load(result_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(path, None)
+        return result
+
+    def put(self, key, result):
+        """ Store a result, written to a temporary file first so a reader
+        never sees half of it
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory,
+                suffix=".tmp")
+        with os.fdopen(handle, "wb") as result_file:
+            pickle.dump(result, result_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path(key))
+        self.trim()
+
+    def trim(self):
+        """ Remove the least recently used results over the size limit """
+        entries = list()
+        for path in glob.glob(os.path.join(self.directory, "*.pickle")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def cached_result(tourn, options, config, script, solve):
+    """ solve()'s result for tourn and what it printed
+
+    With config.cache_dir set the result and output are looked up under
+    result_key and stored there after a miss, otherwise solve() is just
+    called and prints as usual.
+    """
+    if not getattr(config, "cache_dir", None):
+        return solve(), ""
+    cache = ResultCache(config.cache_dir, config.cache_size * 2 ** 20)
+    key = result_key(tourn, options, script)
+    cached = cache.get(key)
+    metrics.note("cached", cached is not None)
+    if cached is None:
+        cached = capture_output(solve)
+        cache.put(key, cached)
+    return cached
@@ -0,0 +1,146 @@
+
+""" Simulate whole tournaments to compare pairing rules
+
+Players are given a true strength and a seed that is the strength off by
+some noise. Each round is paired by a pairing function, normally the real
+get_pairings followed by assign_colors, and the games decided at random
+from the true strengths with the logistic model clyring_rate fits ratings
+with. Events are applied to the Tournament in memory, no state file is
+written.
+
+Every simulation gets its own random generator seeded from the base seed
+and its index, so results don't depend on the number of processes.
+"""
+
+import math
+import os
+import random
+import sys
+from collections import Counter
+from multiprocessing import Pool
+
+from pair import EventState, build_tournament
+
+INATELO = math.log(10) / 400
+
+def win_probability(strength, opponent):
+    """ Chance a player of strength beats one of opponent strength """
+    return 1 / (1 + math.exp((opponent - strength) * INATELO))
+
+def synthetic_field(rng, size, mean=1500.0, spread=200.0, seed_error=100.0):
+    """ Random true strengths and seeds for size players
+
+    Players are named player0, player1 and so on in order of their seeds.
+    """
+    strengths = [rng.gauss(mean, spread) for _ in range(size)]
+    seeded = sorted(((round(s + rng.gauss(0, seed_error), 1), s)
+        for s in strengths), reverse=True)
+    seeds = dict()
+    strength = dict()
+    for num, (seed, true_strength) in enumerate(seeded):
+        name = "player%d" % (num,)
+        seeds[name] = seed
+        strength[name] = true_strength
+    return strength, seeds
+
+def play_game(rng, strength, p1, p2):
+    if rng.random() < win_probability(strength[p1], strength[p2]):
+        return (p1, p2, ("winner", p1))
+    return (p1, p2, ("winner", p2))
+
+def _apply(state, tourn, events):
+    def validated():
+        for event in events:
+            state.apply(event)
+            yield event
+    return build_tournament(state, validated(), tourn)
+
+def simulate_tournament(pair_func, size, rng, rounds=None, **field):
+    """ Play one tournament and return its summary statistics
+
+    pair_func is called with the Tournament before each round and returns
+    the coloured pairings and bye for it. Play stops once a round has no
+    games or after rounds rounds. Keyword arguments are passed on to
+    synthetic_field.
+    """
+    strength, seeds = synthetic_field(rng, size, **field)
+    state = EventState()
+    tourn = _apply(state, None,
+            [("seed", (p, seeds[p])) for p in sorted(seeds)])
+    round_num = 0
+    while rounds is None or round_num < rounds:
+        pairings, bye = pair_func(tourn)
+        if not pairings:
+            break
+        round_num += 1
+        events = [("round", round_num)]
+        if bye is not None:
+            events.append(("bye", (bye, None)))
+        for p1, p2 in pairings:
+            events.append(("game", play_game(rng, strength, p1, p2)))
+        tourn = _apply(state, tourn, events)
+
+    gold = Counter(p1 for p1, p2, result in tourn.games)
+    imbalance = [abs(2 * gold[p] - tourn.played[p]) for p in seeds]
+    top = max(seeds, key=lambda p: strength[p])
+    fewest = min(tourn.losses[p] for p in seeds)
+    return {
+            "rounds": round_num,
+            "games": len(tourn.games),
+            "repeats": sum(c - 1 for c in tourn.pair_counts.values()),
+            "max_imbalance": max(imbalance),
+            "mean_imbalance": float(sum(imbalance)) / len(imbalance),
+            "top_losses": tourn.losses[top],
+            "top_survived": tourn.losses[top] == fewest,
+            }
+
+_simulate_state = dict()
+
+def _simulate_init(pair_func, size, base_seed, rounds, field):
+    _simulate_state["args"] = (pair_func, size, base_seed, rounds, field)
+    # anything the pairing code prints would only get mixed up between
+    # the workers
+    sys.stdout = open(os.devnull, "w")
+
+def _simulate_one(index):
+    pair_func, size, base_seed, rounds, field = _simulate_state["args"]
+    rng = random.Random(base_seed * 2 ** 32 + index)
+    return simulate_tournament(pair_func, size, rng, rounds, **field)
+
+def simulate_tournaments(pair_func, count, size, base_seed=0, rounds=None,
+        processes=None, **field):
+    """ Run count independent simulations in a process pool
+
+    Returns the summary of each simulation in order of their index. The
+    pairing function is handed to the workers when the pool starts so it
+    doesn't need to be picklable.
+    """
+    pool = Pool(processes, initializer=_simulate_init,
+            initargs=(pair_func, size, base_seed, rounds, field))
+    try:
+        return pool.map(_simulate_one, range(count))
+    finally:
+        pool.close()
+        pool.join()
+
+def summarize(results):
+    """ Averages of the simulation summaries, with survival as a rate """
+    count = len(results)
+    summary = dict()
+    for key in ("rounds", "games", "repeats", "max_imbalance",
+            "mean_imbalance", "top_losses"):
+        summary[key] = math.fsum(r[key] for r in results) / count
+    summary["top_survived"] = sum(1 for r in results
+            if r["top_survived"]) / float(count)
+    summary["simulations"] = count
+    return summary
+
+def print_summary(summary):
+    print "# %d simulated tournaments" % (summary["simulations"],)
+    print "# mean rounds %.2f games %.2f" % (summary["rounds"],
+            summary["games"])
+    print "# mean repeat pairings %.3f" % (summary["repeats"],)
+    print "# mean colour imbalance %.3f, worst player %.3f" % (
+            summary["mean_imbalance"], summary["max_imbalance"])
+    print "# strongest player finished first %.1f%%, mean losses %.2f" % (
+            summary["top_survived"] * 100, summary["top_losses"])
@@ -0,0 +1,293 @@
+
+""" Binary snapshots of parsed tournaments
+
+A snapshot stores a parsed Tournament as little endian columnar arrays so
+it can be loaded without parsing the state file again. Players are interned
+into integer ids in order of their seed events and every event is one entry
+in each of four parallel arrays, its type code and up to three integer
+arguments. The stats update_stats would build are stored as well.
+
+The snapshot records the sha256 digest of the state file it came from and
+is only used while that digest still matches. Snapshots are read through
+mmap and the events, games and stats are only turned into Python objects
+when first accessed.
+"""
+
+import array
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from collections import Counter
+
+from pair import (
+        RESULT_CODES, RESULTS, GameTable, Tournament, parse_sections,
+        parse_tournament, open_state,
+        )
+from timing import timed
+
+MAGIC = "TTSNAP01"
+HEADER = struct.Struct("<8s32sI")
+SECTION = struct.Struct("<16scQQ")
+
+EVENT_TYPES = ("seed", "remove", "add", "bye", "game", "force", "exclude",
+        "round")
+EVENT_CODES = {etype: code for code, etype in enumerate(EVENT_TYPES)}
+
+STATS = ("played", "wins", "draws", "losses")
+LAZY = frozenset(("events", "games", "pair_counts") + STATS)
+
+def snapshot_path(state_path, section=None):
+    """ Where the snapshot of a state file, or of one of its sections, is
+    kept
+    """
+    if section is None:
+        return state_path + ".snap"
+    return "%s.%s.snap" % (state_path,
+            hashlib.sha1(section).hexdigest()[:16])
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as state_file:
+        for chunk in iter(lambda: state_file.read(1 << 20), ""):
+            digest.update(chunk)
+    return digest.digest()
+
+def _array(typecode, values=()):
+    return array.array(typecode, values)
+
+def write_snapshot(tourn, path, digest):
+    """ Write tourn to path as a snapshot of a state file with digest """
+    names = list()
+    ids = dict()
+    for etype, info in tourn.events:
+        if etype == "seed" and info[0] not in ids:
+            ids[info[0]] = len(names)
+            names.append(info[0])
+    bye_results = list()
+    bye_codes = {None: 0}
+    etypes = _array("B")
+    args = [_array("i"), _array("i"), _array("i")]
+    for etype, info in tourn.events:
+        values = [0, 0, 0]
+        if etype in ("seed", "remove", "add"):
+            values[0] = ids[info[0]]
+        elif etype == "bye":
+            player, result = info
+            if result not in bye_codes:
+                bye_codes[result] = len(bye_results) + 1
+                bye_results.append(result)
+            values[:2] = ids[player], bye_codes[result]
+        elif etype == "game":
+            p1, p2, result = info
+            if result[0] == "winner":
+                code = 0 if result[1] == p1 else 1
+            else:
+                code = RESULT_CODES[result[0]]
+            values = [ids[p1], ids[p2], code]
+        elif etype in ("force", "exclude"):
+            values[:2] = ids[info[0]], ids[info[1]]
+        elif etype == "round":
+            values[0] = info
+        etypes.append(EVENT_CODES[etype])
+        for column, value in zip(args, values):
+            column.append(value)
+    pairs = sorted(tuple(sorted(ids[p] for p in pset))
+            for pset in tourn.pair_counts)
+    sections = [
+            ("names", "c", "\n".join(names)),
+            ("seeds", "d", _array("d", (tourn.seeds[p] for p in names))),
+            ("bye_results", "c", "\n".join(bye_results)),
+            ("etype", "B", etypes),
+            ("ea", "i", args[0]),
+            ("eb", "i", args[1]),
+            ("ec", "i", args[2]),
+            ("players", "i", _array("i", sorted(ids[p]
+                for p in tourn.players))),
+            ("byes", "i", _array("i", (tourn.byes[p] for p in names))),
+            ("forced", "i", _array("i", (ids[p]
+                for pr in tourn.forced for p in pr))),
+            ("excluded", "i", _array("i", (ids[p]
+                for pset in tourn.excluded for p in sorted(pset)))),
+            ("rounds", "i", _array("i", [tourn.rounds or 0])),
+            ("pair_a", "i", _array("i", (a for a, b in pairs))),
+            ("pair_b", "i", _array("i", (b for a, b in pairs))),
+            ("pair_n", "i", _array("i", (tourn.pair_counts[
+                frozenset((names[a], names[b]))] for a, b in pairs))),
+            ]
+    for stat in STATS:
+        counts = getattr(tourn, stat)
+        sections.append((stat, "i", _array("i", (counts[p] for p in names))))
+
+    blobs = list()
+    for name, typecode, data in sections:
+        if not isinstance(data, str):
+            if sys.byteorder != "little":
+                data = array.array(data.typecode, data)
+                data.byteswap()
+            data = data.tostring()
+        blobs.append(data)
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = list()
+    for (name, typecode, data), blob in zip(sections, blobs):
+        offset += -offset % 8
+        table.append(SECTION.pack(name, typecode, offset, len(blob)))
+        offset += len(blob)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as snap_file:
+        snap_file.write(HEADER.pack(MAGIC, digest, len(sections)))
+        snap_file.write("".join(table))
+        for entry, blob in zip(table, blobs):
+            start = SECTION.unpack(entry)[2]
+            snap_file.write("\0" * (start - snap_file.tell()))
+            snap_file.write(blob)
+    os.rename(tmp_path, path)
+
+class SnapshotTournament(Tournament):
+    """ A Tournament backed by a memory mapped snapshot
+
+    events, games and the stats are decoded from the snapshot the first
+    time they are used.
+    """
+    def __init__(self, snap_map, sections):
+        Tournament.__init__(self)
+        for name in LAZY:
+            self.__dict__.pop(name, None)
+        self._map = snap_map
+        self._sections = sections
+        self.names = self._column("names").split("\n")
+        if self.names == [""]:
+            self.names = []
+        names = self.names
+        self.seeds = dict(zip(names, self._column("seeds")))
+        self.players = frozenset(names[i] for i in self._column("players"))
+        self.byes = Counter({p: n for p, n in zip(names, self._column("byes"))
+            if n})
+        forced = self._column("forced")
+        self.forced = tuple((names[forced[i]], names[forced[i + 1]])
+                for i in range(0, len(forced), 2))
+        excluded = self._column("excluded")
+        self.excluded = frozenset(
+                frozenset((names[excluded[i]], names[excluded[i + 1]]))
+                for i in range(0, len(excluded), 2))
+        self.rounds = self._column("rounds")[0] or None
+
+    def _column(self, name):
+        typecode, offset, size = self._sections[name]
+        data = self._map[offset:offset + size]
+        if typecode == "c":
+            return data
+        column = array.array(typecode)
+        column.fromstring(data)
+        if sys.byteorder != "little":
+            column.byteswap()
+        return column
+
+    def __getattr__(self, name):
+        if name not in LAZY or "_map" not in self.__dict__:
+            raise AttributeError(name)
+        if name in ("events", "games"):
+            self._decode_events()
+        elif name == "pair_counts":
+            names = self.names
+            self.pair_counts = Counter({
+                frozenset((names[a], names[b])): n for a, b, n in zip(
+                    self._column("pair_a"), self._column("pair_b"),
+                    self._column("pair_n"))})
+        else:
+            setattr(self, name, Counter({p: n for p, n in zip(
+                self.names, self._column(name)) if n}))
+        return self.__dict__[name]
+
+    def _decode_events(self):
+        names = self.names
+        bye_results = [None] + self._column("bye_results").split("\n")
+        events = list()
+        # snapshot ids are the game table's ids, so games are copied over
+        # column by column
+        games = GameTable()
+        games.names = list(names)
+        games.ids = {name: pid for pid, name in enumerate(names)}
+        for etype, a, b, c in zip(self._column("etype"), self._column("ea"),
+                self._column("eb"), self._column("ec")):
+            etype = EVENT_TYPES[etype]
+            if etype == "seed":
+                info = (names[a], self.seeds[names[a]])
+            elif etype in ("remove", "add"):
+                info = (names[a],)
+            elif etype == "bye":
+                info = (names[a], bye_results[b])
+            elif etype == "game":
+                p1, p2 = names[a], names[b]
+                if c < 2:
+                    result = ("winner", (p1, p2)[c])
+                else:
+                    result = RESULTS[c]
+                info = (p1, p2, result)
+                games.p1.append(a)
+                games.p2.append(b)
+                games.result.append(c)
+            elif etype in ("force", "exclude"):
+                info = (names[a], names[b])
+            else:
+                info = a
+            events.append((etype, info))
+        self.events = tuple(events)
+        self.games = games
+
+    def __getstate__(self):
+        for name in LAZY:
+            getattr(self, name)
+        state = dict(self.__dict__)
+        del state["_map"]
+        del state["_sections"]
+        return state
+
+@timed("parse")
+def load_snapshot(path, digest=None):
+    """ Load a snapshot, or None if it's missing or doesn't match digest """
+    try:
+        snap_file = open(path, "rb")
+    except IOError:
+        return None
+    with snap_file:
+        if os.fstat(snap_file.fileno()).st_size < HEADER.size:
+            return None
+        snap_map = mmap.mmap(snap_file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, snap_digest, num_sections = HEADER.unpack_from(snap_map, 0)
+    if magic != MAGIC or (digest is not None and snap_digest != digest):
+        snap_map.close()
+        return None
+    sections = dict()
+    for ix in range(num_sections):
+        name, typecode, offset, size = SECTION.unpack_from(snap_map,
+                HEADER.size + ix * SECTION.size)
+        if offset + size > len(snap_map):
+            raise ValueError("Truncated tournament snapshot %s" % (path,))
+        sections[name.rstrip("\0")] = (typecode, offset, size)
+    return SnapshotTournament(snap_map, sections)
+
+def load_state(state_path, section=None):
+    """ Load a tournament state file through its snapshot
+
+    The snapshot is used when it matches the state file, otherwise the state
+    file is parsed and a new snapshot written next to it. A state file with
+    sections has a snapshot for each section and needs the section to load
+    given.
+    """
+    digest = file_digest(state_path)
+    snap_path = snapshot_path(state_path, section)
+    tourn = load_snapshot(snap_path, digest)
+    if tourn is None:
+        with open_state(state_path) as state_file:
+            if section is not None:
+                tourn = parse_tournament(state_file, section=section)
+            else:
+                sections = parse_sections(state_file)
+                if list(sections) != [None]:
+                    raise ValueError("State file %s has sections, pick one "
+                            "to load through a snapshot" % (state_path,))
+                tourn = sections[None]
+        write_snapshot(tourn, snap_path, digest)
+    return tourn
@@ -0,0 +1,159 @@
+
+""" Time the phases of a pairing run
+
+Code marks its phases with the timed decorator or a phase block. Nothing is
+measured until start() is called, a disabled phase costs a global lookup
+and a test, so the marks stay in place for normal runs. Phases can nest,
+each one is only charged for the time spent outside the phases it called.
+
+Phases run in worker processes are not seen by the parent's timer.
+"""
+
+import ctypes
+import ctypes.util
+import cProfile
+import functools
+import os
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _monotonic_clock():
+    """ time.monotonic, or clock_gettime(CLOCK_MONOTONIC) through ctypes
+    on Python 2, falling back to the wall clock if neither is there
+    """
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1",
+                use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    spec = _timespec()
+    def monotonic():
+        if clock_gettime(1, ctypes.byref(spec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return monotonic
+
+clock = _monotonic_clock()
+
+class PhaseTimer(object):
+    def __init__(self):
+        self.started = clock()
+        self.seconds = OrderedDict()
+        self.calls = OrderedDict()
+        # [phase, start, time spent in nested phases]
+        self.stack = list()
+
+    def enter(self, name):
+        self.stack.append([name, clock(), 0.0])
+
+    def exit(self):
+        name, start, nested = self.stack.pop()
+        elapsed = clock() - start
+        self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - nested
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def report(self, output=None):
+        """ Write the time and share of the run taken by each phase, to
+        stderr by default
+        """
+        if output is None:
+            output = sys.stderr
+        total = clock() - self.started
+        rows = list(self.seconds.items())
+        rows.append(("other", total - sum(self.seconds.values())))
+        output.write("# %-14s %6s %10s %7s\n" % ("phase", "calls",
+            "seconds", "share"))
+        for name, seconds in rows:
+            output.write("# %-14s %6s %10.4f %6.1f%%\n" % (name,
+                self.calls.get(name, ""), seconds,
+                100.0 * seconds / total if total else 0.0))
+        output.write("# %-14s %6s %10.4f\n" % ("total", "", total))
+
+_timer = None
+
+class _Phase(object):
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if _timer is not None:
+            _timer.enter(self.name)
+
+    def __exit__(self, etype, value, traceback):
+        if _timer is not None:
+            _timer.exit()
+
+_phases = dict()
+
+def phase(name):
+    """ A with block timed as phase name """
+    if name not in _phases:
+        _phases[name] = _Phase(name)
+    return _phases[name]
+
+def timed(name):
+    """ Decorator timing every call of a function as phase name """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _timer is None:
+                return func(*args, **kwargs)
+            _timer.enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _timer.exit()
+        return wrapper
+    return decorate
+
+def start():
+    """ Start timing phases, returns the PhaseTimer """
+    global _timer
+    _timer = PhaseTimer()
+    return _timer
+
+def current():
+    """ The running PhaseTimer, None when phases aren't being timed """
+    return _timer
+
+def stop():
+    global _timer
+    timer, _timer = _timer, None
+    return timer
+
+@contextmanager
+def profiling(table=False, dump=None):
+    """ Time the phases of the block and print the table to stderr, and
+    with dump write cProfile stats of the whole block to that file
+    """
+    if not table and not dump:
+        yield
+        return
+    profiler = None
+    if dump:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if table:
+        start()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(dump)
+        if table:
+            stop().report()
@@ -0,0 +1,38 @@
+#!/usr/bin/python
+
+import os.path
+import sys
+from argparse import ArgumentParser
+
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(_base_dir, "lib"))
+
+from metrics import print_report, read_metrics, summarize_metrics
+
+def parse_args(args=None):
+    parser = ArgumentParser(description="Summarize pairing metrics by "
+            "field size")
+    parser.add_argument("--bucket", type=int, default=16,
+            help="Number of field sizes grouped on each line")
+    parser.add_argument("--percentiles", metavar="PERCENTILES",
+            type=lambda s: [float(p) / 100 for p in s.split(",")],
+            default=[0.5, 0.9, 0.99],
+            help="Comma separated percentiles to print")
+    parser.add_argument("metrics_file",
+            help="JSON lines file written with --metrics")
+    args = parser.parse_args(args)
+    if args.bucket < 1:
+        print "Bucket must be at least 1"
+        parser.print_help()
+        sys.exit(1)
+    return args
+
+def main(args=None):
+    args = parse_args(args)
+    with open(args.metrics_file) as metrics_file:
+        records = read_metrics(metrics_file)
+    print_report(summarize_metrics(records, args.bucket, args.percentiles),
+            args.percentiles)
+
+if __name__ == "__main__":
+    main()
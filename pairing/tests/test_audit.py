@@ -0,0 +1,129 @@
+import cStringIO
+import random
+import sys
+import unittest
+
+import fte
+import audit
+import wc_swiss
+import wt_swiss
+from test_fte import random_field
+
+def played_state(script, args, rng, num_players, rounds):
+    """ A state file of rounds paired by script, the first board winning """
+    state = random_field(rng, num_players)
+    for round_num in range(1, rounds + 1):
+        pairings, bye = script.simulated_round(
+                script.parse_tournament(state), args)
+        state += "round %d\n" % (round_num,)
+        if bye is not None:
+            state += "bye %s\n" % (bye,)
+        for p1, p2 in pairings:
+            state += "game %s %s winner %s\n" % (p1, p2, p1)
+    return state
+
+def quiet_audit(results):
+    stdout = sys.stdout
+    sys.stdout = cStringIO.StringIO()
+    try:
+        return audit.print_audit(results), sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+class AuditTestCase(unittest.TestCase):
+    def setUp(self):
+        self.args = fte.parse_args(["state"])
+        self.state = played_state(fte, self.args, random.Random(6), 7, 3)
+        self.pair_func = lambda tourn: fte.simulated_round(tourn, self.args)
+
+    def test_round_prefixes(self):
+        tourn = fte.parse_tournament(self.state)
+        rounds = audit.round_prefixes(tourn.events)
+        self.assertEqual([r[0] for r in rounds], [1, 2, 3])
+        second = fte.parse_tournament(self.state.split("round 3")[0])
+        self.assertEqual(rounds[2][1].games, second.games)
+        self.assertEqual(rounds[2][1].wins, second.wins)
+        self.assertEqual(rounds[2][1].rounds, 2)
+        self.assertEqual(len(rounds[0][1].games), 0)
+        self.assertIsNone(rounds[0][1].rounds)
+        self.assertEqual(len(rounds[0][2][0]), 3)
+        self.assertIsNotNone(rounds[0][2][1])
+
+    def test_matches(self):
+        tourn = fte.parse_tournament(self.state)
+        results = audit.audit_rounds(tourn.events, self.pair_func, 2)
+        for round_num, recorded, paired, recoloured, error in results:
+            self.assertEqual(recorded, paired)
+            self.assertEqual(recoloured, [])
+            self.assertIsNone(error)
+
+    def test_differences(self):
+        lines = self.state.splitlines()
+        last = max(ix for ix, line in enumerate(lines)
+                if line.startswith("game"))
+        game, p1, p2, result, winner = lines[last].split()
+        lines[last] = " ".join([game, p2, p1, result, winner])
+        tourn = fte.parse_tournament("\n".join(lines) + "\n")
+        results = audit.audit_rounds(tourn.events, self.pair_func, 2)
+        self.assertEqual(results[-1][3], [(p2, p1)])
+        self.assertEqual([r[3] for r in results[:-1]], [[], []])
+
+    def test_failed_round(self):
+        def pair_func(tourn):
+            if tourn.rounds == 1:
+                raise ValueError("bad round")
+            return self.pair_func(tourn)
+        tourn = fte.parse_tournament(self.state)
+        results = audit.audit_rounds(tourn.events, pair_func, 2)
+        self.assertEqual([r[4] for r in results],
+                [None, "ValueError: bad round", None])
+        self.assertIsNone(results[1][2])
+        matched, output = quiet_audit(results)
+        self.assertFalse(matched)
+        self.assertIn("# round 2 could not be paired", output)
+        self.assertIn("# round 3 matches", output)
+
+    def test_constraints(self):
+        state = played_state(fte, self.args, random.Random(6), 8, 1)
+        free = self.pair_func(fte.parse_tournament(state))
+        constrained = self.pair_func(fte.parse_tournament(state
+            + "force player0 player1\nexclude player4 player5\n"))
+        self.assertNotEqual(sorted(free[0]), sorted(constrained[0]))
+        state += "force player0 player1\nround 2\nexclude player4 player5\n"
+        for p1, p2 in constrained[0]:
+            state += "game %s %s winner %s\n" % (p1, p2, p1)
+        tourn = fte.parse_tournament(state)
+        prefix = audit.round_prefixes(tourn.events)[1][1]
+        self.assertEqual(prefix.forced, (("player0", "player1"),))
+        self.assertEqual(prefix.excluded,
+                frozenset([frozenset(("player4", "player5"))]))
+        results = audit.audit_rounds(tourn.events, self.pair_func, 2)
+        self.assertEqual(results[1][1], constrained)
+        self.assertTrue(quiet_audit(results)[0])
+
+    def test_no_rounds(self):
+        tourn = fte.parse_tournament(random_field(random.Random(6), 4))
+        results = audit.audit_rounds(tourn.events, self.pair_func, 1)
+        self.assertEqual(results, [])
+        matched, output = quiet_audit(results)
+        self.assertFalse(matched)
+
+class ScriptAuditTestCase(unittest.TestCase):
+    def check_script(self, script, args):
+        state = played_state(script, args, random.Random(8), 8, 4)
+        tourn = script.parse_tournament(state)
+        results = audit.audit_rounds(tourn.events,
+                lambda tourn: script.simulated_round(tourn, args), 2)
+        self.assertEqual([r[0] for r in results], [1, 2, 3, 4])
+        for round_num, recorded, paired, recoloured, error in results:
+            self.assertIsNone(error)
+            self.assertEqual(len(recorded[0]), 4)
+            self.assertEqual(recorded, paired)
+        self.assertTrue(quiet_audit(results)[0])
+
+    def test_wt_swiss(self):
+        self.check_script(wt_swiss, wt_swiss.parse_args(["state"]))
+
+    def test_wc_swiss(self):
+        self.check_script(wc_swiss,
+                wc_swiss.parse_args(["state", "--prelives", "0"]))
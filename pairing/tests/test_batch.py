@@ -0,0 +1,50 @@
+
+import cStringIO
+import json
+import unittest
+
+import fte
+import batch
+from test_pair import tournament_state_good
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.args = fte.parse_args(["--batch"])
+
+    def test_run_batch(self):
+        requests = [
+                {"id": 1, "state": tournament_state_good},
+                {"id": 2, "state": tournament_state_good,
+                    "options": {"virtual": 0.25, "utpr": True}},
+                {"id": 3, "state": tournament_state_good,
+                    "options": {"seed_file": "other"}},
+                {"id": 4},
+                ]
+        lines = [json.dumps(r) + "\n" for r in requests]
+        output = cStringIO.StringIO()
+        batch.run_batch(lines + ["\n"],
+                lambda request: fte.batch_request(request, self.args),
+                2, output)
+        results = [json.loads(line)
+                for line in output.getvalue().splitlines()]
+        self.assertEqual([r["id"] for r in results], [1, 2, 3, 4])
+        expected = fte.simulated_round(
+                fte.parse_tournament(tournament_state_good), self.args)
+        self.assertEqual(sorted(tuple(pr) for pr in results[0]["pairings"]),
+                sorted(expected[0]))
+        self.assertEqual(results[0]["bye"], expected[1])
+        self.assertIn("pairings", results[1])
+        self.assertEqual(results[2]["error"],
+                "ValueError: Unknown option seed_file")
+        self.assertIn("error", results[3])
+
+    def test_cached_tournament(self):
+        batch._batch_init(None)
+        request = {"state": tournament_state_good}
+        tourn = batch.request_tournament(request)
+        fte.batch_request(request, self.args)
+        self.assertIs(batch.request_tournament(request), tourn)
+        # pairing worked on a copy, the lives view still has every player
+        view = tourn.views[("lives", 3)]
+        self.assertEqual(view.players, tourn.players)
+        self.assertTrue(view.rating_cache)
@@ -0,0 +1,109 @@
+
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+import fte
+import daemon
+from test_pair import tournament_state_good
+
+class DaemonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.args = fte.parse_args(["--serve", "socket"])
+        self.commands = fte.serve_commands(self.args)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def server(self, memory_cap=2 ** 20):
+        return daemon.PairingServer(self.commands, memory_cap,
+                [fte.LivesFilter(3)])
+
+    def test_lines(self):
+        server = self.server()
+        lines = tournament_state_good.splitlines()
+        response = server.handle({"tournament": "t", "lines": lines[:3]})
+        self.assertEqual(response, {"output": ""})
+        response = server.handle({"tournament": "t", "lines": lines[3:],
+            "command": "pair"})
+        expected = fte.simulated_round(
+                fte.parse_tournament(tournament_state_good), self.args)
+        self.assertIn("output", response)
+        for p1, p2 in expected[0]:
+            self.assertIn("game %s %s\n" % (p1, p2), response["output"])
+        # the result is kept until the tournament changes
+        entry = server.cache.get("t")
+        self.assertIn("pair", entry.results)
+        ranks = server.handle({"tournament": "t", "command": "ranks"})
+        self.assertTrue(ranks["output"].startswith("# 1 "))
+        bad = server.handle({"tournament": "t",
+            "lines": ["game player1 nobody winner player1"]})
+        self.assertIn("error", bad)
+        self.assertIn("pair", entry.results)
+        self.assertIn("error", server.handle({"tournament": "u",
+            "command": "pair"}))
+        self.assertIn("error", server.handle({"tournament": "t",
+            "command": "shuffle"}))
+
+    def test_path_and_eviction(self):
+        path = os.path.join(self.tmp_dir, "state")
+        with open(path, "w") as state_file:
+            state_file.write(tournament_state_good)
+        server = self.server(memory_cap=1)
+        response = server.handle({"tournament": "a", "path": path,
+            "command": "standings"})
+        self.assertTrue(response["output"].startswith("# Final ranks"))
+        server.handle({"tournament": "b",
+            "lines": tournament_state_good.splitlines()})
+        self.assertEqual(list(server.cache.entries), ["b"])
+        response = server.handle({"tournament": "a", "path": path,
+            "command": "standings"})
+        self.assertTrue(response["output"].startswith("# Final ranks"))
+
+    def test_empty_file(self):
+        path = os.path.join(self.tmp_dir, "state")
+        open(path, "w").close()
+        server = self.server()
+        response = server.handle({"tournament": "a", "path": path})
+        self.assertEqual(response, {"output": ""})
+        response = server.handle({"tournament": "a", "path": path,
+            "command": "standings"})
+        self.assertEqual(response, {"error": "Tournament has no players yet"})
+        with open(path, "w") as state_file:
+            state_file.write(tournament_state_good)
+        response = server.handle({"tournament": "a", "path": path,
+            "command": "standings"})
+        self.assertTrue(response["output"].startswith("# Final ranks"))
+        entry = server.cache.get("a", path)
+        self.assertEqual(entry.size,
+                daemon.EVENT_SIZE * len(entry.tourn.events))
+
+    def test_command_error(self):
+        def broken(tourn):
+            return tourn.no_such_thing
+        server = daemon.PairingServer(dict(self.commands, broken=broken),
+                2 ** 20)
+        response = server.handle({"tournament": "t",
+            "lines": tournament_state_good.splitlines(),
+            "command": "broken"})
+        self.assertTrue(response["error"].startswith("AttributeError"))
+        response = server.handle({"tournament": "t", "command": "standings"})
+        self.assertTrue(response["output"].startswith("# Final ranks"))
+
+    def test_socket(self):
+        address = os.path.join(self.tmp_dir, "socket")
+        server = daemon.make_server(address, self.commands, 2 ** 20)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            response = daemon.request(address, {"tournament": "t",
+                "lines": tournament_state_good.splitlines(),
+                "command": "standings"})
+            self.assertTrue(response["output"].startswith("# Final ranks"))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
@@ -0,0 +1,52 @@
+
+import random
+import unittest
+
+import fte
+import forecast
+from test_fte import random_field
+
+class ForecastTestCase(unittest.TestCase):
+    def setUp(self):
+        self.state = random_field(random.Random(2), 8) + """\
+game player0 player1 winner player0
+game player2 player3 winner player3
+"""
+        self.boards = [("player4", "player5"), ("player6", "player7")]
+
+    def test_probabilities(self):
+        tourn = fte.parse_tournament(self.state)
+        forecaster = forecast.Forecaster(3, 500)
+        chances = forecaster.forecast(tourn, self.boards)
+        self.assertEqual(sorted(chances), sorted(tourn.players))
+        for place in range(8):
+            self.assertAlmostEqual(sum(c[place] for c in chances.values()), 1)
+        for player_chances in chances.values():
+            self.assertAlmostEqual(sum(player_chances), 1)
+
+    def test_reuse(self):
+        forecaster = forecast.Forecaster(3, 500, seed=4)
+        forecaster.forecast(fte.parse_tournament(self.state), self.boards)
+        outcomes = list(forecaster.outcomes)
+        played = self.state + "game player5 player4 winner player5\n"
+        forecaster.forecast(fte.parse_tournament(played), self.boards)
+        kept = 0
+        for before, after in zip(outcomes, forecaster.outcomes):
+            self.assertFalse(after[0])
+            if not before[0]:
+                kept += 1
+                self.assertEqual(list(before), list(after))
+        self.assertGreater(kept, 0)
+        # a game off the boards means playing the futures from scratch
+        other = played + "game player0 player2 winner player0\n"
+        forecaster.forecast(fte.parse_tournament(other), self.boards)
+        self.assertEqual(forecaster.base[0],
+                fte.parse_tournament(other).events)
+
+    def test_exact(self):
+        args = fte.parse_args(["state"])
+        forecaster = forecast.Forecaster(3, 5,
+                pair_func=lambda tourn: fte.simulated_round(tourn, args))
+        chances = forecaster.forecast(fte.parse_tournament(self.state),
+                self.boards)
+        self.assertAlmostEqual(sum(c[0] for c in chances.values()), 1)
@@ -0,0 +1,216 @@
+
+import random
+import unittest
+
+import fte
+import pair
+from test_pair import check_full_matching
+
+def random_field(rng, num_players):
+    return "".join("player player%d %d\n" % (n, rng.randint(100, 200) * 10)
+            for n in range(num_players))
+
+class HistoryFreeTestCase(unittest.TestCase):
+    def check_scale(self, scale_class, wc2015):
+        rng = random.Random(2015)
+        config = fte.parse_args(["state"] + (["--wc2015"] if wc2015 else []))
+        closed_form = 0
+        for num_players in range(1, 16):
+            for trial in range(4):
+                tourn = fte.parse_tournament(random_field(rng, num_players))
+                fte.get_pairings(tourn, config)
+                scale = scale_class(config.lives, tourn)
+                closed_form += check_full_matching(self, tourn, scale)
+        self.assertGreater(closed_form, 20)
+
+    def test_fte_scale(self):
+        self.check_scale(fte.FTE_Scale, False)
+
+    def test_fte_2015_scale(self):
+        self.check_scale(fte.FTE_2015_Scale, True)
+
+    def test_fold_pairing(self):
+        tourn = fte.parse_tournament(random_field(random.Random(1), 5))
+        config = fte.parse_args(["state", "--wc2015"])
+        pairings, bye = fte.get_pairings(tourn, config)
+        ordered = sorted(tourn.players, key=lambda p: tourn.ranks[p])
+        self.assertEqual(bye, ordered[0])
+        self.assertEqual(set(frozenset(pr) for pr in pairings),
+                set([frozenset((ordered[1], ordered[4])),
+                    frozenset((ordered[2], ordered[3]))]))
+
+    def test_close_ratings(self):
+        tourn = fte.parse_tournament(
+                "player player1 1500\nplayer player2 1499.5\n")
+        config = fte.parse_args(["state"])
+        fte.get_pairings(tourn, config)
+        scale = fte.FTE_Scale(config.lives, tourn)
+        self.assertIsNone(scale.history_free_order(list(tourn.players)))
+
+    def test_tied_ratings(self):
+        # tied seeds leave several best pairings, the full matching's own
+        # choice has to be kept
+        tourn = fte.parse_tournament("".join("player p%02d %d\n" % (n, rating)
+            for n, rating in enumerate((1500, 1500, 1600, 1400, 1500, 1600,
+                1400, 1700))))
+        config = fte.parse_args(["state"])
+        fte.get_pairings(tourn, config)
+        scale = fte.FTE_Scale(config.lives, tourn)
+        self.assertFalse(check_full_matching(self, tourn, scale))
+
+    def test_truncated_squares(self):
+        # gaps of about 0.8 let truncating the squares pick another pairing
+        tourn = fte.parse_tournament("".join("player p%d %s\n" % (n, rating)
+            for n, rating in enumerate(("1500.0", "1500.772", "1501.539",
+                "1502.444", "1503.349", "1504.239"))))
+        config = fte.parse_args(["state"])
+        fte.get_pairings(tourn, config)
+        scale = fte.FTE_Scale(config.lives, tourn)
+        self.assertFalse(check_full_matching(self, tourn, scale))
+        widened = fte.parse_tournament("".join("player p%d %d\n" % (n,
+            1500 + 2 * n) for n in range(6)))
+        fte.get_pairings(widened, config)
+        scale = fte.FTE_Scale(config.lives, widened)
+        self.assertTrue(check_full_matching(self, widened, scale))
+
+class ScorePairingTestCase(unittest.TestCase):
+    def test_breakdown(self):
+        state = random_field(random.Random(3), 7) + """\
+game player0 player1 winner player0
+game player2 player3 winner player3
+game player4 player5 winner player4
+bye player6
+"""
+        tourn = fte.parse_tournament(state)
+        config = fte.parse_args(["state", "--wc2015"])
+        pairings, bye = fte.get_pairings(tourn, config)
+        scale = tourn.solution.scale
+        score = pair.score_pairing(tourn, scale, pairings, bye)
+        self.assertEqual(score.objective, score.optimum)
+        self.assertEqual(score.violations, [])
+        self.assertEqual([c for c, v in score.breakdown], [
+            "repeat pairings", "loss difference", "rank difference",
+            "fewest games", "bye losses", "bye rank"])
+        # no repeated pairings so each board adds (num_alive + 1) ** 0
+        self.assertEqual(score.breakdown[0][1], len(pairings))
+
+class SweepTestCase(unittest.TestCase):
+    def test_sweep_matches_single_runs(self):
+        state = random_field(random.Random(4), 7) + """\
+game player0 player4 winner player0
+game player1 player5 winner player5
+game player2 player6 winner player6
+bye player3
+"""
+        tourn = fte.filter_games(fte.parse_tournament(state), 3)
+        config = fte.parse_args(["state"])
+        variants = pair.sweep_variants(config, [0.25, 1.0],
+                ("utpr", "wc2015"))
+        self.assertEqual(len(variants), 8)
+        results = pair.sweep_pairings(tourn, fte.get_pairings, variants, 2)
+        for variant, (pairings, bye) in zip(variants, results):
+            single = fte.filter_games(fte.parse_tournament(state), 3)
+            single_pairings, single_bye = fte.get_pairings(single, variant)
+            single_pairings, arbitrary = pair.assign_colors(single,
+                    single_pairings)
+            self.assertEqual(bye, single_bye)
+            self.assertEqual(sorted(pairings), sorted(single_pairings))
+            self.assertEqual(pair.pairing_diff((pairings, bye),
+                (single_pairings, single_bye)), ([], []))
+
+    def test_single_virtual_split(self):
+        config = fte.parse_args(["state"])
+        variants = pair.sweep_variants(config, [0.5], ("utpr", "wc2015"))
+        tasks = pair._sweep_tasks(variants, 4)
+        self.assertEqual([[ix for ix, c in task] for task in tasks],
+                [[0], [1], [2], [3]])
+        variants = pair.sweep_variants(config, [0.25, 1.0],
+                ("utpr", "wc2015"))
+        tasks = pair._sweep_tasks(variants, 4)
+        self.assertEqual([[ix for ix, c in task] for task in tasks],
+                [[0, 1], [2, 3], [4, 5], [6, 7]])
+        self.assertEqual(len(pair._sweep_tasks(variants, 1)), 2)
+
+class SpeculateTestCase(unittest.TestCase):
+    def test_matches_single_runs(self):
+        state = random_field(random.Random(5), 7) + """\
+game player0 player4 winner player0
+bye player3
+"""
+        config = fte.parse_args(["state"])
+        def pair_round(tourn):
+            tourn = fte.filter_games(tourn, 3)
+            return fte.get_pairings(tourn, config)
+        tourn = fte.parse_tournament(state)
+        games = [("player1", "player5"), ("player2", "player6")]
+        results = pair.speculate_pairings(tourn, pair_round, games,
+                ["draw"], processes=2)
+        self.assertEqual(len(results), 9)
+        for p1, p2, result in [("player1", "player5", "winner player5"),
+                ("player1", "player5", "draw"),
+                ("player5", "player1", "winner player1")]:
+            played = state + "game %s %s %s\n" % (p1, p2, result) + \
+                    "game player2 player6 winner player6\n"
+            single = fte.parse_tournament(played)
+            key = pair.outcome_key(single.events[-2:])
+            if p1 != games[0][0]:
+                # not played with the published colours
+                self.assertNotIn(key, results)
+                continue
+            (pairings, bye), output = results[key]
+            self.assertEqual((pairings, bye), pair_round(single))
+
+class FilterGamesTestCase(unittest.TestCase):
+    def test_matches_reparse(self):
+        state = random_field(random.Random(7), 4) + """\
+game player0 player1 winner player0
+game player2 player3 winner player2
+game player1 player3 winner player1
+game player0 player2 winner player0
+game player1 player3 winner player1
+game player2 player3 draw
+"""
+        tourn = fte.parse_tournament(state)
+        filtered = fte.filter_games(tourn, 1)
+        self.assertEqual(len(filtered.games), 3)
+        self.assertEqual(len(tourn.games), 6)
+        expected = pair.from_eventlist(filtered.events)
+        for stat in ("played", "wins", "draws", "losses", "pair_counts",
+                "byes"):
+            self.assertEqual(getattr(filtered, stat), getattr(expected, stat))
+        self.assertEqual(tourn.played["player1"], 3)
+
+    def test_parsed_view(self):
+        state = random_field(random.Random(7), 4) + """\
+game player0 player1 winner player0
+game player2 player3 winner player2
+game player1 player3 winner player1
+game player0 player2 winner player0
+"""
+        tourn = fte.parse_tournament(state, [pair.LivesFilter(1)])
+        self.assertIn(("lives", 1), tourn.views)
+        self.assertIs(fte.filter_games(tourn, 1), tourn.views[("lives", 1)])
+        self.assertEqual(len(tourn.games), 4)
+        unfiltered = fte.parse_tournament(state)
+        filtered = fte.filter_games(unfiltered, 1)
+        self.assertEqual(filtered.games, tourn.views[("lives", 1)].games)
+        self.assertEqual(filtered.losses, tourn.views[("lives", 1)].losses)
+        with self.assertRaises(ValueError):
+            fte.parse_tournament(state + "game player1 player0 draw\n",
+                    [pair.LivesFilter(1)])
+
+    def test_pair_twice(self):
+        state = random_field(random.Random(9), 6) + """\
+game player0 player1 winner player0
+game player2 player3 winner player2
+game player4 player5 draw
+"""
+        tourn = fte.parse_tournament(state)
+        config = fte.parse_args(["state", "--lives", "1"])
+        first = fte.solve_round(fte.prepare(tourn, config), config)
+        self.assertEqual(fte.filter_games(tourn, 1).players, tourn.players)
+        second = fte.solve_round(fte.prepare(tourn, config), config)
+        self.assertEqual(first, second)
+        self.assertEqual(len(first["ranks"]), 6)
+        self.assertEqual(fte.simulated_round(tourn, config),
+                (first["pairings"], first["bye"]))
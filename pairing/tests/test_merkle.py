@@ -0,0 +1,81 @@
+
+import os.path
+import sys
+import unittest
+
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(_base_dir, "..", "lib"))
+
+import merkle
+import pair
+
+def make_events(count, changed=None):
+    events = list()
+    for ix in range(count):
+        winner = "player%d" % (ix % 7,)
+        if ix == changed:
+            winner = "player%d" % ((ix + 1) % 7,)
+        events.append(("game", ("player%d" % (ix % 7,),
+            "player%d" % ((ix + 1) % 7,), ("winner", winner))))
+    return events
+
+class EventDigestTestCase(unittest.TestCase):
+    def test_prefix_digests(self):
+        events = make_events(300)
+        log = merkle.EventDigest()
+        prefixes = [log.prefix()]
+        for event in events:
+            log.append(event)
+            prefixes.append(log.prefix())
+        self.assertEqual(len(set(prefixes)), len(prefixes))
+        for count in (0, 1, 63, 64, 65, 128, 200, 256, 299, 300):
+            self.assertEqual(log.prefix(count), prefixes[count])
+            self.assertEqual(merkle.EventDigest(events[:count]).prefix(),
+                    prefixes[count])
+        with self.assertRaises(ValueError):
+            log.prefix(301)
+
+    def test_first_difference(self):
+        base = merkle.EventDigest(make_events(500))
+        self.assertIsNone(base.first_difference(
+            merkle.EventDigest(make_events(500))))
+        for changed in (0, 63, 64, 130, 257, 499):
+            other = merkle.EventDigest(make_events(500, changed))
+            self.assertEqual(base.first_difference(other), changed)
+            self.assertEqual(other.first_difference(base), changed)
+        shorter = merkle.EventDigest(make_events(321))
+        self.assertEqual(base.first_difference(shorter), 321)
+        self.assertEqual(shorter.first_difference(base), 321)
+
+class TournamentDigestTestCase(unittest.TestCase):
+    state = """\
+player player1 1500
+player player2 1400
+player player3 1300
+round 1
+game player1 player2 winner player1
+bye player3
+round 2
+game player1 player3 winner player3
+bye player2
+"""
+
+    def test_state_digest(self):
+        tourn = pair.parse_tournament(self.state)
+        round_one = pair.parse_tournament(self.state.split("round 2")[0])
+        self.assertEqual(tourn.state_digest(1), round_one.state_digest())
+        self.assertNotEqual(tourn.state_digest(), round_one.state_digest())
+        with self.assertRaises(ValueError):
+            tourn.state_digest(2)
+
+    def test_follower_keeps_digest(self):
+        tourn = pair.parse_tournament(self.state)
+        parser = pair.StateParser()
+        lines = self.state.splitlines()
+        partial = pair.build_tournament(parser.state,
+                parser.iter_events(lines[:5]))
+        log = partial.event_digest
+        pair.build_tournament(parser.state, parser.iter_events(lines[5:]),
+                partial)
+        self.assertIs(partial.event_digest, log)
+        self.assertEqual(partial.state_digest(), tourn.state_digest())
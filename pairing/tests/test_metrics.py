@@ -0,0 +1,101 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import fte
+import metrics
+from mwmatching import maxWeightMatching
+from pair import capture_output
+from test_pair import tournament_state_good
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def pair(self, path, *options, **kwargs):
+        args = fte.parse_args(["--metrics", path] + list(options) +
+                ["state"])
+        tourn = fte.parse_tournament(kwargs.get("state",
+            tournament_state_good))
+        return capture_output(fte.pair_round, tourn, args)
+
+    def test_jsonl(self):
+        path = os.path.join(self.directory, "metrics.jsonl")
+        self.pair(path)
+        self.pair(path, "--virtual", "0.25")
+        with open(path) as metrics_file:
+            records = metrics.read_metrics(metrics_file)
+        self.assertEqual(len(records), 2)
+        record = records[0]
+        self.assertEqual(record["script"], "fte")
+        for name in ("players", "edges", "weight_bits", "matching_stages",
+                "rating_iterations", "seconds", "peak_memory_kb"):
+            self.assertGreater(record[name], 0)
+        self.assertIn("matching", record["phases"])
+        self.assertFalse(metrics.enabled())
+
+    def test_first_round(self):
+        path = os.path.join(self.directory, "metrics.jsonl")
+        self.pair(path, state="".join("player player%d %d\n" % (n,
+            1500 - 100 * n) for n in range(6)))
+        with open(path) as metrics_file:
+            records = metrics.read_metrics(metrics_file)
+        # paired from the seeds, without a matching
+        self.assertEqual(records[0]["players"], 6)
+        self.assertEqual(records[0]["edges"], 0)
+        self.assertNotIn("matching", records[0]["phases"])
+        summary = metrics.summarize_metrics(records)
+        self.assertEqual(summary[0][:2], ((1, 16), 1))
+        self.assertEqual(summary[0][2]["edges"], [0, 0, 0])
+
+    def test_cache_hit(self):
+        path = os.path.join(self.directory, "metrics.jsonl")
+        cache_dir = os.path.join(self.directory, "cache")
+        self.pair(path, "--cache-dir", cache_dir)
+        self.pair(path, "--cache-dir", cache_dir)
+        with open(path) as metrics_file:
+            first, second = metrics.read_metrics(metrics_file)
+        self.assertFalse(first["cached"])
+        self.assertTrue(second["cached"])
+        self.assertNotIn("players", second)
+
+    def test_prometheus(self):
+        path = os.path.join(self.directory, "pairing.prom")
+        self.pair(path)
+        with open(path) as metrics_file:
+            text = metrics_file.read()
+        self.assertIn("# TYPE pairing_edges gauge\n", text)
+        self.assertIn('pairing_phase_seconds{script="fte",phase="matching"}',
+                text)
+        self.assertEqual(os.listdir(self.directory), ["pairing.prom"])
+
+    def test_summarize(self):
+        records = [{"players": players, "edges": edges, "seconds": 1.0,
+            "phases": {"matching": edges / 10.0}}
+            for players, edges in ((4, 6), (16, 120), (17, 136), (30, 435),
+                (32, 496))]
+        records.append({"cached": True})
+        summary = metrics.summarize_metrics(records, 16, (0.5, 1.0))
+        self.assertEqual([(sizes, count) for sizes, count, stats in summary],
+                [((1, 16), 2), ((17, 32), 3)])
+        self.assertEqual(summary[1][2]["edges"], [435, 496])
+        self.assertEqual(summary[0][2]["matching"], [0.6, 12.0])
+        self.assertNotIn("weight_bits", summary[0][2])
+
+    def test_matching_stats(self):
+        stats = dict()
+        mate = maxWeightMatching([(0, 1, 5), (1, 2, 11), (2, 3, 5)], True,
+                stats=stats)
+        self.assertEqual(mate, [1, 0, 3, 2])
+        self.assertGreaterEqual(stats["stages"], 2)
+        self.assertGreaterEqual(stats["substages"], stats["stages"])
+        maxWeightMatching([], stats=stats)
+        self.assertEqual(stats, {"stages": 0, "substages": 0})
+
+if __name__ == "__main__":
+    unittest.main()
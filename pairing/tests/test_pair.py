@@ -1,6 +1,14 @@
 
+import bz2
+import cStringIO
+import gzip
+import hashlib
+import itertools
 import os.path
+import pickle
+import shutil
 import sys
+import tempfile
 import unittest
 
 _base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -8,6 +16,21 @@ sys.path.append(os.path.join(_base_dir, "..", "lib"))
 
 import pair
 
+class Blossom(object):
+    """ Hide a scale's closed form pairing to force the full matching """
+    def __init__(self, scale):
+        self.pair = scale.pair
+        self.bye = scale.bye
+
+def check_full_matching(test, tourn, scale):
+    """ Check weighted_pairing gives the boards of the full matching in the
+    same order, returns whether the scale's closed form was used
+    """
+    fast = pair.weighted_pairing(tourn, scale)
+    full = pair.weighted_pairing(tourn, Blossom(scale))
+    test.assertEqual(fast, full)
+    return scale.history_free_order(list(tourn.players)) is not None
+
 seeds_bad_rating = """
 player1 1234.0
 player2 abcdef
@@ -216,6 +239,24 @@ player player3 1234
 remove player3
 game player1 player3 winner player1
 """
+tournament_state_bad_force_1 = """\
+player player1 1234
+player player2 1234
+force player1 player3
+"""
+tournament_state_bad_force_2 = """\
+player player1 1234
+player player2 1234
+player player3 1234
+force player1 player2
+force player3 player1
+"""
+tournament_state_bad_exclude = """\
+player player1 1234
+player player2 1234
+remove player2
+exclude player1 player2
+"""
 bad_tournament_states = [
         tournament_state_bad_name,
         tournament_state_bad_rating,
@@ -229,6 +270,9 @@ bad_tournament_states = [
         tournament_state_bad_game_4,
         tournament_state_bad_game_5,
         tournament_state_bad_game_6,
+        tournament_state_bad_force_1,
+        tournament_state_bad_force_2,
+        tournament_state_bad_exclude,
         ]
 
 class ParseTestCase(unittest.TestCase):
@@ -274,3 +318,700 @@ class ParseTestCase(unittest.TestCase):
                 raise
 
 
+
+tournament_state_constraints = """\
+player player1 1400
+player player2 1300
+player player3 1200
+player player4 1100
+player player5 1000
+player player6 900
+round 1
+force player3 player4
+exclude player1 player6
+game player3 player4 winner player3
+round 2
+force player1 player2
+exclude player3 player5
+exclude player4 player6
+"""
+
+class RankScale(object):
+    """ Pair players as far apart in seed order as possible """
+    def __init__(self, tourn):
+        order = sorted(tourn.seeds, key=lambda p: -tourn.seeds[p])
+        self.ranks = {p: rank for rank, p in enumerate(order, start=1)}
+
+    def bye(self, player):
+        return len(self.ranks) - self.ranks[player]
+
+    def pair(self, p1, p2):
+        return len(self.ranks) ** 2 - (self.ranks[p1] - self.ranks[p2]) ** 2
+
+class ConstraintTestCase(unittest.TestCase):
+    def test_parse_constraints(self):
+        tourn = pair.parse_tournament(tournament_state_constraints)
+        self.assertEqual(tourn.forced, (("player1", "player2"),))
+        self.assertEqual(tourn.excluded, frozenset([
+            frozenset(("player3", "player5")),
+            frozenset(("player4", "player6")),
+            ]))
+        rebuilt = pair.from_eventlist(tourn.events)
+        self.assertEqual(rebuilt.forced, tourn.forced)
+        self.assertEqual(rebuilt.excluded, tourn.excluded)
+
+    def test_constrained_pairing(self):
+        tourn = pair.parse_tournament(tournament_state_constraints)
+        scale = RankScale(tourn)
+        pairings, bye = pair.weighted_pairing(tourn, scale, (), frozenset())
+        pairings = sorted(tuple(sorted(p)) for p in pairings)
+        self.assertEqual(pairings, [
+            ("player1", "player6"),
+            ("player2", "player5"),
+            ("player3", "player4"),
+            ])
+        pairings, bye = pair.weighted_pairing(tourn, scale)
+        pairings = sorted(tuple(sorted(p)) for p in pairings)
+        self.assertEqual(pairings, [
+            ("player1", "player2"),
+            ("player3", "player6"),
+            ("player4", "player5"),
+            ])
+        self.assertEqual(bye, None)
+
+    def test_unsatisfiable_constraints(self):
+        tourn = pair.parse_tournament(tournament_state_constraints)
+        scale = RankScale(tourn)
+        excluded = frozenset(frozenset(("player6", p))
+                for p in tourn.players if p != "player6")
+        with self.assertRaises(ValueError):
+            pair.weighted_pairing(tourn, scale, excluded=excluded)
+        tourn.players = tourn.players - frozenset(["player2"])
+        with self.assertRaises(ValueError):
+            pair.weighted_pairing(tourn, scale)
+
+class ScorePairingTestCase(unittest.TestCase):
+    def test_score_against_solve(self):
+        tourn = pair.parse_tournament(tournament_state_constraints)
+        scale = RankScale(tourn)
+        pairings, bye = pair.weighted_pairing(tourn, scale, (), frozenset())
+        score = pair.score_pairing(tourn, scale, pairings, bye)
+        self.assertEqual(score.objective, score.optimum)
+        self.assertTrue(score.is_optimal())
+        self.assertEqual(score.violations, [])
+        self.assertEqual(score.breakdown, [("pairs", score.objective)])
+
+        manual = [("player1", "player2"), ("player3", "player4"),
+                ("player5", "player6")]
+        score = pair.score_pairing(tourn, scale, manual)
+        self.assertTrue(score.objective > score.optimum)
+        self.assertFalse(score.is_optimal())
+        self.assertTrue(len(score.violations) > 0)
+
+    def test_solve_scores_each_edge_once(self):
+        tourn = pair.parse_tournament(tournament_state_constraints)
+        scale = RankScale(tourn)
+        calls = list()
+        def counted(p1, p2, pair=scale.pair):
+            calls.append((p1, p2))
+            return pair(p1, p2)
+        scale.pair = counted
+        pairings, bye = pair.weighted_pairing(tourn, scale, (), frozenset())
+        num = len(tourn.players)
+        self.assertEqual(len(calls), num * (num - 1) // 2)
+        # the objective is only worked out when a candidate is scored
+        pair.score_pairing(tourn, scale, pairings, bye)
+        self.assertTrue(len(calls) > num * (num - 1) // 2)
+
+    def test_score_without_solve(self):
+        tourn = pair.parse_tournament(tournament_state_constraints)
+        scale = RankScale(tourn)
+        manual = [("player1", "player2"), ("player3", "player4"),
+                ("player5", "player6")]
+        score = pair.score_pairing(tourn, scale, manual)
+        self.assertEqual(score.optimum, None)
+        self.assertEqual(score.violations, None)
+        self.assertEqual(score.is_optimal(), None)
+
+    def test_bad_candidate(self):
+        tourn = pair.parse_tournament(tournament_state_constraints)
+        scale = RankScale(tourn)
+        with self.assertRaises(ValueError):
+            pair.score_pairing(tourn, scale, [("player1", "player2")])
+        with self.assertRaises(ValueError):
+            pair.score_pairing(tourn, scale, [("player1", "player2"),
+                ("player3", "player4"), ("player5", "player1")], "player6")
+
+tournament_state_sections = """\
+section open
+player player1 1500
+player player2 1400
+section u1400
+player player1 1300
+player player3 1200
+section open
+game player1 player2 winner player2
+round 1
+section u1400
+game player3 player1 winner player3
+"""
+
+class SectionsTestCase(unittest.TestCase):
+    def test_parse_sections(self):
+        sections = pair.parse_sections(tournament_state_sections)
+        self.assertEqual(list(sections), ["open", "u1400"])
+        self.assertEqual(sections["open"].games,
+                (("player1", "player2", ("winner", "player2")),))
+        self.assertEqual(sections["open"].rounds, 1)
+        self.assertEqual(sections["u1400"].seeds,
+                {"player1": 1300, "player3": 1200})
+        self.assertEqual(sections["u1400"].wins["player3"], 1)
+        self.assertEqual(list(pair.parse_sections(tournament_state_good)),
+                [None])
+
+    def test_parse_tournament(self):
+        tourn = pair.parse_tournament(tournament_state_sections,
+                section="u1400")
+        self.assertEqual(tourn.players, frozenset(["player1", "player3"]))
+        with self.assertRaises(ValueError):
+            pair.parse_tournament(tournament_state_sections)
+        with self.assertRaises(ValueError):
+            pair.parse_tournament(tournament_state_sections, section="u1200")
+        with self.assertRaises(ValueError):
+            pair.parse_sections("player player9 1000\n"
+                    + tournament_state_sections)
+
+    def test_pair_sections(self):
+        sections = pair.parse_sections(tournament_state_sections)
+        def pair_func(tourn):
+            print "players", len(tourn.players)
+            return sorted(tourn.players)
+        results = pair.pair_sections(sections, pair_func, 2)
+        self.assertEqual(list(results), ["open", "u1400"])
+        self.assertEqual(results["u1400"],
+                (["player1", "player3"], "players 2\n"))
+
+class StreamingParseTestCase(unittest.TestCase):
+    def test_line_iterables(self):
+        tourn = pair.parse_tournament(
+                iter(tournament_state_good.splitlines(True)))
+        self.assertEqual(tourn.events, tournament_state_good_eventlist)
+        self.assertEqual(tourn.games, tournament_state_good_games)
+        tourn = pair.parse_tournament(unicode(tournament_state_early_stop))
+        self.assertEqual(tourn.events, tournament_state_early_stop_eventlist)
+
+    def test_iter_events(self):
+        parser = pair.StateParser()
+        events = parser.iter_events(tournament_state_good.splitlines())
+        self.assertEqual(next(events), tournament_state_good_eventlist[0])
+        self.assertEqual(parser.state.players, set(["player1"]))
+        self.assertEqual(tuple(events), tournament_state_good_eventlist[1:])
+        self.assertEqual(parser.state.players, tournament_state_good_players)
+
+    def test_from_eventlist(self):
+        tourn = pair.from_eventlist(tournament_state_good_eventlist)
+        self.assertEqual(tourn.players, tournament_state_good_players)
+        self.assertEqual(tourn.games, tournament_state_good_games)
+        with self.assertRaises(ValueError):
+            pair.from_eventlist([("add", ("player1",))])
+
+    def test_compressed_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for name, opener in (("state.gz", gzip.open),
+                    ("state.bz2", bz2.BZ2File), ("state", open)):
+                path = os.path.join(tmp_dir, name)
+                with opener(path, "wb") as state_file:
+                    state_file.write(tournament_state_good)
+                with pair.open_state(path) as state_file:
+                    tourn = pair.parse_tournament(state_file)
+                self.assertEqual(tourn.events,
+                        tournament_state_good_eventlist)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+class StateFollowerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "state")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, data, mode="wb"):
+        with open(self.path, mode) as state_file:
+            state_file.write(data)
+
+    def test_appended_lines(self):
+        split = tournament_state_good.index("remove player2")
+        self.write(tournament_state_good[:split + len("remove pla")])
+        follower = pair.StateFollower(self.path)
+        self.assertEqual(len(follower.update()), 6)
+        self.assertEqual(follower.offset, split)
+        self.write(tournament_state_good[split + len("remove pla"):], "ab")
+        new_events = follower.update()
+        self.assertEqual(tuple(follower.events),
+                tournament_state_good_eventlist)
+        self.assertEqual(new_events[0], ("remove", ("player2",)))
+        self.assertEqual(follower.update(), [])
+        tourn = follower.tournament()
+        self.assertEqual(tourn.games, tournament_state_good_games)
+        self.assertEqual(tourn.players, tournament_state_good_players)
+
+    def test_edited_prefix(self):
+        self.write(tournament_state_good)
+        follower = pair.StateFollower(self.path)
+        follower.update()
+        self.write(tournament_state_good.replace("1200", "1201"))
+        self.assertIsNone(follower.update())
+        self.assertEqual(follower.tournament().seeds["player2"], 1201)
+        offset = follower.offset
+        self.write("player player1 1234.5\ngame player1 player9 draw\n")
+        with self.assertRaises(ValueError):
+            follower.update()
+        # a state that doesn't validate leaves the follower as it was
+        self.assertEqual(follower.offset, offset)
+        self.assertEqual(follower.tournament().seeds["player2"], 1201)
+
+    def test_save_load(self):
+        self.write(tournament_state_good)
+        follower = pair.StateFollower(self.path)
+        follower.update()
+        save_path = self.path + ".follow"
+        follower.save(save_path)
+        loaded = pair.StateFollower.load(save_path, self.path)
+        self.assertEqual(loaded.offset, follower.offset)
+        self.assertEqual(loaded.update(), [])
+        other = pair.StateFollower.load(save_path, self.path + "2")
+        self.assertEqual(other.offset, 0)
+
+    def test_follow_state(self):
+        self.write("player p1 1500\nplayer p2 1400\nplayer p3 1300\n")
+        rounds = list()
+        def pair_round(tourn):
+            rounds.append(tourn.games)
+            if len(rounds) == 1:
+                self.write("game p1 p2 winner p1\n", "ab")
+                return [("p1", "p2")], "p3"
+            return [], None
+        pair.follow_state(self.path, pair_round, 0, polls=2)
+        # the bye for the first round was never recorded
+        self.assertEqual(len(rounds), 1)
+        self.write("bye p3\n", "ab")
+        pair.follow_state(self.path, pair_round, 0, polls=2)
+        self.assertEqual(rounds[-1], (("p1", "p2", ("winner", "p1")),))
+
+    def test_follow_edits(self):
+        state = "player p1 1500\nplayer p2 1400\nplayer p3 1300\n" \
+                "player p4 1200\n"
+        self.write(state)
+        rounds = list()
+        def pair_round(tourn):
+            rounds.append(tourn.games)
+            if len(rounds) == 1:
+                self.write("game p1 p2 winner p1\n", "ab")
+                return [("p1", "p2"), ("p3", "p4")], None
+            return [], None
+        reports = list()
+        def report(tourn, pairings):
+            reports.append(len(tourn.games))
+            if len(reports) == 2:
+                # correct a seed and add a comment with p3 p4 still to play
+                self.write(state.replace("1400", "1401") + "# round one\n"
+                        "game p1 p2 winner p1\n")
+        pair.follow_state(self.path, pair_round, 0, polls=3, report=report)
+        self.assertEqual(len(rounds), 1)
+        self.assertEqual(reports, [0, 1, 1])
+        # a restarted watcher keeps waiting for the same round
+        pair.follow_state(self.path, pair_round, 0, polls=1)
+        self.assertEqual(len(rounds), 1)
+        self.write("game p3 p4 winner p3\n", "ab")
+        pair.follow_state(self.path, pair_round, 0, polls=1)
+        self.assertEqual(len(rounds), 2)
+        self.assertEqual(len(rounds[-1]), 2)
+
+    def test_speculate(self):
+        self.write("player p1 1500\nplayer p2 1400\n"
+                "player p3 1300\nplayer p4 1200\n")
+        rounds = list()
+        def pair_round(tourn):
+            rounds.append(tourn.games)
+            if not tourn.games:
+                self.write("game p3 p4 winner p4\ngame p1 p2 winner p1\n",
+                        "ab")
+                return [("p1", "p2"), ("p3", "p4")], None
+            print " ".join(sorted(g[2][1] for g in tourn.games))
+            return [], None
+        stdout = sys.stdout
+        sys.stdout = output = cStringIO.StringIO()
+        try:
+            pair.follow_state(self.path, pair_round, 0, polls=2,
+                    speculate=2, processes=2)
+        finally:
+            sys.stdout = stdout
+        # the second round was paired in the worker processes
+        self.assertEqual(len(rounds), 1)
+        self.assertEqual(output.getvalue(), "p1 p4\n")
+
+    def test_follow_bad_line(self):
+        self.write("player p1 1500\nplayer p2 1400\n")
+        rounds = list()
+        def pair_round(tourn):
+            rounds.append(tourn.games)
+            if len(rounds) == 1:
+                self.write("game p1 p9 winner p1\n", "ab")
+                return [("p1", "p2")], None
+            return [], None
+        stderr = sys.stderr
+        sys.stderr = errors = cStringIO.StringIO()
+        try:
+            pair.follow_state(self.path, pair_round, 0, polls=3)
+        finally:
+            sys.stderr = stderr
+        # reported once, and the watcher kept polling
+        self.assertEqual(len(errors.getvalue().splitlines()), 1)
+        self.assertIn(self.path, errors.getvalue())
+        self.assertEqual(len(rounds), 1)
+        self.write("player p1 1500\nplayer p2 1400\n"
+                "game p1 p2 winner p1\n")
+        pair.follow_state(self.path, pair_round, 0, polls=1)
+        self.assertEqual(len(rounds), 2)
+
+    def test_speculate_after_edit(self):
+        state = "player p1 1500\nplayer p2 1400\nplayer p3 1300\n" \
+                "player p4 1200\n"
+        self.write(state)
+        rounds = list()
+        def pair_round(tourn):
+            rounds.append(tourn.games)
+            if not tourn.games:
+                self.write("game p3 p4 winner p3\n", "ab")
+                return [("p1", "p2"), ("p3", "p4")], None
+            print " ".join(sorted(g[2][1] for g in tourn.games))
+            return [], None
+        def report(tourn, pairings):
+            if tourn.games:
+                # the result of p3 p4 is corrected as p1 p2 is recorded
+                self.write(state + "game p3 p4 winner p4\n"
+                        "game p1 p2 winner p1\n")
+        stdout = sys.stdout
+        sys.stdout = output = cStringIO.StringIO()
+        try:
+            pair.follow_state(self.path, pair_round, 0, polls=3,
+                    speculate=2, processes=2, report=report)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(len(rounds), 1)
+        self.assertEqual(output.getvalue(), "p1 p4\n")
+
+    def test_speculate_swapped_colours(self):
+        self.write("player p1 1500\nplayer p2 1400\n"
+                "player p3 1300\nplayer p4 1200\n")
+        rounds = list()
+        def pair_round(tourn):
+            rounds.append(tourn.games)
+            if not tourn.games:
+                self.write("game p4 p3 winner p4\ngame p1 p2 winner p1\n",
+                        "ab")
+                return [("p1", "p2"), ("p3", "p4")], None
+            return [], None
+        stdout = sys.stdout
+        sys.stdout = cStringIO.StringIO()
+        try:
+            pair.follow_state(self.path, pair_round, 0, polls=2,
+                    speculate=2, processes=2)
+        finally:
+            sys.stdout = stdout
+        # p4 had gold instead of p3, so the round was paired again here
+        self.assertEqual(len(rounds), 2)
+        self.assertEqual(rounds[-1][0][:2], ("p4", "p3"))
+
+class SpeculateTestCase(unittest.TestCase):
+    def test_outcomes(self):
+        outcomes = pair.pending_outcomes([("a", "b"), ("c", "d")],
+                ["draw"], [("bye", ("e", None))])
+        self.assertEqual(len(outcomes), 9)
+        self.assertEqual(len(set(pair.outcome_key(o) for o in outcomes)), 9)
+        self.assertTrue(all(o[-1] == ("bye", ("e", None)) for o in outcomes))
+        keys = set(pair.outcome_key(o) for o in outcomes)
+        key = pair.outcome_key([("bye", ("e", "loss")),
+            ("game", ("c", "d", ("draw",))),
+            ("game", ("a", "b", ("winner", "a")))])
+        self.assertIn(key, keys)
+        swapped = pair.outcome_key([("bye", ("e", "loss")),
+            ("game", ("d", "c", ("draw",))),
+            ("game", ("a", "b", ("winner", "a")))])
+        self.assertNotIn(swapped, keys)
+
+class IncrementalStatsTestCase(unittest.TestCase):
+    def stats(self, tourn):
+        return (tourn.played, tourn.wins, tourn.draws, tourn.losses,
+                tourn.pair_counts, tourn.byes)
+
+    def test_matches_rebuild(self):
+        tourn = pair.parse_tournament(tournament_state_good)
+        incremental = self.stats(tourn)
+        tourn.update_stats()
+        self.assertEqual(incremental, self.stats(tourn))
+        self.assertEqual(tourn.pair_counts[
+            frozenset(("player1", "player2"))], 2)
+
+    def test_revert(self):
+        tourn = pair.parse_tournament(tournament_state_good)
+        copied = tourn.copy()
+        for event in tournament_state_good_eventlist:
+            copied.revert_event(event)
+        self.assertEqual(self.stats(copied), self.stats(pair.Tournament()))
+        self.assertEqual(tourn.played["player1"], 4)
+
+    def test_correct_game(self):
+        tourn = pair.parse_tournament(tournament_state_good)
+        tourn.rating_cache["key"] = "stale"
+        old = tournament_state_good_games[0]
+        new = ("player1", "player2", ("winner", "player2"))
+        tourn.correct_game(old, new)
+        self.assertEqual(tourn.rating_cache, dict())
+        self.assertEqual(tourn.wins["player2"], 1)
+        self.assertEqual(tourn.losses["player1"], 2)
+        self.assertEqual(tourn.played["player1"], 4)
+
+class GameTableTestCase(unittest.TestCase):
+    def test_sequence(self):
+        table = pair.GameTable(tournament_state_good_games)
+        self.assertEqual(table, tournament_state_good_games)
+        self.assertEqual(len(table), len(tournament_state_good_games))
+        self.assertEqual(table[-1], tournament_state_good_games[-1])
+        self.assertEqual(table[1:3], tournament_state_good_games[1:3])
+        self.assertEqual(table.names,
+                ["player1", "player2", "player3", "player4"])
+        longer = table + (("player1", "player5", ("draw",)),)
+        self.assertEqual(len(table), len(tournament_state_good_games))
+        self.assertEqual(longer[-1], ("player1", "player5", ("draw",)))
+        self.assertNotEqual(longer, table)
+        copied = pickle.loads(pickle.dumps(table, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copied, table)
+        self.assertEqual(copied.ids, table.ids)
+
+    def test_counts(self):
+        table = pair.GameTable(tournament_state_good_games)
+        played, wins, draws, losses, pairs = table.counts()
+        self.assertEqual(played, [4, 3, 3, 4])
+        self.assertEqual(wins, [2, 0, 2, 0])
+        self.assertEqual(draws, [1, 1, 0, 0])
+        self.assertEqual(losses, [1, 1, 0, 2])
+        self.assertEqual(pairs[(0, 1)], 2)
+        self.assertEqual(pairs.get((2, 3)), 1)
+
+class AdjacencyTestCase(unittest.TestCase):
+    def test_index(self):
+        tourn = pair.parse_tournament(tournament_state_good)
+        adjacency = tourn.adjacency
+        self.assertEqual(adjacency.opponents["player1"],
+                {"player2": 2, "player3": 1, "player4": 1})
+        self.assertEqual(adjacency.gold_count("player1", "player2"), 1)
+        self.assertEqual(adjacency.gold_count("player2", "player1"), 1)
+        self.assertEqual(adjacency.extra_gold["player1"], 0)
+        # the vacated game between player4 and player3 is left out
+        self.assertEqual(adjacency.colors["player3"],
+                [pair.GOLD, pair.SILVER])
+        self.assertEqual(adjacency.streaks("player2"), (2, 0))
+        self.assertEqual(adjacency.streaks("player3"), (0, 1))
+        self.assertEqual(adjacency.last_gold[
+            frozenset(("player1", "player2"))], "player2")
+
+    def test_maintained(self):
+        tourn = pair.parse_tournament(tournament_state_good)
+        built = tourn.adjacency
+        game = ("player3", "player1", ("winner", "player1"))
+        tourn.apply_event(("game", game))
+        self.assertIs(tourn.adjacency, built)
+        self.assertEqual(built.streaks("player3"), (1, 0))
+        self.assertEqual(built.opponents["player1"]["player3"], 2)
+        copied = tourn.copy()
+        copied.revert_event(("game", game))
+        self.assertIsNot(copied.adjacency, built)
+        self.assertEqual(built.opponents["player1"]["player3"], 2)
+
+def earlier_color(tourn, p1, p2):
+    """ The arbitrary colours of p1 and p2 as earlier versions drew them """
+    tourn_hash = hashlib.sha256()
+    tourn_hash.update("\n".join(sorted(tourn.players)))
+    tourn_hash.update("\n")
+    tourn_hash.update("\n".join(sorted("%s %s" % g[:2] for g in tourn.games)))
+    def board_hash(gold, silver):
+        board = tourn_hash.copy()
+        board.update("\n%s %s" % (gold, silver))
+        return int(board.hexdigest(), 16)
+    if board_hash(p2, p1) < board_hash(p1, p2):
+        return (p2, p1)
+    return (p1, p2)
+
+class ColorTestCase(unittest.TestCase):
+    def test_arbitrary_as_earlier(self):
+        fresh = pair.parse_tournament("".join("player player%d %d\n" % (
+            n, 1500 - n) for n in range(1, 9)))
+        played = pair.parse_tournament(tournament_state_good)
+        played.players = played.players | frozenset(("player5", "player6"))
+        for tourn in (fresh, played):
+            boards = list(itertools.combinations(sorted(tourn.players), 2))
+            colored, arbitrary = pair.assign_colors(tourn, boards)
+            self.assertTrue(arbitrary)
+            for game in arbitrary:
+                self.assertEqual(game, earlier_color(tourn, *game))
+
+tournament_state_rounds = """\
+player player1 1500
+player player2 1400
+player player3 1300
+player player4 1200
+round 1
+game player1 player2 winner player1
+game player3 player4 winner player3
+round 2
+game player1 player3 winner player1
+game player2 player4 draw
+round 3
+remove player4
+game player2 player1 winner player2
+bye player3
+round 4
+game player3 player1 winner player3
+"""
+
+class RoundCheckpointsTestCase(unittest.TestCase):
+    def assertSameState(self, tourn, expected):
+        for attr in ("events", "players", "seeds", "games", "byes", "rounds",
+                "played", "wins", "draws", "losses", "pair_counts"):
+            self.assertEqual(getattr(tourn, attr), getattr(expected, attr),
+                    "%s differs" % (attr,))
+        for attr in ("opponents", "gold", "extra_gold", "colors", "streak",
+                "last_gold"):
+            self.assertEqual(getattr(tourn.adjacency, attr),
+                    getattr(expected.adjacency, attr), "%s differs" % (attr,))
+        self.assertEqual(tourn.state_digest(), expected.state_digest())
+
+    def test_correct_earlier_round(self):
+        events = pair.parse_tournament(tournament_state_rounds).events
+        log = pair.RoundCheckpoints(events)
+        self.assertSameState(log.tournament(),
+                pair.from_eventlist(events))
+        position = events.index(("game",
+            ("player1", "player3", ("winner", "player1"))))
+        fixed = ("game", ("player1", "player3", ("winner", "player3")))
+        replayed = log.correct(position, [fixed])
+        self.assertEqual(replayed, len(events) - events.index(("round", 2)))
+        corrected = list(events)
+        corrected[position] = fixed
+        self.assertSameState(log.tournament(), pair.from_eventlist(corrected))
+        # dropping a game and adding it back
+        log.correct(position, [])
+        del corrected[position]
+        self.assertSameState(log.tournament(), pair.from_eventlist(corrected))
+
+    def test_invalid_correction(self):
+        events = pair.parse_tournament(tournament_state_rounds).events
+        log = pair.RoundCheckpoints(events)
+        position = events.index(("remove", ("player4",)))
+        with self.assertRaises(ValueError):
+            log.correct(position, [("remove", ("player5",))])
+        self.assertSameState(log.tournament(), pair.from_eventlist(events))
+        with self.assertRaises(ValueError):
+            log.correct(len(events), [])
+
+    def test_ratings_kept(self):
+        events = pair.parse_tournament(tournament_state_rounds).events
+        round_three = events.index(("round", 3))
+        log = pair.RoundCheckpoints(events[:round_three + 1])
+        tourn = log.tournament()
+        ratings = pair.cached_rate(tourn.seeds, tourn, 0.5)
+        log.extend(events[round_three + 1:])
+        position = events.index(("bye", ("player3", None)))
+        log.correct(position, [])
+        self.assertEqual(log.checkpoints[2][5].values(), [ratings])
+        self.assertEqual(log.checkpoints[3][5], dict())
+
+class StateDiffTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "state")
+        self.follower = pair.StateFollower(self.path)
+        self.update(tournament_state_rounds)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def update(self, state):
+        with open(self.path, "wb") as state_file:
+            state_file.write(state)
+        return self.follower.update()
+
+    def assertParsed(self, state):
+        tourn = self.follower.tournament()
+        expected = pair.parse_tournament(state)
+        self.assertEqual(tourn.events, expected.events)
+        self.assertEqual(tourn.games, expected.games)
+        self.assertEqual(tourn.players, expected.players)
+        self.assertEqual(tourn.losses, expected.losses)
+        self.assertEqual(tourn.adjacency.streak, expected.adjacency.streak)
+        self.assertEqual(tourn.state_digest(), expected.state_digest())
+
+    def test_append(self):
+        state = tournament_state_rounds + "bye player2\n"
+        self.assertEqual(self.update(state), [("bye", ("player2", None))])
+        self.assertEqual(self.follower.change, "append")
+        self.assertParsed(state)
+
+    def test_local_edits(self):
+        state = tournament_state_rounds.replace(
+                "game player1 player3 winner player1",
+                "game player1 player3 winner player3")
+        self.assertIsNone(self.update(state))
+        self.assertEqual(self.follower.change, "edit")
+        self.assertParsed(state)
+        state = state.replace("round 3\n", "round 3\nremove player1\n"
+                "add player1\n# late entry\n")
+        self.assertIsNone(self.update(state))
+        self.assertEqual(self.follower.change, "edit")
+        self.assertParsed(state)
+        state = state.replace("# late entry\n", "")
+        self.update(state)
+        self.assertEqual(self.follower.change, "edit")
+        self.assertParsed(state)
+
+    def test_structural(self):
+        state = tournament_state_rounds.replace("round 3\n", "stop\n")
+        self.assertIsNone(self.update(state))
+        self.assertEqual(self.follower.change, "structural")
+        self.assertParsed(state)
+        self.assertEqual(self.update(state + "game player1 player2 draw\n"),
+                [])
+        self.assertEqual(self.follower.change, "append")
+        self.assertParsed(state)
+        with self.assertRaises(ValueError):
+            self.update(state.replace("player player2", "player player5"))
+        self.assertParsed(state)
+
+    def test_failed_append(self):
+        with self.assertRaises(ValueError):
+            self.update(tournament_state_rounds + "round 5\n"
+                    "game player1 player9 draw\n")
+        self.assertParsed(tournament_state_rounds)
+        state = tournament_state_rounds + "round 5\n"
+        self.assertEqual(self.update(state), [("round", 5)])
+        self.assertParsed(state)
+
+    def test_edited(self):
+        state = tournament_state_rounds.replace("round 2\n",
+                "# second round\nround 2\n")
+        self.assertEqual(self.update(state), [])
+        state = state.replace("game player2 player4 draw",
+                "game player2 player4 winner player4")
+        events = list(self.follower.events)
+        self.assertIsNone(self.update(state))
+        changed = events.index(("game", ("player2", "player4", ("draw",))))
+        self.assertEqual(self.follower.edited,
+                (changed, changed + 1, changed + 1))
+        self.assertIsNone(self.update(state.replace("round 3\n", "stop\n")))
+        self.assertEqual(self.follower.change, "structural")
+        self.assertEqual(self.follower.edited[0],
+                events.index(("round", 3)))
@@ -0,0 +1,67 @@
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import fte
+import result_cache
+from pair import capture_output
+from test_pair import tournament_state_good
+
+class ResultCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def pair(self, *options):
+        args = fte.parse_args(["--cache-dir", self.directory] +
+                list(options) + ["state"])
+        tourn = fte.parse_tournament(tournament_state_good)
+        return capture_output(fte.pair_round, tourn, args)
+
+    def test_hit(self):
+        first = self.pair("--ranks", "--show-arbitrary")
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        get_pairings = fte.get_pairings
+        def fail(tourn, config):
+            self.fail("get_pairings called on a cache hit")
+        fte.get_pairings = fail
+        try:
+            self.assertEqual(self.pair("--ranks", "--show-arbitrary"), first)
+        finally:
+            fte.get_pairings = get_pairings
+        plain = capture_output(fte.pair_round,
+                fte.parse_tournament(tournament_state_good),
+                fte.parse_args(["--ranks", "--show-arbitrary", "state"]))
+        self.assertEqual(first, plain)
+
+    def test_options_in_key(self):
+        self.pair()
+        self.pair("--ranks")
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.pair("--virtual", "0.25")
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_trim(self):
+        cache = result_cache.ResultCache(self.directory, 0)
+        cache.put("a", "x" * 100)
+        self.assertIsNone(cache.get("a"))
+        cache.max_size = 1000
+        for age, key in enumerate(("c", "b", "a")):
+            cache.put(key, "x" * 100)
+            os.utime(cache.path(key), (time.time(), time.time() - 10 - age))
+        cache.max_size = 250
+        # reading a result makes it the most recently used
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("d", "x" * 100)
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNone(cache.get("c"))
+        self.assertIsNotNone(cache.get("d"))
+
+if __name__ == "__main__":
+    unittest.main()
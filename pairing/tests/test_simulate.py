@@ -0,0 +1,59 @@
+
+import cStringIO
+import random
+import sys
+import unittest
+
+import fte
+import simulate
+import wc_swiss
+
+class SimulateTestCase(unittest.TestCase):
+    def test_win_probability(self):
+        self.assertAlmostEqual(simulate.win_probability(1500, 1500), 0.5)
+        self.assertAlmostEqual(simulate.win_probability(1900, 1500),
+                10 / 11.0)
+        self.assertAlmostEqual(simulate.win_probability(1500, 1700)
+                + simulate.win_probability(1700, 1500), 1)
+
+    def test_fte_runs_to_the_end(self):
+        args = fte.parse_args(["--simulate", "1"])
+        result = simulate.simulate_tournament(
+                lambda tourn: fte.simulated_round(tourn, args), 9,
+                random.Random(3))
+        # the eight eliminated players lost three games each
+        self.assertGreaterEqual(result["games"], 8 * 3)
+        self.assertLessEqual(result["top_losses"], 3)
+
+    def test_wc_swiss_plays_games(self):
+        args = wc_swiss.parse_args(["--simulate", "2", "--prelives", "0"])
+        results = simulate.simulate_tournaments(
+                lambda tourn: wc_swiss.simulated_round(tourn, args), 2, 8,
+                rounds=args.rounds, processes=1)
+        self.assertEqual([r["rounds"] for r in results], [args.rounds] * 2)
+        self.assertEqual([r["games"] for r in results], [4 * args.rounds] * 2)
+        # the default prelives would leave a simulated field unpaired
+        stdout = sys.stdout
+        sys.stdout = cStringIO.StringIO()
+        try:
+            with self.assertRaises(SystemExit):
+                wc_swiss.parse_args(["--simulate", "2"])
+        finally:
+            sys.stdout = stdout
+
+    def test_deterministic(self):
+        args = fte.parse_args(["--simulate", "4"])
+        def pair_func(tourn):
+            return fte.simulated_round(tourn, args)
+        single = simulate.simulate_tournaments(pair_func, 4, 6, 11,
+                processes=1)
+        pooled = simulate.simulate_tournaments(pair_func, 4, 6, 11,
+                processes=3)
+        self.assertEqual(single, pooled)
+        rounds = simulate.simulate_tournaments(pair_func, 4, 6, 11, 2,
+                processes=2)
+        self.assertEqual([r["rounds"] for r in rounds], [2] * 4)
+        summary = simulate.summarize(single)
+        self.assertEqual(summary["simulations"], 4)
+        self.assertEqual(summary["games"],
+                sum(r["games"] for r in single) / 4.0)
@@ -0,0 +1,93 @@
+
+import os.path
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(_base_dir, "..", "lib"))
+
+import pair
+import snapshot
+
+tournament_state = """\
+player player1 1234.5
+player player2 1200
+player player3 1150.3
+player player4 1100.2
+round 1
+game player1 player2 winner player1
+pair player3 player4 winner player4
+round 2
+remove player2
+bye player3 win
+pick player4 player1 double loss
+round 3
+add player2
+game player1 player3 double win
+game player2 player4 draw
+force player1 player4
+exclude player2 player3
+"""
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tmp_dir, "state")
+        with open(self.state_path, "w") as state_file:
+            state_file.write(tournament_state)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assertSameTournament(self, loaded, tourn):
+        for attr in ("events", "players", "seeds", "games", "byes", "rounds",
+                "forced", "excluded", "played", "wins", "draws", "losses",
+                "pair_counts"):
+            self.assertEqual(getattr(loaded, attr), getattr(tourn, attr),
+                    "%s differs" % (attr,))
+
+    def test_round_trip(self):
+        tourn = pair.parse_tournament(tournament_state)
+        digest = snapshot.file_digest(self.state_path)
+        snap_path = snapshot.snapshot_path(self.state_path)
+        snapshot.write_snapshot(tourn, snap_path, digest)
+        loaded = snapshot.load_snapshot(snap_path, digest)
+        self.assertTrue("events" not in loaded.__dict__)
+        self.assertSameTournament(loaded, tourn)
+        self.assertSameTournament(pickle.loads(pickle.dumps(
+            snapshot.load_snapshot(snap_path, digest))), tourn)
+        self.assertEqual(snapshot.load_snapshot(snap_path, "x" * 32), None)
+        self.assertEqual(snapshot.load_snapshot(snap_path + ".none"), None)
+
+    def test_load_state(self):
+        snap_path = snapshot.snapshot_path(self.state_path)
+        tourn = snapshot.load_state(self.state_path)
+        self.assertTrue(os.path.exists(snap_path))
+        self.assertSameTournament(tourn, pair.parse_tournament(
+            tournament_state))
+        loaded = snapshot.load_state(self.state_path)
+        self.assertTrue(isinstance(loaded, snapshot.SnapshotTournament))
+        self.assertSameTournament(loaded, tourn)
+        with open(self.state_path, "a") as state_file:
+            state_file.write("game player2 player3 winner player3\n")
+        loaded = snapshot.load_state(self.state_path)
+        self.assertFalse(isinstance(loaded, snapshot.SnapshotTournament))
+        self.assertEqual(len(loaded.games), len(tourn.games) + 1)
+
+    def test_load_section(self):
+        with open(self.state_path, "w") as state_file:
+            state_file.write("section open\n" + tournament_state
+                    + "section other\nplayer player9 1000\n")
+        with self.assertRaises(ValueError):
+            snapshot.load_state(self.state_path)
+        for section, players in (("open", 4), ("other", 1)):
+            tourn = snapshot.load_state(self.state_path, section)
+            self.assertEqual(len(tourn.players), players)
+            loaded = snapshot.load_state(self.state_path, section)
+            self.assertTrue(isinstance(loaded, snapshot.SnapshotTournament))
+            self.assertSameTournament(loaded, tourn)
+        self.assertNotEqual(snapshot.snapshot_path(self.state_path, "open"),
+                snapshot.snapshot_path(self.state_path, "other"))
@@ -0,0 +1,79 @@
+
+import cStringIO
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import unittest
+
+import fte
+import timing
+from test_pair import tournament_state_good
+
+class TimingTestCase(unittest.TestCase):
+    def tearDown(self):
+        timing.stop()
+
+    def test_nested_phases(self):
+        now = [0.0]
+        clock = timing.clock
+        timing.clock = lambda: now[0]
+        try:
+            timer = timing.start()
+            with timing.phase("outer"):
+                now[0] += 1
+                with timing.phase("inner"):
+                    now[0] += 2
+                with timing.phase("inner"):
+                    now[0] += 2
+                now[0] += 1
+            now[0] += 4
+            output = cStringIO.StringIO()
+            timer.report(output)
+        finally:
+            timing.clock = clock
+        self.assertEqual(timer.seconds, {"outer": 2.0, "inner": 4.0})
+        self.assertEqual(timer.calls, {"outer": 1, "inner": 2})
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[3].split(), ["#", "other", "4.0000", "40.0%"])
+        self.assertEqual(lines[4].split(), ["#", "total", "10.0000"])
+
+    def test_disabled(self):
+        @timing.timed("func")
+        def func(value):
+            return value + 1
+        self.assertEqual(func(1), 2)
+        with timing.phase("block"):
+            pass
+        timer = timing.start()
+        self.assertEqual(func(2), 3)
+        self.assertEqual(list(timer.seconds), ["func"])
+
+    def test_profile_run(self):
+        directory = tempfile.mkdtemp()
+        try:
+            state_path = os.path.join(directory, "state")
+            with open(state_path, "w") as state_file:
+                state_file.write(tournament_state_good)
+            dump = os.path.join(directory, "stats")
+            stderr = sys.stderr
+            sys.stderr = cStringIO.StringIO()
+            try:
+                fte.capture_output(fte.main, ["--profile", "--profile-dump",
+                    dump, state_path])
+                table = sys.stderr.getvalue()
+            finally:
+                sys.stderr = stderr
+            phases = [line.split()[1] for line in table.splitlines()]
+            for name in ("parse", "rate", "matching", "assign_colors",
+                    "total"):
+                self.assertIn(name, phases)
+            stats = pstats.Stats(dump)
+            self.assertTrue(any(func[2] == "weighted_pairing"
+                for func in stats.stats))
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,12 @@
 
 import os.path
+import random
 import sys
 import unittest
 
+import pair
 import wc_swiss
+from test_pair import check_full_matching
 
 simple_r1 = """\
 player player1 1400
@@ -108,3 +111,15 @@ class FilterPlayersTestCase(unittest.TestCase):
         wc_swiss.filter_players(tourn, 3)
         self.assertEqual(tourn.players, frozenset(["player3", "player4"]))
 
+class HistoryFreeTestCase(unittest.TestCase):
+    def test_matches_full_matching(self):
+        rng = random.Random(2015)
+        for num_players in range(1, 16):
+            for trial in range(4):
+                tourn = wc_swiss.parse_tournament("".join(
+                    "player player%d %d\n" % (n, rng.randint(1000, 2000))
+                    for n in range(num_players)))
+                wc_swiss.get_pairings(tourn,
+                        wc_swiss.parse_args(["state", "--wc2015"]))
+                scale = wc_swiss.Swiss_2015_Scale(tourn)
+                self.assertTrue(check_full_matching(self, tourn, scale))
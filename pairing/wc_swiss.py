@@ -10,9 +10,19 @@ _base_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(_base_dir, "lib"))
 
 from pair import (
-        assign_colors, parse_seeds, parse_history, parse_tournament,
-        rate, weighted_pairing,
+        assign_colors, cached_rate, capture_output, combine_terms,
+        follow_state, open_state, pair_sections, pairing_diff, parse_seeds,
+        parse_history, parse_sections, parse_tournament, sweep_pairings,
+        sweep_variants, weighted_pairing,
         )
+from audit import audit_rounds, print_audit
+from batch import apply_options, request_tournament, run_batch
+from daemon import make_server
+from metrics import last_round, recording
+from result_cache import cached_result
+from simulate import print_summary, simulate_tournaments, summarize
+from snapshot import load_state
+from timing import profiling
 
 class Swiss_Scale(object):
     """
@@ -48,40 +58,52 @@ class Swiss_Scale(object):
             self.num_with_losses[0] = len(tourn.players)
 
     def bye(self, player):
+        return combine_terms(self.bye_terms(player))
+
+    def bye_terms(self, player):
         num_alive = self.num_alive
+        rating_mul = int(math.sqrt(self.rating_range) * 1000) + 1
 
-        # 2 bye to fewest bye player
-        weight = self.tourn.byes[player]
-        # 3 descending order of N, minimize number of pairings for Nth time
-        weight *= self.pair_mul
-        # 4 descending order of N, minimize pairings with losses differing by N
-        weight *= (num_alive + 1) ** (self.most_losses + 1)
-        # 5 bye to most losses
-        weight *= (self.most_losses + 1)
-        weight += self.most_losses - self.tourn.losses[player]
-        # 6 maximize sqrt rating difference
-        weight *= int(math.sqrt(self.rating_range) * 1000) + 1
-        return weight
+        return [
+                # 2 bye to fewest bye player
+                ("fewest byes", 1, self.tourn.byes[player]),
+                # 3 descending order of N, minimize number of pairings for Nth time
+                ("repeat pairings", self.pair_mul, 0),
+                # 4 descending order of N, minimize pairings with losses differing by N
+                ("loss difference", (num_alive + 1) ** (self.most_losses + 1), 0),
+                # 5 bye to most losses
+                ("bye losses", self.most_losses + 1,
+                    self.most_losses - self.tourn.losses[player]),
+                # 6 maximize sqrt rating difference
+                ("rating difference", rating_mul, 0),
+                ]
 
     def pair(self, p1, p2):
+        weight = combine_terms(self.pair_terms(p1, p2))
+        print p1, p2, weight
+        return weight
+
+    def pair_terms(self, p1, p2):
         num_alive = self.num_alive
         losses = self.tourn.losses
+        rating_mul = int(math.sqrt(self.rating_range) * 1000) + 1
 
-        # 3 descending order of N, minimize number of pairings for Nth time
-        weight = (num_alive + 1) ** self.tourn.pair_counts[frozenset((p1, p2))]
-        # 4 descending order of N, minimize pairings with losses differing by N
-        weight *= (num_alive + 1) ** (self.most_losses + 1)
-        weight += (num_alive + 1) ** abs(losses[p1] - losses[p2])
-        # 5 bye to most losses
-        weight *= (self.most_losses + 1)
-        # 6 maximize sqrt rating difference
-        # need integer weights
-        # FIXME: this might break with small stpr differences
-        weight *= int(math.sqrt(self.rating_range) * 1000) + 1
-        weight += int(math.sqrt(self.rating_range) * 1000) + 1 - int(
-                math.sqrt(abs(self.tourn.stpr[p1] - self.tourn.stpr[p2])) * 1000)
-        print p1, p2, weight
-        return weight
+        return [
+                # 3 descending order of N, minimize number of pairings for Nth time
+                ("repeat pairings", 1,
+                    (num_alive + 1) ** self.tourn.pair_counts[frozenset((p1, p2))]),
+                # 4 descending order of N, minimize pairings with losses differing by N
+                ("loss difference", (num_alive + 1) ** (self.most_losses + 1),
+                    (num_alive + 1) ** abs(losses[p1] - losses[p2])),
+                # 5 bye to most losses
+                ("bye losses", self.most_losses + 1, 0),
+                # 6 maximize sqrt rating difference
+                # need integer weights
+                # FIXME: this might break with small stpr differences
+                ("rating difference", rating_mul, rating_mul - int(
+                    math.sqrt(abs(self.tourn.stpr[p1] - self.tourn.stpr[p2]))
+                    * 1000)),
+                ]
 
 class Swiss_2015_Scale(object):
     """
@@ -118,59 +140,82 @@ class Swiss_2015_Scale(object):
             self.num_with_losses[0] = len(tourn.players)
 
     def bye(self, player):
+        return combine_terms(self.bye_terms(player))
+
+    def bye_terms(self, player):
         num_alive = self.num_alive
 
-        # 2 bye to fewest bye player
-        weight = self.tourn.byes[player]
-        # 3 descending order of N, minimize number of pairings for Nth time
-        weight *= self.pair_mul
-        # 4 bye to most losses
-        weight *= (self.most_losses + 1)
-        weight += self.most_losses - self.tourn.losses[player]
-        # 5 descending order of N, minimize pairings with losses differing by N
-        weight *= (num_alive + 1) ** (self.most_losses + 1)
-        # 6 bye to worst ranked
-        weight *= (num_alive + 1)
-        weight += self.num_alive - self.tourn.ranks[player]
-        # 7 minimize rank differences
-        weight *= (num_alive ** 2) + 1
-        return weight
+        return [
+                # 2 bye to fewest bye player
+                ("fewest byes", 1, self.tourn.byes[player]),
+                # 3 descending order of N, minimize number of pairings for Nth time
+                ("repeat pairings", self.pair_mul, 0),
+                # 4 bye to most losses
+                ("bye losses", self.most_losses + 1,
+                    self.most_losses - self.tourn.losses[player]),
+                # 5 descending order of N, minimize pairings with losses differing by N
+                ("loss difference", (num_alive + 1) ** (self.most_losses + 1), 0),
+                # 6 bye to worst ranked
+                ("bye rank", num_alive + 1,
+                    self.num_alive - self.tourn.ranks[player]),
+                # 7 minimize rank differences
+                ("rank difference", (num_alive ** 2) + 1, 0),
+                ]
 
     def pair(self, p1, p2):
+        return combine_terms(self.pair_terms(p1, p2))
+
+    def pair_terms(self, p1, p2):
         num_alive = self.num_alive
         losses = self.tourn.losses
 
-        # 3 descending order of N, minimize number of pairings for Nth time
-        weight = (num_alive + 1) ** self.tourn.pair_counts[frozenset((p1, p2))]
-        # 4 bye to most losses
-        weight *= (self.most_losses + 1)
-        # 5 descending order of N, minimize pairings with losses differing by N
-        weight *= (num_alive + 1) ** (self.most_losses + 1)
-        weight += (num_alive + 1) ** abs(losses[p1] - losses[p2])
-        # 6 bye to worst ranked
-        weight *= (num_alive + 1)
-        # 7 minimize rank differences
-        weight *= (num_alive ** 2) + 1
         rank_difference = abs(self.tourn.ranks[p1] - self.tourn.ranks[p2])
         if losses[p1] == losses[p2]:
-            weight += abs(rank_difference - (
+            rank_weight = abs(rank_difference - (
                 self.num_with_losses[losses[p1]] / 2.))
         else:
-            weight += (rank_difference) ** 2
-        return weight
+            rank_weight = (rank_difference) ** 2
+        return [
+                # 3 descending order of N, minimize number of pairings for Nth time
+                ("repeat pairings", 1,
+                    (num_alive + 1) ** self.tourn.pair_counts[frozenset((p1, p2))]),
+                # 4 bye to most losses
+                ("bye losses", self.most_losses + 1, 0),
+                # 5 descending order of N, minimize pairings with losses differing by N
+                ("loss difference", (num_alive + 1) ** (self.most_losses + 1),
+                    (num_alive + 1) ** abs(losses[p1] - losses[p2])),
+                # 6 bye to worst ranked
+                ("bye rank", num_alive + 1, 0),
+                # 7 minimize rank differences
+                ("rank difference", (num_alive ** 2) + 1, rank_weight),
+                ]
+
+    def history_free_order(self, players):
+        """ Before any games everyone has the same losses, pairing each player
+        with the one half the field further down gets every pair as close to
+        the target rank difference as possible. Needs the whole field with
+        consecutive ranks.
+        """
+        ranks = self.tourn.ranks
+        ordered = sorted(players, key=lambda p: ranks[p])
+        if (len(ordered) != self.num_alive
+                or self.num_with_losses[0] != self.num_alive
+                or [ranks[p] for p in ordered] != range(1, len(ordered) + 1)):
+            return None
+        return ordered, "slide"
 
 def filter_players(tourn, min_loss):
     players = [p for p in tourn.players if tourn.losses[p] >= min_loss]
     tourn.players = frozenset(players)
 
-def get_pairings(tourn, config):
+def rank_players(tourn, config):
+    """ Rate the players and set their order and rank on tourn """
     virtual = config.virtual if hasattr(config, "virtual") else 0.5
     use_utpr = config.utpr if hasattr(config, "utpr") else False
-    use_2015 = config.wc2015 if hasattr(config, "wc2015") else False
 
-    stpr = rate(tourn.seeds, tourn, virtual)
+    stpr = cached_rate(tourn.seeds, tourn, virtual)
     if use_utpr:
-        utpr = rate({p: 1500 for p in tourn.seeds}, tourn, virtual)
+        utpr = cached_rate({p: 1500 for p in tourn.seeds}, tourn, virtual)
         def order(p):
             return (tourn.losses[p], -utpr[p], -stpr[p])
     else:
@@ -180,6 +225,11 @@ def get_pairings(tourn, config):
     sorted_players = sorted(tourn.players, key=order)
     tourn.stpr = stpr
     tourn.ranks = {p: rank for rank, p in enumerate(sorted_players, start=1)}
+
+def get_pairings(tourn, config):
+    use_2015 = config.wc2015 if hasattr(config, "wc2015") else False
+
+    rank_players(tourn, config)
     if use_2015:
         scale = Swiss_2015_Scale(tourn)
     else:
@@ -187,6 +237,67 @@ def get_pairings(tourn, config):
     pairings, bye = weighted_pairing(tourn, scale)
     return pairings, bye
 
+def print_ranks(tourn):
+    players = sorted(tourn.players, key=lambda p: tourn.ranks[p])
+    for p in players:
+        print "#", tourn.ranks[p], p, tourn.player_order[p]
+
+def print_sweep(tourn, args):
+    variants = sweep_variants(args, args.sweep, ("utpr", "wc2015"))
+    results = sweep_pairings(tourn, get_pairings, variants, args.processes)
+    for variant, result in zip(variants, results):
+        flags = [f for f in ("utpr", "wc2015") if getattr(variant, f)]
+        print " ".join(["# virtual", str(variant.virtual)] + flags)
+        pairings, bye = result
+        if bye:
+            print "bye", bye
+        for p1, p2 in pairings:
+            print "game", p1, p2
+        removed, added = pairing_diff(results[0], result)
+        if removed or added:
+            print "# %d boards differ from first variant" % (len(removed),)
+            for board in removed:
+                print "# -", " ".join(board)
+            for board in added:
+                print "# +", " ".join(board)
+
+def print_sections(sections, args):
+    """ Pair every section at once and print them in order """
+    if args.sweep or args.audit:
+        print "Pick a section with --section"
+        sys.exit(1)
+    results = pair_sections(sections, lambda tourn: pair_round(tourn, args),
+            args.processes)
+    for name, (result, output) in results.items():
+        print "# section", name
+        sys.stdout.write(output)
+
+BATCH_OPTIONS = ("prelives", "virtual", "utpr", "wc2015", "ranks",
+        "show_arbitrary")
+
+def batch_request(request, args):
+    """ Pair one --batch request """
+    config = apply_options(args, request.get("options", {}), BATCH_OPTIONS)
+    tourn = request_tournament(request)
+    (pairings, bye), output = capture_output(pair_round,
+            tourn.working_copy(), config)
+    return {"pairings": pairings, "bye": bye, "output": output}
+
+def serve_commands(args):
+    """ The commands answered by --serve, standings rank every player """
+    def ranks(tourn):
+        tourn = prepare(tourn, args)
+        rank_players(tourn, args)
+        print_ranks(tourn)
+    def standings(tourn):
+        rank_players(tourn, args)
+        print_ranks(tourn)
+    return {
+            "pair": lambda tourn: pair_round(tourn, args),
+            "ranks": ranks,
+            "standings": standings,
+            }
+
 def parse_args(args=None):
     parser = ArgumentParser(description="Pair FTE tournament")
     parser.add_argument("-v", "--virtual", help="Virtual game weight",
@@ -203,10 +314,72 @@ def parse_args(args=None):
     parser.add_argument("--show-arbitrary",
             help="Indicate arbitrary color assignments",
             action="store_true")
+    parser.add_argument("--sweep", metavar="VIRTUALS",
+            type=lambda s: [float(v) for v in s.split(",")],
+            help="Compare pairings for each comma separated virtual weight "
+            "with and without --utpr and --wc2015")
+    parser.add_argument("--processes", type=int,
+            help="Number of worker processes for --sweep, --speculate, "
+            "--simulate, --audit, --batch and state files with sections, by "
+            "default one per CPU")
     parser.add_argument("--seed_file", "--seeds",
             help="aaaa style player seeds")
     parser.add_argument("--history_file", "--games",
             help="aaaa style tournament history")
+    parser.add_argument("--snapshot",
+            help="Load the state through a binary snapshot kept next to it",
+            action="store_true")
+    parser.add_argument("--follow",
+            help="Keep following the state file, pairing each round as soon "
+            "as the previous one is complete", action="store_true")
+    parser.add_argument("--interval",
+            help="Seconds between checks of the state file with --follow",
+            type=float, default=5.0)
+    parser.add_argument("--speculate", metavar="GAMES", type=int, default=0,
+            help="With --follow, pair the next round for every outcome once "
+            "no more than this many games are left")
+    parser.add_argument("--speculate-results", metavar="RESULTS",
+            type=lambda s: s.split(","), default=[],
+            help="Comma separated results besides a win to speculate on, "
+            "like draw")
+    parser.add_argument("--batch",
+            help="Pair the JSON requests read from each line of stdin",
+            action="store_true")
+    parser.add_argument("--serve", metavar="ADDRESS",
+            help="Keep running and answer pairing requests on this Unix "
+            "socket path or host:port")
+    parser.add_argument("--memory-cap", metavar="MB", type=float,
+            default=512, help="Memory for tournaments kept by --serve")
+    parser.add_argument("--cache-dir", metavar="DIR",
+            help="Keep pairings in this directory and print them from there "
+            "when the same state is paired with the same options again")
+    parser.add_argument("--cache-size", metavar="MB", type=float,
+            default=64, help="Size limit of --cache-dir")
+    parser.add_argument("--profile",
+            help="Print the time taken by each phase of the run to stderr",
+            action="store_true")
+    parser.add_argument("--profile-dump", metavar="FILE",
+            help="Write cProfile stats of the whole run to this file")
+    parser.add_argument("--metrics", metavar="FILE",
+            help="Append the size and cost of pairing each round to this "
+            "file, see metrics_report.py")
+    parser.add_argument("--metrics-format", choices=("jsonl", "prometheus"),
+            help="Format of --metrics, by default prometheus for a .prom "
+            "file and JSON lines otherwise")
+    parser.add_argument("--section",
+            help="Only use this section of a state file with sections")
+    parser.add_argument("--audit",
+            help="Pair every round of the state file again and report where "
+            "the recorded games differ", action="store_true")
+    parser.add_argument("--simulate", metavar="COUNT", type=int,
+            help="Simulate this many tournaments of random players paired "
+            "with these options and print summary statistics")
+    parser.add_argument("--field-size", type=int, default=16,
+            help="Number of players in each simulated tournament")
+    parser.add_argument("--rounds", type=int, default=6,
+            help="Rounds per simulated tournament")
+    parser.add_argument("--sim-seed", type=int, default=0,
+            help="Base random seed for --simulate")
     parser.add_argument("tournament_state", help="Tournament state file",
             nargs="?")
     args = parser.parse_args(args)
@@ -214,35 +387,116 @@ def parse_args(args=None):
         print "Cannot use both regular tournament state file and aaaa style"
         parser.print_help()
         sys.exit(1)
+    if args.simulate and args.prelives > 0:
+        # simulated players start without losses, so nobody would be paired
+        print "Simulated tournaments have no preliminary losses, " \
+                "use --prelives 0"
+        parser.print_help()
+        sys.exit(1)
+    if args.simulate or args.serve or args.batch:
+        return args
     if not args.seed_file and not args.tournament_state:
         print "Must give tournament state"
         parser.print_help()
         sys.exit(1)
+    if (args.follow or args.audit) and not args.tournament_state:
+        print "Can only follow or audit a tournament state file"
+        parser.print_help()
+        sys.exit(1)
     return args
 
 def main(args=None):
     args = parse_args(args)
+    with profiling(args.profile, args.profile_dump):
+        run(args)
+
+def run(args):
+    if args.batch:
+        run_batch(sys.stdin, lambda request: batch_request(request, args),
+                args.processes)
+        return
+    if args.serve:
+        server = make_server(args.serve, serve_commands(args),
+                args.memory_cap * 2 ** 20, ())
+        server.serve_forever()
+        return
+    if args.simulate:
+        results = simulate_tournaments(
+                lambda tourn: simulated_round(tourn, args), args.simulate,
+                args.field_size, args.sim_seed, args.rounds, args.processes)
+        print_summary(summarize(results))
+        return
+    if args.follow:
+        follow_state(args.tournament_state,
+                lambda tourn: pair_round(tourn, args), args.interval,
+                speculate=args.speculate, results=args.speculate_results,
+                processes=args.processes)
+        return
     if args.tournament_state:
-        with open(args.tournament_state) as state_file:
-            tourn = parse_tournament(state_file.read())
+        if args.snapshot:
+            tourn = load_state(args.tournament_state, args.section)
+        else:
+            with open_state(args.tournament_state) as state_file:
+                if args.section is not None:
+                    tourn = parse_tournament(state_file,
+                            section=args.section)
+                else:
+                    sections = parse_sections(state_file)
+            if args.section is None:
+                if list(sections) != [None]:
+                    print_sections(sections, args)
+                    return
+                tourn = sections[None]
     else:
-        with open(args.seed_file) as seed_file:
-            tourn = parse_seeds(seed_file.read())
+        with open_state(args.seed_file) as seed_file:
+            tourn = parse_seeds(seed_file)
         if args.history_file:
-            with open(args.history_file) as history_file:
-                parse_history(tourn, history_file.read())
+            with open_state(args.history_file) as history_file:
+                parse_history(tourn, history_file)
+
+    if args.audit:
+        audit = audit_rounds(tourn.events,
+                lambda tourn: simulated_round(tourn, args), args.processes)
+        if not print_audit(audit):
+            sys.exit(1)
+        return
+    if args.sweep:
+        print_sweep(prepare(tourn, args), args)
+        return
+    pair_round(tourn, args)
 
+def prepare(tourn, args):
     if args.prelives > 0:
         filter_players(tourn, args.prelives)
-    pairings, bye = get_pairings(tourn, args)
-    if args.ranks:
-        players = sorted(tourn.players, key=lambda p: tourn.ranks[p])
-        for p in players:
-            print "#", tourn.ranks[p], p, tourn.player_order[p]
+    return tourn
 
-    pairings, arbitrary = assign_colors(tourn, pairings)
+def pairing_options(args):
+    """ The options that change the pairing, for the --cache-dir key """
+    return {"prelives": args.prelives, "virtual": args.virtual,
+            "utpr": args.utpr, "wc2015": args.wc2015}
 
+def solve_round(tourn, args):
+    """ The coloured pairings, bye and ranks of the next round """
+    pairings, bye = get_pairings(tourn, args)
+    pairings, arbitrary = assign_colors(tourn, pairings)
     pairings.sort(key=lambda pr: min(tourn.ranks[pr[0]], tourn.ranks[pr[1]]))
+    return {"pairings": pairings, "bye": bye, "arbitrary": arbitrary,
+            "ranks": tourn.ranks, "player_order": tourn.player_order}
+
+def pair_round(tourn, args):
+    """ Pair and print the next round, returns its pairings and bye """
+    tourn = prepare(tourn, args)
+    with recording(args.metrics, args.metrics_format, script="wc_swiss",
+            round=last_round(tourn.events)):
+        result, output = cached_result(tourn, pairing_options(args), args,
+                __file__, lambda: solve_round(tourn, args))
+    sys.stdout.write(output)
+    tourn.ranks = result["ranks"]
+    tourn.player_order = result["player_order"]
+    pairings, bye = result["pairings"], result["bye"]
+    arbitrary = result["arbitrary"]
+    if args.ranks:
+        print_ranks(tourn)
 
     if bye:
         print "bye", bye
@@ -251,6 +505,14 @@ def main(args=None):
             print "game", p1, p2, "# A" if (p1, p2) in arbitrary else ""
         else:
             print "game", p1, p2
+    return pairings, bye
+
+def simulated_round(tourn, args):
+    """ Pair a round of a simulated tournament without printing it """
+    tourn = prepare(tourn, args)
+    pairings, bye = get_pairings(tourn, args)
+    pairings, arbitrary = assign_colors(tourn, pairings)
+    return pairings, bye
 
 if __name__ == "__main__":
     main()
@@ -14,9 +14,18 @@ _base_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(_base_dir, "lib"))
 
 from pair import (
-        assign_colors, parse_seeds, parse_history, parse_tournament,
-        rate, weighted_pairing,
+        assign_colors, cached_rate, capture_output, combine_terms,
+        follow_state, open_state, pair_sections, parse_seeds, parse_history,
+        parse_sections, parse_tournament, weighted_pairing,
         )
+from audit import audit_rounds, print_audit
+from batch import apply_options, request_tournament, run_batch
+from daemon import make_server
+from metrics import last_round, recording
+from result_cache import cached_result
+from simulate import print_summary, simulate_tournaments, summarize
+from snapshot import load_state
+from timing import profiling
 
 class Swiss_Scale(object):
     """
@@ -55,63 +64,89 @@ class Swiss_Scale(object):
             self.num_with_score[0] = len(tourn.players)
 
     def bye(self, player):
+        return combine_terms(self.bye_terms(player))
+
+    def bye_terms(self, player):
         num_alive = self.num_alive
 
-        # 2 bye to fewest bye player
-        weight = self.tourn.byes[player]
-        # 3 descending order of N, minimize number of pairings for Nth time
-        weight *= self.pair_mul
-        # 4 bye to most losses
-        weight *= (self.most_losses + 1)
-        weight += self.most_losses - self.tourn.losses[player]
-        # 5 descending order of N, minimize pairings with scores differing by N
-        weight *= (num_alive + 1) ** ((self.rounds * 2) + 1)
-        # 6 bye to worst ranked
-        weight *= (num_alive + 1)
-        weight += self.num_alive - self.tourn.ranks[player]
-        # 7 minimize rank differences
-        weight *= (num_alive ** 2) + 1
-        return weight
+        return [
+                # 2 bye to fewest bye player
+                ("fewest byes", 1, self.tourn.byes[player]),
+                # 3 descending order of N, minimize number of pairings for Nth time
+                ("repeat pairings", self.pair_mul, 0),
+                # 4 bye to most losses
+                ("bye losses", self.most_losses + 1,
+                    self.most_losses - self.tourn.losses[player]),
+                # 5 descending order of N, minimize pairings with scores differing by N
+                ("score difference", (num_alive + 1) ** ((self.rounds * 2) + 1), 0),
+                # 6 bye to worst ranked
+                ("bye rank", num_alive + 1,
+                    self.num_alive - self.tourn.ranks[player]),
+                # 7 minimize rank differences
+                ("rank difference", (num_alive ** 2) + 1, 0),
+                ]
 
     def pair(self, p1, p2):
+        return combine_terms(self.pair_terms(p1, p2))
+
+    def pair_terms(self, p1, p2):
         num_alive = self.num_alive
         score = self.tourn.score
 
-        # 3 descending order of N, minimize number of pairings for Nth time
-        weight = (num_alive + 1) ** self.tourn.pair_counts[frozenset((p1, p2))]
-        # 4 bye to most losses
-        weight *= (self.most_losses + 1)
-        # 5 descending order of N, minimize pairings with scores differing by N
-        weight *= (num_alive + 1) ** ((self.rounds * 2) + 1)
-        weight += (num_alive + 1) ** int(abs(score[p1] - score[p2]) * 2)
-        # 6 bye to worst ranked
-        weight *= (num_alive + 1)
-        # 7 minimize rank differences
-        weight *= (num_alive ** 2) + 1
         rank_difference = abs(self.tourn.ranks[p1] - self.tourn.ranks[p2])
         if score[p1] == score[p2]:
-            weight += int(abs(rank_difference - (
+            rank_weight = int(abs(rank_difference - (
                 self.num_with_score[score[p1]] / 2.)) * 2)
         else:
-            weight += (rank_difference) ** 2
-        return weight
+            rank_weight = (rank_difference) ** 2
+        return [
+                # 3 descending order of N, minimize number of pairings for Nth time
+                ("repeat pairings", 1,
+                    (num_alive + 1) ** self.tourn.pair_counts[frozenset((p1, p2))]),
+                # 4 bye to most losses
+                ("bye losses", self.most_losses + 1, 0),
+                # 5 descending order of N, minimize pairings with scores differing by N
+                ("score difference", (num_alive + 1) ** ((self.rounds * 2) + 1),
+                    (num_alive + 1) ** int(abs(score[p1] - score[p2]) * 2)),
+                # 6 bye to worst ranked
+                ("bye rank", num_alive + 1, 0),
+                # 7 minimize rank differences
+                ("rank difference", (num_alive ** 2) + 1, rank_weight),
+                ]
+
+    def history_free_order(self, players):
+        """ Before any games everyone has the same score, pairing each player
+        with the one half the field further down gets every pair as close to
+        the target rank difference as possible. Needs the whole field with
+        consecutive ranks.
+        """
+        ranks = self.tourn.ranks
+        score = self.tourn.score
+        ordered = sorted(players, key=lambda p: ranks[p])
+        if (len(ordered) != self.num_alive
+                or [ranks[p] for p in ordered] != range(1, len(ordered) + 1)
+                or any(self.num_with_score[score[p]] != self.num_alive
+                    for p in ordered)):
+            return None
+        return ordered, "slide"
 
 def filter_players(tourn, min_loss):
     players = [p for p in tourn.players if tourn.losses[p] >= min_loss]
     tourn.players = frozenset(players)
 
-def get_pairings(tourn, virtual=0.5):
+def rank_players(tourn, virtual=0.5):
+    """ Rate and score the players and set their order and rank on tourn """
     rounds = tourn.rounds
     if rounds is None:
         if tourn.played.values():
             raise ValueError("Round information not found for tournament.")
         rounds = 0
-    elif rounds < tourn.played.most_common(1)[0][1]:
+    elif tourn.played and rounds < tourn.played.most_common(1)[0][1]:
         p = tourn.played.most_common(1)[0][0]
         raise ValueError(
                 "Games played by player %s is larger than number of rounds" %
                 (p,))
-    stpr = rate(tourn.seeds, tourn, virtual)
+    stpr = cached_rate(tourn.seeds, tourn, virtual)
     tourn.score = dict()
     for p in tourn.players:
         tourn.score[p] = tourn.wins[p] + ((rounds - tourn.played[p]) * 0.5)
@@ -120,10 +155,55 @@ def get_pairings(tourn, virtual=0.5):
     tourn.player_order = {p: order(p) for p in tourn.players}
     sorted_players = sorted(tourn.players, key=order)
     tourn.ranks = {p: rank for rank, p in enumerate(sorted_players, start=1)}
+
+def get_pairings(tourn, virtual=0.5):
+    rank_players(tourn, virtual)
     scale = Swiss_Scale(tourn)
     pairings, bye = weighted_pairing(tourn, scale)
     return pairings, bye
 
+def print_ranks(tourn):
+    players = sorted(tourn.players, key=lambda p: tourn.ranks[p])
+    for p in players:
+        print "#", tourn.ranks[p], p, tourn.player_order[p]
+
+def print_sections(sections, args):
+    """ Pair every section at once and print them in order """
+    if args.audit:
+        print "Pick a section with --section"
+        sys.exit(1)
+    results = pair_sections(sections, lambda tourn: pair_round(tourn, args),
+            args.processes)
+    for name, (result, output) in results.items():
+        print "# section", name
+        sys.stdout.write(output)
+
+BATCH_OPTIONS = ("prelives", "virtual", "ranks", "show_arbitrary")
+
+def batch_request(request, args):
+    """ Pair one --batch request """
+    config = apply_options(args, request.get("options", {}), BATCH_OPTIONS)
+    tourn = request_tournament(request)
+    (pairings, bye), output = capture_output(pair_round,
+            tourn.working_copy(), config)
+    return {"pairings": pairings, "bye": bye, "output": output}
+
+def serve_commands(args):
+    """ The commands answered by --serve, standings rank every player """
+    def ranks(tourn):
+        if args.prelives > 0:
+            filter_players(tourn, args.prelives)
+        rank_players(tourn, args.virtual)
+        print_ranks(tourn)
+    def standings(tourn):
+        rank_players(tourn, args.virtual)
+        print_ranks(tourn)
+    return {
+            "pair": lambda tourn: pair_round(tourn, args),
+            "ranks": ranks,
+            "standings": standings,
+            }
+
 def parse_args(args=None):
     parser = ArgumentParser(description="Pair swiss weekend tournament")
     parser.add_argument("-v", "--virtual", help="Virtual game weight",
@@ -140,6 +220,64 @@ def parse_args(args=None):
             help="aaaa style player seeds")
     parser.add_argument("--history_file", "--games",
             help="aaaa style tournament history")
+    parser.add_argument("--snapshot",
+            help="Load the state through a binary snapshot kept next to it",
+            action="store_true")
+    parser.add_argument("--follow",
+            help="Keep following the state file, pairing each round as soon "
+            "as the previous one is complete", action="store_true")
+    parser.add_argument("--interval",
+            help="Seconds between checks of the state file with --follow",
+            type=float, default=5.0)
+    parser.add_argument("--processes", type=int,
+            help="Number of worker processes for --speculate, --simulate, "
+            "--audit, --batch and state files with sections, by default one "
+            "per CPU")
+    parser.add_argument("--speculate", metavar="GAMES", type=int, default=0,
+            help="With --follow, pair the next round for every outcome once "
+            "no more than this many games are left")
+    parser.add_argument("--speculate-results", metavar="RESULTS",
+            type=lambda s: s.split(","), default=[],
+            help="Comma separated results besides a win to speculate on, "
+            "like draw")
+    parser.add_argument("--batch",
+            help="Pair the JSON requests read from each line of stdin",
+            action="store_true")
+    parser.add_argument("--serve", metavar="ADDRESS",
+            help="Keep running and answer pairing requests on this Unix "
+            "socket path or host:port")
+    parser.add_argument("--memory-cap", metavar="MB", type=float,
+            default=512, help="Memory for tournaments kept by --serve")
+    parser.add_argument("--cache-dir", metavar="DIR",
+            help="Keep pairings in this directory and print them from there "
+            "when the same state is paired with the same options again")
+    parser.add_argument("--cache-size", metavar="MB", type=float,
+            default=64, help="Size limit of --cache-dir")
+    parser.add_argument("--profile",
+            help="Print the time taken by each phase of the run to stderr",
+            action="store_true")
+    parser.add_argument("--profile-dump", metavar="FILE",
+            help="Write cProfile stats of the whole run to this file")
+    parser.add_argument("--metrics", metavar="FILE",
+            help="Append the size and cost of pairing each round to this "
+            "file, see metrics_report.py")
+    parser.add_argument("--metrics-format", choices=("jsonl", "prometheus"),
+            help="Format of --metrics, by default prometheus for a .prom "
+            "file and JSON lines otherwise")
+    parser.add_argument("--section",
+            help="Only use this section of a state file with sections")
+    parser.add_argument("--audit",
+            help="Pair every round of the state file again and report where "
+            "the recorded games differ", action="store_true")
+    parser.add_argument("--simulate", metavar="COUNT", type=int,
+            help="Simulate this many tournaments of random players paired "
+            "with these options and print summary statistics")
+    parser.add_argument("--field-size", type=int, default=16,
+            help="Number of players in each simulated tournament")
+    parser.add_argument("--rounds", type=int, default=6,
+            help="Rounds per simulated tournament")
+    parser.add_argument("--sim-seed", type=int, default=0,
+            help="Base random seed for --simulate")
     parser.add_argument("tournament_state", help="Tournament state file",
             nargs="?")
     args = parser.parse_args(args)
@@ -147,33 +285,101 @@ def parse_args(args=None):
         print "Cannot use both regular tournament state file and aaaa style"
         parser.print_help()
         sys.exit(1)
+    if args.simulate or args.serve or args.batch:
+        return args
     if not args.seed_file and not args.tournament_state:
         print "Must give tournament state"
         parser.print_help()
         sys.exit(1)
+    if (args.follow or args.audit) and not args.tournament_state:
+        print "Can only follow or audit a tournament state file"
+        parser.print_help()
+        sys.exit(1)
     return args
 
 def main(args=None):
     args = parse_args(args)
+    with profiling(args.profile, args.profile_dump):
+        run(args)
+
+def run(args):
+    if args.batch:
+        run_batch(sys.stdin, lambda request: batch_request(request, args),
+                args.processes)
+        return
+    if args.serve:
+        server = make_server(args.serve, serve_commands(args),
+                args.memory_cap * 2 ** 20, ())
+        server.serve_forever()
+        return
+    if args.simulate:
+        results = simulate_tournaments(
+                lambda tourn: simulated_round(tourn, args), args.simulate,
+                args.field_size, args.sim_seed, args.rounds, args.processes)
+        print_summary(summarize(results))
+        return
+    if args.follow:
+        follow_state(args.tournament_state,
+                lambda tourn: pair_round(tourn, args), args.interval,
+                speculate=args.speculate, results=args.speculate_results,
+                processes=args.processes)
+        return
     if args.tournament_state:
-        with open(args.tournament_state) as state_file:
-            tourn = parse_tournament(state_file.read())
+        if args.snapshot:
+            tourn = load_state(args.tournament_state, args.section)
+        else:
+            with open_state(args.tournament_state) as state_file:
+                if args.section is not None:
+                    tourn = parse_tournament(state_file,
+                            section=args.section)
+                else:
+                    sections = parse_sections(state_file)
+            if args.section is None:
+                if list(sections) != [None]:
+                    print_sections(sections, args)
+                    return
+                tourn = sections[None]
     else:
-        with open(args.seed_file) as seed_file:
-            tourn = parse_seeds(seed_file.read())
+        with open_state(args.seed_file) as seed_file:
+            tourn = parse_seeds(seed_file)
         if args.history_file:
-            with open(args.history_file) as history_file:
-                parse_history(tourn, history_file.read())
+            with open_state(args.history_file) as history_file:
+                parse_history(tourn, history_file)
+
+    if args.audit:
+        audit = audit_rounds(tourn.events,
+                lambda tourn: simulated_round(tourn, args), args.processes)
+        if not print_audit(audit):
+            sys.exit(1)
+        return
+    pair_round(tourn, args)
 
+def pairing_options(args):
+    """ The options that change the pairing, for the --cache-dir key """
+    return {"prelives": args.prelives, "virtual": args.virtual}
+
+def solve_round(tourn, args):
+    """ The coloured pairings, bye and ranks of the next round """
+    pairings, bye = get_pairings(tourn, args.virtual)
+    pairings, arbitrary = assign_colors(tourn, pairings)
+    return {"pairings": pairings, "bye": bye, "arbitrary": arbitrary,
+            "ranks": tourn.ranks, "player_order": tourn.player_order}
+
+def pair_round(tourn, args):
+    """ Pair and print the next round, returns its pairings and bye """
     if args.prelives > 0:
         filter_players(tourn, args.prelives)
-    pairings, bye = get_pairings(tourn, args.virtual)
+    with recording(args.metrics, args.metrics_format, script="wt_swiss",
+            round=last_round(tourn.events)):
+        result, output = cached_result(tourn, pairing_options(args), args,
+                __file__, lambda: solve_round(tourn, args))
+    sys.stdout.write(output)
+    tourn.ranks = result["ranks"]
+    tourn.player_order = result["player_order"]
+    pairings, bye = result["pairings"], result["bye"]
+    arbitrary = result["arbitrary"]
     if args.ranks:
-        players = sorted(tourn.players, key=lambda p: tourn.ranks[p])
-        for p in players:
-            print "#", tourn.ranks[p], p, tourn.player_order[p]
-
-    pairings, arbitrary = assign_colors(tourn, pairings)
+        print_ranks(tourn)
 
     if bye:
         print "bye", bye
@@ -182,6 +388,15 @@ def main(args=None):
             print "game", p1, p2, "A" if (p1, p2) in arbitrary else ""
         else:
             print "game", p1, p2
+    return pairings, bye
+
+def simulated_round(tourn, args):
+    """ Pair a round of a simulated tournament without printing it """
+    if args.prelives > 0:
+        filter_players(tourn, args.prelives)
+    pairings, bye = get_pairings(tourn, args.virtual)
+    pairings, arbitrary = assign_colors(tourn, pairings)
+    return pairings, bye
 
 if __name__ == "__main__":
     main()